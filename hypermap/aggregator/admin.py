@@ -4,8 +4,8 @@ from django_celery_results.models import TaskResult
 
 from django.core.urlresolvers import reverse
 
-from models import (Service, Layer, Check, SpatialReferenceSystem, EndpointList,
-                    Endpoint, LayerDate, LayerWM, Catalog, IssueType, Issue)
+from models import (Service, Layer, Check, CheckRollup, SpatialReferenceSystem, EndpointList,
+                    Endpoint, LayerDate, LayerWM, Catalog, IssueType, Issue, IndexQueueItem, IndexTimeBounds)
 
 
 class ServiceAdmin(admin.ModelAdmin):
@@ -50,12 +50,22 @@ class LayerWMAdmin(admin.ModelAdmin):
 
 class CheckAdmin(admin.ModelAdmin):
     model = Check
-    list_display = ('id', 'content_type', 'content_object', 'checked_datetime', 'success', 'response_time', )
+    list_display = ('id', 'content_type', 'content_object', 'checked_datetime', 'success', 'response_time',
+                    'response_size', )
     search_fields = ['=object_id']
     list_filter = ('success', 'content_type')
     date_hierarchy = 'checked_datetime'
 
 
+class CheckRollupAdmin(admin.ModelAdmin):
+    model = CheckRollup
+    list_display = ('id', 'content_type', 'content_object', 'period', 'start_datetime', 'checks_count',
+                    'success_checks_count', 'min_response_time', 'max_response_time', )
+    search_fields = ['=object_id']
+    list_filter = ('period', 'content_type')
+    date_hierarchy = 'start_datetime'
+
+
 class EndpointListAdmin(admin.ModelAdmin):
     model = EndpointList
     list_display = ('id', 'upload', 'endpoints_admin_url', 'catalog', 'greedy')
@@ -94,8 +104,22 @@ class IssueAdmin(admin.ModelAdmin):
     content_object_link.short_description = 'content object'
 
 
+class IndexQueueItemAdmin(admin.ModelAdmin):
+    model = IndexQueueItem
+    list_display = ('layer_id', 'action', 'enqueued', 'claimed', 'retries', 'last_error')
+    list_filter = ('action', )
+    search_fields = ['=layer_id']
+    date_hierarchy = 'enqueued'
+
+
+class IndexTimeBoundsAdmin(admin.ModelAdmin):
+    model = IndexTimeBounds
+    list_display = ('index_name', 'min_date', 'max_date', 'last_updated')
+
+
 admin.site.register(Service, ServiceAdmin)
 admin.site.register(Check, CheckAdmin)
+admin.site.register(CheckRollup, CheckRollupAdmin)
 admin.site.register(SpatialReferenceSystem, SpatialReferenceSystemAdmin)
 admin.site.register(Layer, LayerAdmin)
 admin.site.register(LayerWM, LayerWMAdmin)
@@ -105,6 +129,8 @@ admin.site.register(Endpoint, EndpointAdmin)
 admin.site.register(Catalog, CatalogAdmin)
 admin.site.register(IssueType, IssueTypeAdmin)
 admin.site.register(Issue, IssueAdmin)
+admin.site.register(IndexQueueItem, IndexQueueItemAdmin)
+admin.site.register(IndexTimeBounds, IndexTimeBoundsAdmin)
 
 
 class CustomTaskResultAdmin(admin.ModelAdmin):
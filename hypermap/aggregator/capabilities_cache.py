@@ -0,0 +1,108 @@
+"""
+Cache of parsed capabilities documents, keyed by (url, service type, version).
+
+Parsed documents are kept in an in process LRU cache. When
+REGISTRY_CAPABILITIES_CACHE_DIR is set, the raw XML of OGC documents is also
+stored on disk, so that other worker processes can parse it without
+downloading it again.
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import time
+
+from django.conf import settings
+
+from owslib.wms import WebMapService
+from owslib.wmts import WebMapTileService
+
+from hypermap.aggregator.lru import LRUCache
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_CAPABILITIES_CACHE_TTL = getattr(settings, 'REGISTRY_CAPABILITIES_CACHE_TTL', 600)
+REGISTRY_CAPABILITIES_CACHE_SIZE = getattr(settings, 'REGISTRY_CAPABILITIES_CACHE_SIZE', 20)
+REGISTRY_CAPABILITIES_CACHE_DIR = getattr(settings, 'REGISTRY_CAPABILITIES_CACHE_DIR', None)
+
+# service types whose documents can be stored as XML and parsed again
+XML_SERVICE_TYPES = ('OGC:WMS', 'OGC:WMTS')
+
+
+class CapabilitiesCache(object):
+
+    def __init__(self, timeout=REGISTRY_CAPABILITIES_CACHE_TTL, maxsize=REGISTRY_CAPABILITIES_CACHE_SIZE,
+                 directory=REGISTRY_CAPABILITIES_CACHE_DIR):
+        self.timeout = timeout
+        self.directory = directory
+        self.memory = LRUCache(maxsize=maxsize, timeout=timeout)
+
+    def get(self, url, service_type, version=None):
+        """
+        Return the parsed document, or None if it is not cached or it expired.
+        """
+        key = (url, service_type, version)
+        ows = self.memory.get(key)
+        if ows is None:
+            ows = self._get_from_disk(key)
+            if ows is not None:
+                self.memory.set(key, ows)
+        return ows
+
+    def set(self, url, service_type, ows, version=None):
+        key = (url, service_type, version)
+        self.memory.set(key, ows)
+        self._set_to_disk(key, ows)
+
+    def delete(self, url, service_type, version=None):
+        key = (url, service_type, version)
+        self.memory.delete(key)
+        path = self._path(key)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def clear(self):
+        self.memory.clear()
+
+    def _path(self, key):
+        if not self.directory or key[1] not in XML_SERVICE_TYPES:
+            return None
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.directory, '%s.capabilities' % digest)
+
+    def _get_from_disk(self, key):
+        path = self._path(key)
+        if not path or not os.path.exists(path):
+            return None
+        if self.timeout is not None and os.path.getmtime(path) + self.timeout < time.time():
+            return None
+        try:
+            with open(path, 'rb') as f:
+                entry = cPickle.load(f)
+            url, service_type, version = key
+            if service_type == 'OGC:WMS':
+                return WebMapService(url, version=entry['version'], xml=entry['xml'])
+            return WebMapTileService(url, version=entry['version'], xml=entry['xml'])
+        except Exception, e:
+            LOGGER.warning('Cannot read cached capabilities from %s: %s' % (path, e))
+            return None
+
+    def _set_to_disk(self, key, ows):
+        path = self._path(key)
+        if not path:
+            return
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            entry = {'version': ows.version, 'xml': ows.getServiceXML()}
+            # write and rename, so that readers never get a partial file
+            tmp_path = '%s.%s' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except Exception, e:
+            LOGGER.warning('Cannot write cached capabilities to %s: %s' % (path, e))
+
+
+capabilities_cache = CapabilitiesCache()
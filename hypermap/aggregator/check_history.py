@@ -0,0 +1,127 @@
+"""
+Retention of the checks of the services and layers.
+
+Checks are kept for REGISTRY_CHECK_RETENTION_DAYS days, older checks are
+rolled up into one CheckRollup row per resource and hour. Hourly rollups are
+kept for REGISTRY_CHECK_HOURLY_RETENTION_DAYS days, then rolled up into one
+row per resource and day, kept forever. Periods are rolled up one at a time
+with grouped aggregates, the rollups are created and the rolled up rows
+deleted in the same transaction.
+
+The statistics of the resources (see check_stats) are not changed when their
+checks are rolled up.
+"""
+
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum, Min, Max, Case, When, IntegerField
+from django.utils import timezone
+
+LOGGER = logging.getLogger(__name__)
+
+# days the checks are kept before being rolled up into hourly rollups, 0 keeps them forever
+REGISTRY_CHECK_RETENTION_DAYS = getattr(settings, 'REGISTRY_CHECK_RETENTION_DAYS', 30)
+# days the hourly rollups are kept before being rolled up into daily rollups, 0 keeps them forever
+REGISTRY_CHECK_HOURLY_RETENTION_DAYS = getattr(settings, 'REGISTRY_CHECK_HOURLY_RETENTION_DAYS', 180)
+
+PERIODS = {
+    'hour': datetime.timedelta(hours=1),
+    'day': datetime.timedelta(days=1),
+}
+
+# aggregates of the checks of a period
+CHECKS_AGGREGATES = {
+    'rolled_checks_count': Count('id'),
+    'rolled_success_checks_count': Sum(Case(When(success=True, then=1), default=0, output_field=IntegerField())),
+    'rolled_response_time_sum': Sum('response_time'),
+    'rolled_min_response_time': Min('response_time'),
+    'rolled_max_response_time': Max('response_time'),
+}
+
+# aggregates of the rollups of a period
+ROLLUPS_AGGREGATES = {
+    'rolled_checks_count': Sum('checks_count'),
+    'rolled_success_checks_count': Sum('success_checks_count'),
+    'rolled_response_time_sum': Sum('response_time_sum'),
+    'rolled_min_response_time': Min('min_response_time'),
+    'rolled_max_response_time': Max('max_response_time'),
+}
+
+
+def get_period_start(value, period):
+    """
+    Return the start of the hour or day of a datetime.
+    """
+    value = value.replace(minute=0, second=0, microsecond=0)
+    if period == 'day':
+        value = value.replace(hour=0)
+    return value
+
+
+def roll_up(queryset, datetime_field, aggregates, period, before):
+    """
+    Roll up the rows of queryset older than the period of before into one rollup per resource and period.
+    Return the number of checks rolled up.
+    """
+    from hypermap.aggregator.models import CheckRollup
+
+    queryset = queryset.order_by()
+    before = get_period_start(before, period)
+    rolled = 0
+    while True:
+        first = queryset.filter(**{datetime_field + '__lt': before}).aggregate(first=Min(datetime_field))['first']
+        if first is None:
+            return rolled
+        start = get_period_start(first, period)
+        window = queryset.filter(**{
+            datetime_field + '__gte': start,
+            datetime_field + '__lt': start + PERIODS[period],
+        })
+        with transaction.atomic():
+            rollups = [
+                CheckRollup(
+                    content_type_id=row['content_type_id'],
+                    object_id=row['object_id'],
+                    period=period,
+                    start_datetime=start,
+                    checks_count=row['rolled_checks_count'],
+                    success_checks_count=row['rolled_success_checks_count'],
+                    response_time_sum=row['rolled_response_time_sum'],
+                    min_response_time=row['rolled_min_response_time'],
+                    max_response_time=row['rolled_max_response_time'],
+                )
+                for row in window.values('content_type_id', 'object_id').annotate(**aggregates)
+            ]
+            CheckRollup.objects.bulk_create(rollups)
+            window.delete()
+        checks_count = sum(rollup.checks_count for rollup in rollups)
+        rolled += checks_count
+        LOGGER.debug('Rolled up %s checks of %s resources in the %s of %s' % (
+            checks_count, len(rollups), period, start))
+
+
+def rollup_checks(now=None):
+    """
+    Roll up the checks older than REGISTRY_CHECK_RETENTION_DAYS days into hourly rollups, and the hourly
+    rollups older than REGISTRY_CHECK_HOURLY_RETENTION_DAYS days into daily rollups.
+    Return the number of checks rolled up into hourly rollups and into daily rollups.
+    """
+    from hypermap.aggregator.models import Check, CheckRollup
+
+    now = now or timezone.now()
+    hourly_checks = 0
+    daily_checks = 0
+    if REGISTRY_CHECK_RETENTION_DAYS:
+        hourly_checks = roll_up(
+            Check.objects.all(), 'checked_datetime', CHECKS_AGGREGATES, 'hour',
+            now - datetime.timedelta(days=REGISTRY_CHECK_RETENTION_DAYS)
+        )
+    if REGISTRY_CHECK_HOURLY_RETENTION_DAYS:
+        daily_checks = roll_up(
+            CheckRollup.objects.filter(period='hour'), 'start_datetime', ROLLUPS_AGGREGATES, 'day',
+            now - datetime.timedelta(days=REGISTRY_CHECK_HOURLY_RETENTION_DAYS)
+        )
+    return hourly_checks, daily_checks
@@ -0,0 +1,127 @@
+"""
+Adaptive scheduling of the checks of the services and layers.
+
+Each service and layer has its own next check time. The check_due_resources
+task, polled by Celery beat every REGISTRY_CHECK_SCHEDULER_PERIOD minutes,
+claims the resources whose check is due, up to the REGISTRY_CHECK_BUDGET
+requests per minute budget, and schedules their next check.
+
+The interval before the next check of a resource starts from
+REGISTRY_CHECK_PERIOD minutes, and is:
+
+- longer for stable resources, always up or always down, and shorter for
+  flapping ones (see the decayed reliability in check_stats),
+- shorter for services whose capabilities document often changes,
+- longer for slow resources,
+
+bounded by REGISTRY_CHECK_MIN_PERIOD and REGISTRY_CHECK_MAX_PERIOD and
+randomized by REGISTRY_CHECK_JITTER, so resources added together are not
+checked together forever. Never checked resources are due at once, then
+resources with a higher check_priority are checked first.
+"""
+
+import datetime
+import logging
+import random
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+LOGGER = logging.getLogger(__name__)
+
+# minutes between two checks of a resource, before being adapted to its history
+REGISTRY_CHECK_PERIOD = getattr(settings, 'REGISTRY_CHECK_PERIOD', 1440)
+REGISTRY_CHECK_MIN_PERIOD = getattr(settings, 'REGISTRY_CHECK_MIN_PERIOD', 60)
+REGISTRY_CHECK_MAX_PERIOD = getattr(settings, 'REGISTRY_CHECK_MAX_PERIOD', 7 * 1440)
+# fraction of the interval randomly added or removed
+REGISTRY_CHECK_JITTER = getattr(settings, 'REGISTRY_CHECK_JITTER', 0.1)
+# highest number of checks started per minute, a service check is one request, as a layer check
+REGISTRY_CHECK_BUDGET = getattr(settings, 'REGISTRY_CHECK_BUDGET', 60)
+# minutes between two polls of the due checks
+REGISTRY_CHECK_SCHEDULER_PERIOD = getattr(settings, 'REGISTRY_CHECK_SCHEDULER_PERIOD', 1)
+
+# weight of the last harvest in the capabilities change rate
+CHANGE_RATE_DECAY = 0.2
+
+# response time (in seconds) from which the interval of a resource is doubled
+SLOW_RESPONSE_TIME = 30.0
+
+# fields not overwritten by Resource.save, as record_capabilities updates them in the database
+SCHEDULE_FIELDS = ('capabilities_change_rate',)
+
+# fields read to compute the interval of a resource
+CLAIM_FIELDS = ('id', 'check_priority', 'checks_count', 'decayed_reliability', 'recent_checks_status',
+                'response_time_sum', 'capabilities_change_rate')
+
+
+def get_check_interval(resource):
+    """
+    Return the number of minutes before the next check of a resource, from its check statistics.
+    """
+    if not resource.checks_count:
+        return REGISTRY_CHECK_MIN_PERIOD
+
+    interval = float(REGISTRY_CHECK_PERIOD)
+    # 0 for resources always up or always down, 1 for resources up half of the time
+    reliability = resource.decayed_reliability / 100.0
+    instability = 4 * reliability * (1 - reliability)
+    interval *= 2 ** (1 - 2 * instability)
+    if len(set(resource.recent_checks_status)) > 1:
+        # the status just changed
+        interval /= 2
+    interval /= 1 + 3 * getattr(resource, 'capabilities_change_rate', 0)
+    interval *= 1 + min(resource.average_response_time or 0, SLOW_RESPONSE_TIME) / SLOW_RESPONSE_TIME
+
+    interval = min(max(interval, REGISTRY_CHECK_MIN_PERIOD), REGISTRY_CHECK_MAX_PERIOD)
+    return interval * random.uniform(1 - REGISTRY_CHECK_JITTER, 1 + REGISTRY_CHECK_JITTER)
+
+
+def claim_due(queryset, limit, now):
+    """
+    Return the ids of up to limit resources of queryset whose check is due, and schedule their next check.
+    """
+    if limit <= 0:
+        return []
+
+    model = queryset.model
+    model_fields = [field.name for field in model._meta.concrete_fields]
+    fields = [name for name in CLAIM_FIELDS if name in model_fields]
+    with transaction.atomic():
+        resources = list(queryset.filter(next_check__isnull=True).select_for_update().only(*fields).order_by(
+            '-check_priority', 'id')[0:limit])
+        if len(resources) < limit:
+            resources += list(queryset.filter(next_check__lte=now).select_for_update().only(*fields).order_by(
+                '-check_priority', 'next_check')[0:limit - len(resources)])
+        for resource in resources:
+            next_check = now + datetime.timedelta(minutes=get_check_interval(resource))
+            model.objects.filter(id=resource.id).update(next_check=next_check)
+    return [resource.id for resource in resources]
+
+
+def claim_due_resources(now=None):
+    """
+    Return the ids of the services and of the layers to check now, within the budget of a scheduler period.
+    Services are claimed first, as their check also harvests their layers.
+    """
+    from hypermap.aggregator.models import Service, Layer
+
+    now = now or timezone.now()
+    budget = int(REGISTRY_CHECK_BUDGET * REGISTRY_CHECK_SCHEDULER_PERIOD)
+    service_ids = claim_due(Service.objects.filter(active=True), budget, now)
+    layers = Layer.objects.filter(active=True, is_monitored=True, service__active=True, service__is_monitored=True)
+    layer_ids = claim_due(layers, budget - len(service_ids), now)
+    return service_ids, layer_ids
+
+
+def record_capabilities(service_id, changed):
+    """
+    Update the capabilities change rate of a service after a successful harvest.
+    """
+    from hypermap.aggregator.models import Service
+
+    Service.objects.filter(id=service_id).update(
+        capabilities_change_rate=F('capabilities_change_rate') * (1 - CHANGE_RATE_DECAY) +
+        (CHANGE_RATE_DECAY if changed else 0)
+    )
@@ -0,0 +1,167 @@
+"""
+Check statistics of the services and layers.
+
+The statistics of a resource (number of checks, reliability, response times,
+last status...) are stored in its row and updated in constant time when one of
+its checks is saved, so pages and indexed documents read them without
+aggregating the Check table. Besides the totals, a resource keeps the status
+of its RECENT_CHECKS_NUMBER last checks, an exponentially decayed reliability
+and a response time histogram.
+
+Statistics are only written by record_check (and rebuilt from the checks by
+rebuild), Resource.save does not overwrite them.
+"""
+
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum, Min, Max, Case, When, IntegerField
+
+LOGGER = logging.getLogger(__name__)
+
+# weight of the last check in the decayed reliability
+REGISTRY_CHECK_RELIABILITY_DECAY = getattr(settings, 'REGISTRY_CHECK_RELIABILITY_DECAY', 0.1)
+
+# upper bounds (in seconds) of the response time histogram buckets, a last bucket counts the slower checks
+RESPONSE_TIME_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# statistics of a resource without checks
+EMPTY_STATS = {
+    'checks_count': 0,
+    'success_checks_count': 0,
+    'first_checked': None,
+    'last_checked': None,
+    'last_status': None,
+    'recent_checks_status': '',
+    'response_time_sum': 0,
+    'min_response_time': None,
+    'max_response_time': None,
+    'decayed_reliability': None,
+    'response_time_histogram': '',
+}
+
+STATS_FIELDS = tuple(EMPTY_STATS)
+
+
+def get_bucket(response_time):
+    """
+    Return the index of the histogram bucket of a response time.
+    """
+    for i, upper_bound in enumerate(RESPONSE_TIME_BUCKETS):
+        if response_time <= upper_bound:
+            return i
+    return len(RESPONSE_TIME_BUCKETS)
+
+
+def parse_histogram(histogram):
+    counts = [int(count) for count in histogram.split(',')] if histogram else []
+    return counts + [0] * (len(RESPONSE_TIME_BUCKETS) + 1 - len(counts))
+
+
+def updated_stats(resource, check):
+    """
+    Return the statistics fields of a resource after one more check.
+    """
+    from hypermap.aggregator.models import RECENT_CHECKS_NUMBER
+
+    response_time = float(check.response_time)
+    histogram = parse_histogram(resource.response_time_histogram)
+    histogram[get_bucket(response_time)] += 1
+    decayed_reliability = 100.0 if check.success else 0.0
+    if resource.decayed_reliability is not None:
+        decayed_reliability = (REGISTRY_CHECK_RELIABILITY_DECAY * decayed_reliability +
+                               (1 - REGISTRY_CHECK_RELIABILITY_DECAY) * resource.decayed_reliability)
+
+    return {
+        'checks_count': resource.checks_count + 1,
+        'success_checks_count': resource.success_checks_count + (1 if check.success else 0),
+        'first_checked': resource.first_checked or check.checked_datetime,
+        'last_checked': check.checked_datetime,
+        'last_status': check.success,
+        # most recent first
+        'recent_checks_status': (('1' if check.success else '0') + resource.recent_checks_status)[
+            0:RECENT_CHECKS_NUMBER],
+        'response_time_sum': resource.response_time_sum + response_time,
+        'min_response_time': min(response_time, resource.min_response_time)
+        if resource.min_response_time is not None else response_time,
+        'max_response_time': max(response_time, resource.max_response_time)
+        if resource.max_response_time is not None else response_time,
+        'decayed_reliability': decayed_reliability,
+        'response_time_histogram': ','.join(str(count) for count in histogram),
+    }
+
+
+def record_check(check):
+    """
+    Add a new check to the statistics of its resource. The resource row is locked during the update,
+    so concurrent checks of a resource are all counted.
+    """
+    model = check.content_type.model_class()
+    with transaction.atomic():
+        resource = model.objects.select_for_update().only(*STATS_FIELDS).filter(pk=check.object_id).first()
+        if resource is None:
+            return
+        stats = updated_stats(resource, check)
+        model.objects.filter(pk=check.object_id).update(**stats)
+    # the resource of the check, if loaded, sees its new statistics
+    content_object = getattr(check, check.__class__.content_object.cache_attr, None)
+    if content_object is not None:
+        for name, value in stats.items():
+            setattr(content_object, name, value)
+
+
+def reset(model, ids):
+    """
+    Reset the statistics of resources whose checks were deleted.
+    """
+    model.objects.filter(pk__in=ids).update(**EMPTY_STATS)
+
+
+def rebuild(model, check_model, content_type_id):
+    """
+    Compute the statistics of all the resources of a model from their checks, with grouped aggregates.
+    The decayed reliability starts from the reliability.
+    """
+    from hypermap.aggregator.models import RECENT_CHECKS_NUMBER
+
+    checks = check_model.objects.filter(content_type_id=content_type_id).order_by()
+    buckets = {}
+    lower_bound = None
+    for i, upper_bound in enumerate(RESPONSE_TIME_BUCKETS + (None, )):
+        when = {}
+        if lower_bound is not None:
+            when['response_time__gt'] = lower_bound
+        if upper_bound is not None:
+            when['response_time__lte'] = upper_bound
+        buckets['bucket_%s' % i] = Sum(Case(When(then=1, **when), default=0, output_field=IntegerField()))
+        lower_bound = upper_bound
+
+    rows = checks.values('object_id').annotate(
+        count=Count('id'),
+        success_count=Sum(Case(When(success=True, then=1), default=0, output_field=IntegerField())),
+        first_checked=Min('checked_datetime'),
+        last_checked=Max('checked_datetime'),
+        response_time_sum=Sum('response_time'),
+        min_response_time=Min('response_time'),
+        max_response_time=Max('response_time'),
+        **buckets
+    )
+    model.objects.exclude(pk__in=checks.values('object_id')).update(**EMPTY_STATS)
+    for row in rows:
+        recent = list(checks.filter(object_id=row['object_id']).order_by('-checked_datetime', '-id').values_list(
+            'success', flat=True)[0:RECENT_CHECKS_NUMBER])
+        model.objects.filter(pk=row['object_id']).update(
+            checks_count=row['count'],
+            success_checks_count=row['success_count'],
+            first_checked=row['first_checked'],
+            last_checked=row['last_checked'],
+            last_status=recent[0],
+            recent_checks_status=''.join('1' if success else '0' for success in recent),
+            response_time_sum=row['response_time_sum'],
+            min_response_time=row['min_response_time'],
+            max_response_time=row['max_response_time'],
+            decayed_reliability=row['success_count'] * 100.0 / row['count'],
+            response_time_histogram=','.join(
+                str(row['bucket_%s' % i]) for i in range(len(RESPONSE_TIME_BUCKETS) + 1)),
+        )
@@ -1,5 +1,6 @@
 import sys
 import logging
+import datetime
 import math
 import json
 
@@ -10,10 +11,15 @@ from django.utils.html import strip_tags
 from elasticsearch import Elasticsearch
 from shapely.geometry import box
 
-from hypermap.aggregator.utils import mercator_to_llbbox, get_date
+from hypermap.aggregator.lru import LRUCache
+from hypermap.aggregator.search_transport import get_elasticsearch_options
+from hypermap.aggregator.utils import mercator_to_llbbox, get_date, prefetch_layers
+from hypermap.search_api import cache as search_cache
 
 REGISTRY_MAPPING_PRECISION = getattr(settings, "REGISTRY_MAPPING_PRECISION", "500m")
 REGISTRY_SEARCH_URL = getattr(settings, "REGISTRY_SEARCH_URL", "elasticsearch+http://localhost:9200")
+# seconds the cluster version and the existing catalog indices are cached
+REGISTRY_SEARCH_INFO_TTL = getattr(settings, "REGISTRY_SEARCH_INFO_TTL", 300)
 
 SEARCH_TYPE = REGISTRY_SEARCH_URL.split('+')[0]
 SEARCH_URL = REGISTRY_SEARCH_URL.split('+')[1]
@@ -24,8 +30,11 @@ LOGGER = logging.getLogger(__name__)
 class ESHypermap(object):
 
     es_url = SEARCH_URL
-    es = Elasticsearch(hosts=[es_url])
+    es = Elasticsearch(hosts=[es_url], **get_elasticsearch_options())
     index_name = 'hypermap'
+    # cluster information and catalog indices known to exist, shared by the instances of the process
+    cluster_info = LRUCache(maxsize=1, timeout=REGISTRY_SEARCH_INFO_TTL)
+    known_indices = LRUCache(maxsize=1000, timeout=REGISTRY_SEARCH_INFO_TTL)
 
     def __init__(self):
         # TODO: this create_indices() should not happen here:
@@ -95,8 +104,9 @@ class ESHypermap(object):
 
         try:
             bbox = ESHypermap.get_bbox(layer)
-            for proj in layer.service.srs.values():
-                if proj['code'] in ('102113', '102100'):
+            srs_codes = [srs.code for srs in layer.service.srs.all()]
+            for code in srs_codes:
+                if code in ('102113', '102100'):
                     bbox = mercator_to_llbbox(bbox)
             if (ESHypermap.good_coords(bbox)) is False:
                 LOGGER.debug('Elasticsearch: There are not valid coordinates for this layer ', layer.title)
@@ -172,7 +182,7 @@ class ESHypermap(object):
                     "bbox": wkt,
                     "centroid_x": rectangle.centroid.x,
                     "centroid_y": rectangle.centroid.y,
-                    "srs": [srs.encode('utf-8') for srs in layer.service.srs.values_list('code', flat=True)],
+                    "srs": [code.encode('utf-8') for code in srs_codes],
                     "layer_geoshape": {
                        "type": "envelope",
                        "coordinates": [
@@ -200,8 +210,7 @@ class ESHypermap(object):
                     }
 
                 LOGGER.info(es_record)
-                # TODO: cache index creation.
-                ESHypermap.create_indices(layer.catalog.slug)
+                ESHypermap.ensure_index(layer.catalog.slug)
                 if not with_bulk:
                     ESHypermap.es.index(layer.catalog.slug, 'layer', json.dumps(es_record), id=layer.id,
                                         request_timeout=20)
@@ -217,21 +226,31 @@ class ESHypermap(object):
                          layer.id, sys.exc_info()[1]))
             return False, sys.exc_info()[1]
 
+    @staticmethod
+    def layers_to_es(layers):
+        """
+        Return the bulk actions indexing a queryset of layers, loading them with prefetch_layers.
+        Layers which can not be serialized are skipped.
+        """
+        actions = []
+        for layer in prefetch_layers(layers):
+            es_record = ESHypermap.layer_to_es(layer, with_bulk=True)
+            if isinstance(es_record, dict):
+                actions.append(es_record)
+        return actions
+
     @staticmethod
     def clear_es():
         """Clear all indexes in the es core"""
         # TODO: should receive a catalog slug.
         ESHypermap.es.indices.delete(ESHypermap.index_name, ignore=[400, 404])
+        ESHypermap.known_indices.clear()
+        search_cache.invalidate()
         LOGGER.debug('Elasticsearch: Index cleared')
 
     @staticmethod
-    def create_indices(catalog_slug):
-        """Create ES core indices """
-        # TODO: enable auto_create_index in the ES nodes to make this implicit.
-        # https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-index_.html#index-creation
-        # http://support.searchly.com/customer/en/portal/questions/
-        # 16312889-is-automatic-index-creation-disabled-?new=16312889
-        mapping = {
+    def get_index_mapping():
+        return {
             "mappings": {
                 "layer": {
                     "properties": {
@@ -244,4 +263,96 @@ class ESHypermap(object):
                 }
             }
         }
+
+    @staticmethod
+    def create_indices(catalog_slug):
+        """Create ES core indices """
+        # TODO: enable auto_create_index in the ES nodes to make this implicit.
+        # https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-index_.html#index-creation
+        # http://support.searchly.com/customer/en/portal/questions/
+        # 16312889-is-automatic-index-creation-disabled-?new=16312889
+        mapping = ESHypermap.get_index_mapping()
         ESHypermap.es.indices.create(catalog_slug, ignore=[400, 404], body=mapping)
+        ESHypermap.known_indices.set(catalog_slug, True)
+
+    @staticmethod
+    def ensure_index(catalog_slug):
+        """
+        Create the index of a catalog, unless it was created (or found) in the last REGISTRY_SEARCH_INFO_TTL seconds.
+        """
+        if not ESHypermap.known_indices.get(catalog_slug):
+            ESHypermap.create_indices(catalog_slug)
+
+    @staticmethod
+    def get_version(default=2):
+        """
+        Return the major version of the Elasticsearch cluster, requested at most every REGISTRY_SEARCH_INFO_TTL seconds.
+        """
+        version = ESHypermap.cluster_info.get('version')
+        if version is None:
+            try:
+                info = ESHypermap.es.info()
+                version = int(info['version']['number'].split('.')[0])
+            except Exception, e:
+                LOGGER.error('Elasticsearch: cannot get the cluster version: %s' % e)
+                return default
+            ESHypermap.cluster_info.set('version', version)
+        return version
+
+    @staticmethod
+    def create_versioned_index(catalog_slug):
+        """
+        Create a new index for a catalog, with bulk indexing settings (no refresh, no replicas).
+        The index is searched once swap_alias points the catalog alias to it.
+        """
+        index_name = '%s_%s' % (catalog_slug, datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+        body = ESHypermap.get_index_mapping()
+        body['settings'] = {'index': {'refresh_interval': '-1', 'number_of_replicas': 0}}
+        ESHypermap.es.indices.create(index_name, body=body)
+        LOGGER.info('Elasticsearch: index %s created for catalog %s' % (index_name, catalog_slug))
+        return index_name
+
+    @staticmethod
+    def swap_alias(catalog_slug, index_name):
+        """
+        Restore the search settings of an index built with create_versioned_index,
+        then atomically point the catalog alias to it and delete the previous catalog indices.
+        A plain index named as the catalog is replaced by the alias in the same atomic action on
+        Elasticsearch 5 and later, and deleted just before the alias is added on older clusters.
+        """
+        indices = ESHypermap.es.indices
+        old_indices = []
+        if indices.exists_alias(name=catalog_slug):
+            old_indices = list(indices.get_alias(name=catalog_slug).keys())
+        # catalogs indexed before aliases were used have a plain index named as the catalog
+        legacy_index = not old_indices and indices.exists(index=catalog_slug)
+
+        # use the settings of the previous index, if any
+        search_settings = {'refresh_interval': '1s', 'number_of_replicas': 1}
+        previous_index = old_indices[0] if old_indices else (catalog_slug if legacy_index else None)
+        if previous_index:
+            previous_settings = indices.get_settings(index=previous_index).get(previous_index, {})
+            previous_settings = previous_settings.get('settings', {}).get('index', {})
+            for name in search_settings:
+                if name in previous_settings:
+                    search_settings[name] = previous_settings[name]
+        indices.put_settings(index=index_name, body={'index': search_settings})
+        indices.refresh(index=index_name)
+
+        actions = [{'remove': {'index': old_index, 'alias': catalog_slug}} for old_index in old_indices]
+        if legacy_index:
+            # an alias can not have the name of an index
+            if ESHypermap.get_version() >= 5:
+                # deleted in the same atomic action as the alias is added
+                actions.append({'remove_index': {'index': catalog_slug}})
+            else:
+                # older clusters can not delete an index in an alias action, the catalog can not
+                # be searched until the alias is added
+                indices.delete(index=catalog_slug)
+        actions.append({'add': {'index': index_name, 'alias': catalog_slug}})
+        indices.update_aliases(body={'actions': actions})
+        ESHypermap.known_indices.set(catalog_slug, True)
+        LOGGER.info('Elasticsearch: alias %s now points to index %s' % (catalog_slug, index_name))
+
+        for old_index in old_indices:
+            indices.delete(index=old_index)
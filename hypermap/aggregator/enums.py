@@ -37,3 +37,13 @@ DATE_TYPES = (
     (DATE_DETECTED, 'Detected'),
     (DATE_FROM_METADATA, 'From Metadata'),
 )
+
+INDEX_ACTIONS = (
+    ('index', 'Index'),
+    ('unindex', 'Remove from index'),
+)
+
+CHECK_ROLLUP_PERIODS = (
+    ('hour', 'Hour'),
+    ('day', 'Day'),
+)
@@ -0,0 +1,285 @@
+"""
+Concurrent harvesting of service capabilities.
+
+Services are grouped by remote host and their capabilities documents are
+fetched in a thread pool, with a cap on the number of in-flight requests per
+host. The parsed documents are then handed to the (sequential) database work
+of Service.update_layers and Service.check_available, and stored in the
+capabilities cache for the layer checks, so each document is downloaded and
+parsed only once per check.
+"""
+
+import datetime
+import hashlib
+import logging
+import requests
+import threading
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from django.conf import settings
+
+from owslib.csw import CatalogueServiceWeb
+from owslib.map.common import WMSCapabilitiesReader
+from owslib.tms import TileMapService
+from owslib.wms import WebMapService
+from owslib.wmts import WebMapTileService, WMTSCapabilitiesReader
+from arcrest import MapService as ArcMapService, ImageService as ArcImageService
+
+from hypermap.aggregator import host_governor
+from hypermap.aggregator.capabilities_cache import capabilities_cache
+from hypermap.aggregator.utils import get_wms_version_negotiate
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_HARVEST_MAX_WORKERS = getattr(settings, 'REGISTRY_HARVEST_MAX_WORKERS', 8)
+REGISTRY_HARVEST_MAX_PER_HOST = getattr(settings, 'REGISTRY_HARVEST_MAX_PER_HOST', 2)
+REGISTRY_HARVEST_BATCH_SIZE = getattr(settings, 'REGISTRY_HARVEST_BATCH_SIZE', 50)
+REGISTRY_HARVEST_TIMEOUT = getattr(settings, 'REGISTRY_HARVEST_TIMEOUT', 30)
+
+# service types harvested with conditional requests
+CONDITIONAL_SERVICE_TYPES = ('OGC:WMS', 'OGC:WMTS')
+
+
+class Capabilities(object):
+    """
+    Result of a capabilities fetch for a service.
+    ows is the parsed document (None for service types harvested by other means),
+    error is set when the fetch failed, changed is False when the document did not
+    change since the last harvest (as told by the etag, last_modified and content_hash validators).
+    """
+
+    def __init__(self, service_id, ows=None, response_time=0, error=None, changed=True,
+                 etag=None, last_modified=None, content_hash=None):
+        self.service_id = service_id
+        self.ows = ows
+        self.response_time = response_time
+        self.error = error
+        self.changed = changed
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+
+    @property
+    def success(self):
+        return self.error is None
+
+    @property
+    def fetched(self):
+        """
+        True if the document was requested by the harvester.
+        """
+        return self.ows is not None or not self.changed
+
+    def __repr__(self):
+        return '<Capabilities service=%s success=%s>' % (self.service_id, self.success)
+
+
+def get_capabilities(service_type, url, version=None):
+    """
+    Fetch and parse the capabilities document of a service.
+    Returns None for service types which are not described by a single document.
+    """
+    if service_type == 'OGC:WMS':
+        if version:
+            return WebMapService(url, version=version)
+        return get_wms_version_negotiate(url)
+    if service_type == 'OGC:WMTS':
+        return WebMapTileService(url, version=version or '1.0.0')
+    if service_type == 'OGC:CSW':
+        return CatalogueServiceWeb(url)
+    if service_type == 'OSGeo:TMS':
+        return TileMapService(url)
+    if service_type == 'ESRI:ArcGIS:MapServer':
+        return ArcMapService(url)
+    if service_type == 'ESRI:ArcGIS:ImageServer':
+        return ArcImageService(url)
+    return None
+
+
+def get_cached_capabilities(service_type, url, version=None, refresh=False):
+    """
+    Return the parsed capabilities document of a service from the capabilities cache,
+    fetching it if it is not cached, it expired or refresh is set.
+    """
+    if not refresh:
+        ows = capabilities_cache.get(url, service_type, version)
+        if ows is not None:
+            return ows
+    ows = get_capabilities(service_type, url, version)
+    if ows is not None:
+        capabilities_cache.set(url, service_type, ows, version)
+    return ows
+
+
+def get_conditional_capabilities(service_type, url, etag=None, last_modified=None, content_hash=None):
+    """
+    Fetch and parse the capabilities document of an OGC:WMS or OGC:WMTS service with a conditional request.
+    Returns a (ows, changed, (etag, last_modified, content_hash)) tuple, ows is None if the server
+    answered the document was not modified.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    if service_type == 'OGC:WMS':
+        # version negotiation, as in get_wms_version_negotiate
+        versions = ['1.3.0', '1.1.1']
+    else:
+        versions = ['1.0.0']
+
+    error = None
+    for version in versions:
+        try:
+            if service_type == 'OGC:WMS':
+                capabilities_url = WMSCapabilitiesReader(version).capabilities_url(url)
+            else:
+                capabilities_url = WMTSCapabilitiesReader(version).capabilities_url(url)
+            response = requests.get(capabilities_url, headers=headers, timeout=REGISTRY_HARVEST_TIMEOUT)
+            if response.status_code == 304:
+                LOGGER.debug('Capabilities of %s were not modified' % url)
+                return None, False, (etag, last_modified, content_hash)
+            response.raise_for_status()
+            if service_type == 'OGC:WMS':
+                ows = WebMapService(url, version=version, xml=response.content)
+            else:
+                ows = WebMapTileService(url, version=version, xml=response.content)
+        except Exception as err:
+            LOGGER.warning('%s %s capabilities not found: %s' % (service_type, version, err))
+            error = err
+            continue
+        new_hash = hashlib.sha1(response.content).hexdigest()
+        validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'), new_hash)
+        return ows, new_hash != content_hash, validators
+    raise error
+
+
+def get_host(url):
+    return urlparse(url).netloc.lower()
+
+
+class HostLimiter(object):
+    """
+    Caps the number of concurrent requests to the same host.
+    """
+
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def semaphore(self, url):
+        host = get_host(url)
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+
+def group_by_host(services):
+    """
+    Group (id, type, url) tuples by remote host, keeping their order.
+    """
+    groups = OrderedDict()
+    for service in services:
+        groups.setdefault(get_host(service[2]), []).append(service)
+    return groups
+
+
+def interleave(services):
+    """
+    Order services round robin across hosts, so consecutive requests hit different hosts.
+    """
+    groups = group_by_host(services).values()
+    interleaved = []
+    position = 0
+    while len(interleaved) < len(services):
+        for group in groups:
+            if position < len(group):
+                interleaved.append(group[position])
+        position += 1
+    return interleaved
+
+
+def batch_by_host(services, batch_size=None):
+    """
+    Split services in batches with hosts spread across them.
+    """
+    batch_size = batch_size or REGISTRY_HARVEST_BATCH_SIZE
+    interleaved = interleave(services)
+    return [interleaved[i:i+batch_size] for i in range(0, len(interleaved), batch_size)]
+
+
+def fetch_capabilities(service, limiter=None):
+    """
+    Fetch the capabilities for a (id, type, url) or a (id, type, url, etag, last_modified, content_hash)
+    tuple, returning a Capabilities instance.
+    """
+    service_id, service_type, url = service[:3]
+    validators = tuple(service[3:]) or (None, None, None)
+    changed = True
+    host = get_host(url)
+    if host_governor.is_open(host):
+        LOGGER.debug('Not fetching capabilities for service id %s, the circuit of %s is open' % (service_id, host))
+        return Capabilities(service_id, error=host_governor.CircuitOpenError(host))
+    # wait for a token of the host, shared with the other workers, before taking a slot of the host
+    if not host_governor.acquire(host):
+        LOGGER.debug('Not fetching capabilities for service id %s, %s is busy' % (service_id, host))
+        return Capabilities(service_id, error=host_governor.HostBusyError(host))
+    semaphore = limiter.semaphore(url) if limiter else None
+    if semaphore:
+        semaphore.acquire()
+    start_time = datetime.datetime.utcnow()
+    try:
+        LOGGER.debug('Fetching capabilities for service id %s' % service_id)
+        if service_type in CONDITIONAL_SERVICE_TYPES:
+            ows, changed, validators = get_conditional_capabilities(service_type, url, *validators)
+            if ows is None:
+                # not modified, the parsed document may still be cached
+                ows = capabilities_cache.get(url, service_type)
+            else:
+                capabilities_cache.set(url, service_type, ows)
+        else:
+            ows = get_cached_capabilities(service_type, url, refresh=True)
+        error = None
+    except Exception, e:
+        LOGGER.error('Error fetching capabilities for service id %s: %s' % (service_id, e))
+        ows = None
+        error = e
+    finally:
+        if semaphore:
+            semaphore.release()
+    host_governor.record(host, error)
+    delta = datetime.datetime.utcnow() - start_time
+    response_time = delta.total_seconds()
+    etag, last_modified, content_hash = validators
+    return Capabilities(service_id, ows=ows, response_time=response_time, error=error, changed=changed,
+                        etag=etag, last_modified=last_modified, content_hash=content_hash)
+
+
+def fetch_all_capabilities(services, max_workers=None, max_per_host=None):
+    """
+    Fetch concurrently the capabilities for a list of service tuples, as accepted by fetch_capabilities.
+    Returns a dictionary of Capabilities by service id.
+    """
+    max_workers = max_workers or REGISTRY_HARVEST_MAX_WORKERS
+    limiter = HostLimiter(max_per_host or REGISTRY_HARVEST_MAX_PER_HOST)
+    services = interleave(list(services))
+    if not services:
+        return {}
+
+    pool = ThreadPool(min(max_workers, len(services)))
+    try:
+        results = pool.imap_unordered(lambda service: fetch_capabilities(service, limiter), services)
+        capabilities = dict((result.service_id, result) for result in results)
+    finally:
+        pool.close()
+        pool.join()
+
+    LOGGER.debug('Fetched capabilities for %s services on %s hosts' % (
+        len(capabilities), len(group_by_host(services))))
+    return capabilities
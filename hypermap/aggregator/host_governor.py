@@ -0,0 +1,214 @@
+"""
+Rate limiting and circuit breaking of the requests to the remote hosts.
+
+The state is stored in the Django cache, so it is shared by all the workers
+using the same cache (use a shared cache, like Memcached, with several
+processes).
+
+Each host has a token bucket, refilled with REGISTRY_HOST_RATE tokens per
+second up to REGISTRY_HOST_BURST tokens. The bucket is stored as the number
+of tokens consumed since the epoch, in thousandths of a token, updated with
+atomic cache increments: a request reserves a token, and waits until the
+bucket had the time to refill it.
+
+Each host also has a circuit breaker: after REGISTRY_HOST_FAILURE_THRESHOLD
+consecutive failed requests, the circuit of the host is open and no request
+is sent to it for REGISTRY_HOST_CIRCUIT_TIMEOUT seconds. Then one more failed
+request opens it again, a successful one closes it. Only the requests which
+did not get an answer, or got a server error or throttling answer, are failed
+requests: a host answering a 404 or an invalid document is alive.
+"""
+
+import logging
+import random
+import socket
+import time
+import urllib2
+
+from urlparse import urlparse
+
+import requests
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+from django.core.cache import cache
+
+LOGGER = logging.getLogger(__name__)
+
+# tokens added per second to the bucket of a host, 0 disables the rate limiting
+REGISTRY_HOST_RATE = getattr(settings, 'REGISTRY_HOST_RATE', 2)
+# size of the bucket of a host, the number of requests sent at once to an idle host
+REGISTRY_HOST_BURST = getattr(settings, 'REGISTRY_HOST_BURST', 5)
+# highest number of seconds a request waits for a token, before being retried later
+REGISTRY_HOST_MAX_WAIT = getattr(settings, 'REGISTRY_HOST_MAX_WAIT', 2)
+# times a layer check is retried while its host is busy, before being recorded as failed
+REGISTRY_HOST_MAX_RETRIES = getattr(settings, 'REGISTRY_HOST_MAX_RETRIES', 10)
+# consecutive failed requests opening the circuit of a host, 0 disables the circuit breaker
+REGISTRY_HOST_FAILURE_THRESHOLD = getattr(settings, 'REGISTRY_HOST_FAILURE_THRESHOLD', 5)
+# seconds during which no request is sent to a host whose circuit is open
+REGISTRY_HOST_CIRCUIT_TIMEOUT = getattr(settings, 'REGISTRY_HOST_CIRCUIT_TIMEOUT', 600)
+
+BUCKET_KEY = 'host_governor:bucket:%s'
+FAILURES_KEY = 'host_governor:failures:%s'
+CIRCUIT_KEY = 'host_governor:circuit:%s'
+
+# tokens are counted in thousandths
+TOKEN = 1000
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request to a host whose circuit is open.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        super(CircuitOpenError, self).__init__(
+            'Requests to %s are suspended after %s consecutive failures' % (host, REGISTRY_HOST_FAILURE_THRESHOLD))
+
+
+class HostBusyError(Exception):
+    """
+    Raised instead of waiting more than REGISTRY_HOST_MAX_WAIT seconds for a token of a host.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        super(HostBusyError, self).__init__(
+            'Requests to %s are rate limited, no token available within %s seconds' % (host, REGISTRY_HOST_MAX_WAIT))
+
+
+def reserve(host, now=None):
+    """
+    Take a token from the bucket of a host, and return the number of seconds to wait before sending the request.
+    """
+    if not REGISTRY_HOST_RATE:
+        return 0
+    now = now or time.time()
+    key = BUCKET_KEY % host
+    refilled = int(now * REGISTRY_HOST_RATE * TOKEN)
+    burst = REGISTRY_HOST_BURST * TOKEN
+    # a full bucket
+    cache.add(key, refilled - burst, None)
+    try:
+        consumed = cache.incr(key, TOKEN)
+    except ValueError:
+        # the key was evicted in the meantime
+        cache.add(key, refilled - burst + TOKEN, None)
+        return 0
+    if consumed < refilled - burst + TOKEN:
+        # the host was idle, the bucket can not hold more than burst tokens
+        consumed = cache.incr(key, refilled - burst + TOKEN - consumed)
+    return max(consumed - refilled, 0) / float(REGISTRY_HOST_RATE * TOKEN)
+
+
+def release(host):
+    """
+    Give back a token reserved but not used.
+    """
+    if REGISTRY_HOST_RATE:
+        try:
+            cache.decr(BUCKET_KEY % host, TOKEN)
+        except ValueError:
+            pass
+
+
+def acquire(host):
+    """
+    Wait for a token of a host, and return True. Return False, without waiting, if the wait would be longer than
+    REGISTRY_HOST_MAX_WAIT seconds.
+    """
+    delay = reserve(host)
+    if delay > REGISTRY_HOST_MAX_WAIT:
+        release(host)
+        return False
+    if delay > 0:
+        LOGGER.debug('Waiting %.2f seconds before sending a request to %s' % (delay, host))
+        time.sleep(delay)
+    return True
+
+
+def get_delay(host):
+    """
+    Return the number of seconds before a token of a host is available.
+    """
+    if not REGISTRY_HOST_RATE:
+        return 0
+    consumed = cache.get(BUCKET_KEY % host)
+    if consumed is None:
+        return 0
+    refilled = int(time.time() * REGISTRY_HOST_RATE * TOKEN)
+    return max(consumed + TOKEN - refilled, 0) / float(REGISTRY_HOST_RATE * TOKEN)
+
+
+def get_backoff(host, retries):
+    """
+    Return the number of seconds before retrying a request to a busy host, doubled at each retry and randomized,
+    so the retries of the many requests waiting for a host spread over time instead of hitting it again together.
+    """
+    delay = max(get_delay(host), 1.0 / REGISTRY_HOST_RATE if REGISTRY_HOST_RATE else 1)
+    return delay * 2 ** retries * random.uniform(1, 2)
+
+
+def is_host_failure(error):
+    """
+    Return True if an error raised by a request tells that the remote host is down or overloaded.
+    """
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and (error.response.status_code >= 500 or
+                                               error.response.status_code == 429)
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, urllib2.URLError, socket.error,
+                              SoftTimeLimitExceeded))
+
+
+def is_open(host):
+    """
+    Return True if the circuit of a host is open.
+    """
+    return REGISTRY_HOST_FAILURE_THRESHOLD > 0 and cache.get(CIRCUIT_KEY % host) is not None
+
+
+def get_request_host(error):
+    """
+    Return the host of the request which raised an error, None if it is not known.
+    """
+    request = getattr(error, 'request', None)
+    response = getattr(error, 'response', None)
+    url = getattr(request, 'url', None) or getattr(response, 'url', None)
+    if url is None and isinstance(error, urllib2.HTTPError):
+        url = error.geturl()
+    if url:
+        return urlparse(url).netloc.lower()
+    return None
+
+
+def record(host, error=None):
+    """
+    Record the result of a request to a host, error is the exception it raised if any.
+    Errors telling that a host is down or overloaded are failures of the host of the failed request (a layer
+    GetMap may be sent to another host than the one of the layer url), other ones tell that host is alive.
+    """
+    if not REGISTRY_HOST_FAILURE_THRESHOLD:
+        return
+    if error is not None and is_host_failure(error):
+        record_failure(get_request_host(error) or host)
+    else:
+        cache.delete_many([FAILURES_KEY % host, CIRCUIT_KEY % host])
+
+
+def record_failure(host):
+    """
+    Count a failed request to a host, opening its circuit after too many consecutive failures.
+    """
+    failures_key = FAILURES_KEY % host
+    cache.add(failures_key, 0, None)
+    try:
+        failures = cache.incr(failures_key)
+    except ValueError:
+        failures = 1
+        cache.add(failures_key, failures, None)
+    if failures >= REGISTRY_HOST_FAILURE_THRESHOLD:
+        if failures == REGISTRY_HOST_FAILURE_THRESHOLD:
+            LOGGER.warning('Suspending the requests to %s after %s consecutive failures' % (host, failures))
+        cache.set(CIRCUIT_KEY % host, failures, REGISTRY_HOST_CIRCUIT_TIMEOUT)
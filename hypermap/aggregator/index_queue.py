@@ -0,0 +1,119 @@
+"""
+Durable queue of layers to be indexed in, or removed from, the search backend.
+
+Items are stored in the IndexQueueItem table, one row per layer: enqueueing a
+layer which is already queued just updates its action. Workers claim batches
+of items with dequeue_batch, then ack them when the search backend was
+updated, or nack them to record the error and retry them later.
+"""
+
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+LOGGER = logging.getLogger(__name__)
+
+# seconds before a claimed item, not acked or nacked, can be claimed again
+REGISTRY_INDEX_QUEUE_LEASE = getattr(settings, 'REGISTRY_INDEX_QUEUE_LEASE', 300)
+# items failing more than this number of times are not dequeued anymore
+REGISTRY_INDEX_QUEUE_MAX_RETRIES = getattr(settings, 'REGISTRY_INDEX_QUEUE_MAX_RETRIES', 5)
+
+ENQUEUE_BATCH_SIZE = 500
+
+
+def enqueue(layer_ids, action='index'):
+    """
+    Add layers to the queue, or update their action if they are already queued.
+    """
+    from hypermap.aggregator.models import IndexQueueItem
+
+    layer_ids = list(set(layer_ids))
+    for i in range(0, len(layer_ids), ENQUEUE_BATCH_SIZE):
+        batch_ids = layer_ids[i:i+ENQUEUE_BATCH_SIZE]
+        now = timezone.now()
+        values = dict(action=action, enqueued=now, claimed=None, retries=0, last_error=None)
+        queued_ids = set(IndexQueueItem.objects.filter(layer_id__in=batch_ids).values_list('layer_id', flat=True))
+        IndexQueueItem.objects.filter(layer_id__in=queued_ids).update(**values)
+        new_items = [IndexQueueItem(layer_id=layer_id, **values) for layer_id in batch_ids
+                     if layer_id not in queued_ids]
+        try:
+            with transaction.atomic():
+                IndexQueueItem.objects.bulk_create(new_items)
+        except IntegrityError:
+            # some layers were enqueued in the meantime by another worker
+            for item in new_items:
+                try:
+                    with transaction.atomic():
+                        item.save()
+                except IntegrityError:
+                    IndexQueueItem.objects.filter(layer_id=item.layer_id).update(**values)
+
+
+def dequeue_batch(size, action='index'):
+    """
+    Claim up to size queued items for an action, oldest first.
+    Claimed items are not returned by other calls until acked, nacked or their lease expires.
+    """
+    from hypermap.aggregator.models import IndexQueueItem
+
+    now = timezone.now()
+    lease_expired = now - datetime.timedelta(seconds=REGISTRY_INDEX_QUEUE_LEASE)
+    with transaction.atomic():
+        items = list(
+            IndexQueueItem.objects.select_for_update().filter(
+                Q(claimed__isnull=True) | Q(claimed__lt=lease_expired),
+                action=action,
+                retries__lt=REGISTRY_INDEX_QUEUE_MAX_RETRIES,
+            ).order_by('enqueued')[:size]
+        )
+        IndexQueueItem.objects.filter(id__in=[item.id for item in items]).update(claimed=now)
+    for item in items:
+        item.claimed = now
+    return items
+
+
+def ack(items):
+    """
+    Remove processed items from the queue.
+    Items enqueued again after being claimed are kept, so they will be processed again.
+    """
+    from hypermap.aggregator.models import IndexQueueItem
+
+    claims = {}
+    for item in items:
+        claims.setdefault(item.claimed, []).append(item.id)
+    for claimed, ids in claims.items():
+        IndexQueueItem.objects.filter(id__in=ids, enqueued__lte=claimed).delete()
+
+
+def nack(items, error):
+    """
+    Release failed items, recording the error. They will be retried once their lease expires.
+    """
+    from hypermap.aggregator.models import IndexQueueItem
+
+    IndexQueueItem.objects.filter(id__in=[item.id for item in items]).update(
+        retries=F('retries') + 1, last_error=str(error)
+    )
+
+
+def size(action=None):
+    """
+    Number of items in the queue, optionally for a given action.
+    """
+    from hypermap.aggregator.models import IndexQueueItem
+
+    items = IndexQueueItem.objects.all()
+    if action:
+        items = items.filter(action=action)
+    return items.count()
+
+
+def clear():
+    from hypermap.aggregator.models import IndexQueueItem
+
+    IndexQueueItem.objects.all().delete()
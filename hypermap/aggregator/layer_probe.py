@@ -0,0 +1,166 @@
+"""
+Lightweight availability probes of the layers.
+
+A layer check sends one minimal request to the layer: a 1x1 pixel GetMap for
+the WMS based layers, the first tile for the WMTS layers, a 1x1 pixel export
+for the ArcGIS layers, and a HEAD request to the layer url for the other
+layers or when the extent of the layer is invalid. The check records the time
+and the number of bytes of the answer, the thumbnail of the layer is not
+regenerated at each check anymore.
+
+The thumbnail is regenerated by a check only when the layer has none, when it
+is older than REGISTRY_THUMBNAIL_TTL days, or when the metadata or the extent
+of the layer changed since it was generated. Set REGISTRY_LAYER_CHECK_MODE to
+'thumbnail' to check the layers by regenerating their thumbnail every time, as
+before.
+"""
+
+import datetime
+import hashlib
+import logging
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+
+LOGGER = logging.getLogger(__name__)
+
+# 'probe' to check the layers with a minimal request, 'thumbnail' to regenerate their thumbnail at each check
+REGISTRY_LAYER_CHECK_MODE = getattr(settings, 'REGISTRY_LAYER_CHECK_MODE', 'probe')
+# seconds before a probe request times out
+REGISTRY_PROBE_TIMEOUT = getattr(settings, 'REGISTRY_PROBE_TIMEOUT', 10)
+# days after which the thumbnail of a layer is regenerated by its next check, 0 to never regenerate it
+REGISTRY_THUMBNAIL_TTL = getattr(settings, 'REGISTRY_THUMBNAIL_TTL', 30)
+
+WMS_TYPES = ('OGC:WMS', 'Hypermap:WorldMap', 'Hypermap:WARPER')
+
+# fields of a layer whose change requires a new thumbnail
+THUMBNAIL_FIELDS = ('type', 'url', 'name', 'title', 'abstract', 'bbox_x0', 'bbox_y0', 'bbox_x1', 'bbox_y1')
+
+
+class ProbeResult(object):
+    """
+    The answer to the probe of a layer.
+    """
+
+    def __init__(self, response_time, response_size):
+        self.response_time = response_time
+        self.response_size = response_size
+
+
+def get_bbox(layer):
+    return ','.join(str(float(coordinate)) for coordinate in (
+        layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1))
+
+
+def get_esri_url(url, operation):
+    return '%s/%s' % (url.split('?')[0].rstrip('/'), operation)
+
+
+def get_probe_request(layer):
+    """
+    Return the method, url and parameters of the minimal request probing a layer.
+    """
+    if layer.type in WMS_TYPES and layer.has_valid_bbox():
+        url = layer.service.url if layer.type == 'OGC:WMS' else layer.url
+        return 'GET', url, {
+            'SERVICE': 'WMS',
+            'VERSION': '1.1.1',
+            'REQUEST': 'GetMap',
+            'LAYERS': layer.name,
+            'STYLES': '',
+            'SRS': 'EPSG:4326',
+            'BBOX': get_bbox(layer),
+            'WIDTH': 1,
+            'HEIGHT': 1,
+            'FORMAT': 'image/png',
+            'TRANSPARENT': 'TRUE',
+        }
+    if layer.type == 'OGC:WMTS':
+        from hypermap.aggregator.harvest import get_cached_capabilities
+
+        # the tile matrix sets are only known from the capabilities document, usually cached by the harvest
+        ows = get_cached_capabilities('OGC:WMTS', layer.service.url)
+        ows_layer = ows.contents[layer.name]
+        image_format = 'image/png'
+        if image_format not in ows_layer.formats and 'image/jpeg' in ows_layer.formats:
+            image_format = 'image/jpeg'
+        tile = dict(layer=layer.name, tilematrixset=ows_layer.tilematrixsets[0], tilematrix='0', row='0',
+                    column='0', format=image_format)
+        if getattr(ows, 'restonly', False):
+            return 'GET', ows.buildTileResource(**tile), None
+        url = ows.url
+        for method in ows.getOperationByName('GetTile').methods:
+            if method.get('type', '').lower() == 'get':
+                url = method['url']
+                break
+        return 'GET', url, ows.buildTileRequest(**tile)
+    if layer.type == 'ESRI:ArcGIS:MapServer' and layer.has_valid_bbox():
+        return 'GET', get_esri_url(layer.service.url, 'export'), {
+            'bbox': get_bbox(layer),
+            'bboxSR': '4326',
+            'size': '1,1',
+            'layers': 'show:%s' % layer.name,
+            'transparent': 'true',
+            'format': 'png',
+            'f': 'image',
+        }
+    if layer.type == 'ESRI:ArcGIS:ImageServer' and layer.has_valid_bbox():
+        return 'GET', get_esri_url(layer.service.url, 'exportImage'), {
+            'bbox': get_bbox(layer),
+            'size': '1,1',
+            'format': 'png',
+            'f': 'image',
+        }
+    return 'HEAD', layer.url, None
+
+
+def probe(layer):
+    """
+    Send the minimal request probing a layer and return a ProbeResult.
+    Raise an exception if the layer is not available.
+    """
+    method, url, params = get_probe_request(layer)
+    auth = None
+    if layer.type == 'Hypermap:WorldMap' and getattr(settings, 'REGISTRY_WORLDMAP_USERNAME', None):
+        auth = (settings.REGISTRY_WORLDMAP_USERNAME, settings.REGISTRY_WORLDMAP_PASSWORD)
+    LOGGER.debug('Probing layer id %s with %s %s' % (layer.id, method, url))
+
+    start_time = datetime.datetime.utcnow()
+    response = requests.request(method, url, params=params, auth=auth, timeout=REGISTRY_PROBE_TIMEOUT)
+    content = response.content
+    delta = datetime.datetime.utcnow() - start_time
+
+    if method == 'HEAD':
+        # a server not answering HEAD requests is still up
+        if response.status_code != 405:
+            response.raise_for_status()
+    else:
+        response.raise_for_status()
+        content_type = response.headers.get('Content-Type', '')
+        if not content_type.startswith('image/'):
+            # most likely a service exception
+            raise ValueError(content[:1000] or 'The layer did not answer an image (%s)' % content_type)
+    return ProbeResult(delta.total_seconds(), len(content))
+
+
+def get_thumbnail_signature(layer):
+    """
+    Return a hash of the fields of a layer which are rendered in its thumbnail.
+    """
+    values = [unicode(getattr(layer, field)) for field in THUMBNAIL_FIELDS]
+    return hashlib.md5(u'\n'.join(values).encode('utf-8')).hexdigest()
+
+
+def needs_thumbnail(layer, now=None):
+    """
+    Return True if the thumbnail of a layer is missing, expired, or does not match its metadata and extent.
+    """
+    if not layer.thumbnail or layer.thumbnail_updated is None:
+        return True
+    if layer.thumbnail_signature != get_thumbnail_signature(layer):
+        return True
+    if not REGISTRY_THUMBNAIL_TTL:
+        return False
+    now = now or timezone.now()
+    return layer.thumbnail_updated < now - datetime.timedelta(days=REGISTRY_THUMBNAIL_TTL)
@@ -0,0 +1,215 @@
+"""
+Bulk synchronisation of the layers of a service with its parsed capabilities.
+
+The existing layers of the service are read in one query and diffed against
+the parsed layers, then the new and changed layers, their keywords and their
+mined dates are written with a few bulk statements per service, instead of
+several queries per layer.
+"""
+
+import logging
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Case, When, Value
+from django.utils import timezone
+
+from taggit.models import Tag, TaggedItem
+
+from hypermap.dynasty.utils import get_mined_dates
+
+LOGGER = logging.getLogger(__name__)
+
+# fields compared and written for an existing layer.
+# xml is not compared, as it contains the modification date of the record.
+SYNC_FIELDS = ('type', 'title', 'abstract', 'url', 'page_url', 'bbox_x0', 'bbox_y0', 'bbox_x1', 'bbox_y1',
+               'wkt_geometry', 'anytext', 'is_valid')
+BBOX_FIELDS = ('bbox_x0', 'bbox_y0', 'bbox_x1', 'bbox_y1')
+
+BATCH_SIZE = 100
+
+
+class LayerRecord(object):
+    """
+    A layer as parsed from a capabilities document.
+    """
+
+    def __init__(self, name, title=None, abstract=None, keywords=None, bbox=None, anytext=None):
+        self.name = name
+        self.title = title
+        self.abstract = abstract
+        self.keywords = [keyword for keyword in (keywords or []) if keyword]
+        self.bbox = list(bbox or (-179.0, -89.0, 179.0, 89.0))
+        self.anytext = anytext
+
+
+def field_changed(field_name, current, value):
+    if field_name in BBOX_FIELDS and current is not None and value is not None:
+        return abs(float(current) - float(value)) > 1e-9
+    return current != value
+
+
+def bulk_update(model, objects, fields, batch_size=BATCH_SIZE):
+    """
+    Update the given fields of a list of objects with one UPDATE ... CASE statement per batch.
+    """
+    for i in range(0, len(objects), batch_size):
+        batch = objects[i:i+batch_size]
+        values = {}
+        for field_name in fields:
+            field = model._meta.get_field(field_name)
+            whens = [When(pk=obj.pk, then=Value(getattr(obj, field_name), output_field=field)) for obj in batch]
+            values[field_name] = Case(*whens, output_field=field)
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(**values)
+
+
+def get_mined_layer_dates(layer):
+    """
+    Return the dates mined from the title and the abstract of a layer.
+    """
+    text_to_mine = ''
+    if layer.title:
+        text_to_mine = text_to_mine + layer.title
+    if layer.abstract:
+        text_to_mine = text_to_mine + ' ' + layer.abstract
+    return get_mined_dates(text_to_mine)
+
+
+def sync_layers(service, records, layer_type, metadata_format):
+    """
+    Create or update the layers of a service from a list of LayerRecord.
+    Layer signals are not sent, validity is computed here.
+    A layer listed several times (as in nested WMS layers) is synced once, from its last record.
+    Returns a dictionary with the number of added, updated and skipped (unchanged or inactive) layers.
+    """
+    from hypermap.aggregator.models import Layer, LayerDate, bbox2wktpolygon, create_metadata_record
+    from hypermap.aggregator.models import is_layer_valid
+
+    report = {'added': 0, 'updated': 0, 'skipped': 0}
+    site_url = settings.SITE_URL.rstrip('/')
+    layer_content_type = ContentType.objects.get_for_model(Layer)
+
+    # 1. read the existing layers and their keywords
+    existing = dict(
+        (layer.name, layer) for layer in
+        Layer.objects.filter(service=service, catalog=service.catalog).select_related('catalog').defer('xml')
+    )
+    existing_keywords = {}
+    tagged_items = TaggedItem.objects.filter(
+        content_type=layer_content_type, object_id__in=[layer.id for layer in existing.values()]
+    ).values_list('object_id', 'tag__name')
+    for object_id, name in tagged_items:
+        existing_keywords.setdefault(object_id, set()).add(name)
+
+    # 2. diff them with the parsed layers, keyed by name
+    records = OrderedDict((record.name, record) for record in records)
+    to_create = []
+    to_update = []
+    new_keywords = {}
+    for record in records.values():
+        layer = existing.get(record.name)
+        created = layer is None
+        if created:
+            layer = Layer(name=record.name, service=service, catalog=service.catalog)
+        elif not layer.active:
+            report['skipped'] += 1
+            continue
+        layer.service = service
+
+        bbox = record.bbox
+        values = {
+            'type': layer_type,
+            'title': record.title,
+            'abstract': record.abstract,
+            'url': service.url,
+            'page_url': layer.get_absolute_url,
+            'bbox_x0': bbox[0],
+            'bbox_y0': bbox[1],
+            'bbox_x1': bbox[2],
+            'bbox_y1': bbox[3],
+            'wkt_geometry': bbox2wktpolygon(bbox),
+            'anytext': record.anytext,
+        }
+        changed = [name for name, value in values.items() if field_changed(name, getattr(layer, name), value)]
+        was_valid = layer.is_valid
+        for name, value in values.items():
+            setattr(layer, name, value)
+        layer.is_valid = is_layer_valid(layer)
+        if layer.is_valid != was_valid:
+            changed.append('is_valid')
+        missing_keywords = set(record.keywords) - existing_keywords.get(layer.id, set())
+
+        if not created and not changed and not missing_keywords:
+            report['skipped'] += 1
+            continue
+
+        LOGGER.debug('Updating layer %s' % record.name)
+        new_keywords[record.name] = missing_keywords
+        layer.xml = create_metadata_record(
+            identifier=str(layer.uuid),
+            source=service.url,
+            links=[[metadata_format, service.url], ['WWW:LINK', site_url + layer.page_url]],
+            format=metadata_format,
+            type=layer.csw_type,
+            relation=service.id_string,
+            title=record.title,
+            alternative=record.name,
+            abstract=record.abstract,
+            keywords=record.keywords,
+            wkt_geometry=layer.wkt_geometry
+        )
+        if created:
+            to_create.append(layer)
+        else:
+            to_update.append(layer)
+
+    with transaction.atomic():
+        # 3. write the layers
+        if to_create:
+            Layer.objects.bulk_create(to_create, batch_size=BATCH_SIZE)
+            # bulk_create does not set the primary keys
+            ids = dict(Layer.objects.filter(service=service).values_list('uuid', 'id'))
+            for layer in to_create:
+                layer.id = ids[layer.uuid]
+        if to_update:
+            now = timezone.now()
+            for layer in to_update:
+                layer.last_updated = now
+            bulk_update(Layer, to_update, SYNC_FIELDS + ('xml', 'last_updated'))
+
+        synced = to_create + to_update
+
+        # 4. keywords
+        names = set()
+        for keywords in new_keywords.values():
+            names.update(keywords)
+        if names:
+            tags = dict((tag.name, tag) for tag in Tag.objects.filter(name__in=names))
+            for name in names:
+                if name not in tags:
+                    tags[name] = Tag.objects.create(name=name)
+            TaggedItem.objects.bulk_create([
+                TaggedItem(content_type=layer_content_type, object_id=layer.id, tag=tags[name])
+                for layer in synced for name in new_keywords[layer.name]
+            ], batch_size=BATCH_SIZE)
+
+        # 5. mined dates
+        if synced:
+            existing_dates = set(LayerDate.objects.filter(
+                layer__service=service, type=0).values_list('layer_id', 'date'))
+            layer_dates = []
+            for layer in synced:
+                for date in get_mined_layer_dates(layer):
+                    if (layer.id, date) not in existing_dates:
+                        existing_dates.add((layer.id, date))
+                        layer_dates.append(LayerDate(layer=layer, date=date, type=0))
+            LayerDate.objects.bulk_create(layer_dates, batch_size=BATCH_SIZE)
+
+    report['added'] = len(to_create)
+    report['updated'] = len(to_update)
+    LOGGER.debug('Layers of service %s synced: %s added, %s updated, %s skipped' % (
+        service.id, report['added'], report['updated'], report['skipped']))
+    return report
@@ -0,0 +1,56 @@
+"""
+A small thread safe, in process, LRU cache with expiration.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Keeps at most maxsize items, discarding the least recently used ones first.
+    Items older than timeout seconds are expired (a timeout of None never expires them).
+    """
+
+    def __init__(self, maxsize=128, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            # re-insert as the most recently used item
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = timeout if timeout is not None else self.timeout
+        expires = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
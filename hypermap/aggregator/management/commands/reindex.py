@@ -0,0 +1,76 @@
+import logging
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hypermap.aggregator.reindex import reindex_layers, SEARCH_TYPE
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Index all the valid layers in the search backend.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '-p',
+            '--processes',
+            dest="processes",
+            default=None,
+            help="Number of processes serializing layers, defaults to the number of CPUs"),
+        make_option(
+            '-c',
+            '--concurrency',
+            dest="concurrency",
+            default=4,
+            help="Number of concurrent bulk requests to the search backend"),
+        make_option(
+            '-b',
+            '--batch-size',
+            dest="batch_size",
+            default=settings.REGISTRY_SEARCH_BATCH_SIZE,
+            help="Number of layers per bulk request"),
+        make_option(
+            '--checkpoint',
+            dest="checkpoint",
+            default=None,
+            help="File storing the last indexed layer id"),
+        make_option(
+            '--resume',
+            action="store_true",
+            dest="resume",
+            default=False,
+            help="Skip the layers up to the id stored in the checkpoint file"),
+        make_option(
+            '--blue-green',
+            action="store_true",
+            dest="blue_green",
+            default=False,
+            help="Elasticsearch only: index in new indices and swap the catalog aliases when done"),
+    )
+
+    def handle(self, *args, **options):
+        processes = options.get('processes')
+        if options.get('blue_green'):
+            if SEARCH_TYPE != 'elasticsearch':
+                raise CommandError('--blue-green is only supported with Elasticsearch')
+            if options.get('resume'):
+                raise CommandError('--blue-green reindex can not be resumed')
+
+        def report(written, errors, elapsed, last_id):
+            self.stdout.write('%s layers indexed in %.1fs (%.1f layers/s), %s errors, last id %s' % (
+                written, elapsed, written / elapsed if elapsed else 0, len(errors), last_id))
+
+        written, errors = reindex_layers(
+            processes=int(processes) if processes else None,
+            concurrency=int(options.get('concurrency')),
+            batch_size=int(options.get('batch_size')),
+            checkpoint=options.get('checkpoint'),
+            resume=options.get('resume'),
+            report=report,
+            blue_green=options.get('blue_green')
+        )
+        for layer_id, message in errors:
+            LOGGER.error('Layer id %s was not indexed: %s' % (layer_id, message))
+        self.stdout.write('Reindex done: %s layers indexed, %s errors' % (written, len(errors)))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0013_service_capabilities_validators'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexQueueItem',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('layer_id', models.PositiveIntegerField(unique=True)),
+                ('action', models.CharField(default=b'index', max_length=16, choices=[(b'index', b'Index'), (b'unindex', b'Remove from index')])),
+                ('enqueued', models.DateTimeField(db_index=True)),
+                ('claimed', models.DateTimeField(null=True, blank=True)),
+                ('retries', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(null=True, blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0014_indexqueueitem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexTimeBounds',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('index_name', models.CharField(unique=True, max_length=255)),
+                ('min_date', models.CharField(max_length=64, null=True, blank=True)),
+                ('min_key', models.BigIntegerField(null=True, blank=True)),
+                ('max_date', models.CharField(max_length=64, null=True, blank=True)),
+                ('max_key', models.BigIntegerField(null=True, blank=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
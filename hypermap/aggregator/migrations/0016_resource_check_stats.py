@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Sum, Min, Max, Case, When, IntegerField
+
+# the check statistics layout when this migration was written, see check_stats
+RECENT_CHECKS_NUMBER = 2
+RESPONSE_TIME_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+EMPTY_STATS = {
+    'checks_count': 0,
+    'success_checks_count': 0,
+    'first_checked': None,
+    'last_checked': None,
+    'last_status': None,
+    'recent_checks_status': '',
+    'response_time_sum': 0,
+    'min_response_time': None,
+    'max_response_time': None,
+    'decayed_reliability': None,
+    'response_time_histogram': '',
+}
+
+
+def rebuild(model, check_model, content_type_id):
+    """
+    Compute the statistics of all the resources of a model from their checks, as check_stats.rebuild did.
+    """
+    checks = check_model.objects.filter(content_type_id=content_type_id).order_by()
+    buckets = {}
+    lower_bound = None
+    for i, upper_bound in enumerate(RESPONSE_TIME_BUCKETS + (None, )):
+        when = {}
+        if lower_bound is not None:
+            when['response_time__gt'] = lower_bound
+        if upper_bound is not None:
+            when['response_time__lte'] = upper_bound
+        buckets['bucket_%s' % i] = Sum(Case(When(then=1, **when), default=0, output_field=IntegerField()))
+        lower_bound = upper_bound
+
+    rows = checks.values('object_id').annotate(
+        count=Count('id'),
+        success_count=Sum(Case(When(success=True, then=1), default=0, output_field=IntegerField())),
+        first_checked=Min('checked_datetime'),
+        last_checked=Max('checked_datetime'),
+        response_time_sum=Sum('response_time'),
+        min_response_time=Min('response_time'),
+        max_response_time=Max('response_time'),
+        **buckets
+    )
+    model.objects.exclude(pk__in=checks.values('object_id')).update(**EMPTY_STATS)
+    for row in rows:
+        recent = list(checks.filter(object_id=row['object_id']).order_by('-checked_datetime', '-id').values_list(
+            'success', flat=True)[0:RECENT_CHECKS_NUMBER])
+        model.objects.filter(pk=row['object_id']).update(
+            checks_count=row['count'],
+            success_checks_count=row['success_count'],
+            first_checked=row['first_checked'],
+            last_checked=row['last_checked'],
+            last_status=recent[0],
+            recent_checks_status=''.join('1' if success else '0' for success in recent),
+            response_time_sum=row['response_time_sum'],
+            min_response_time=row['min_response_time'],
+            max_response_time=row['max_response_time'],
+            decayed_reliability=row['success_count'] * 100.0 / row['count'],
+            response_time_histogram=','.join(
+                str(row['bucket_%s' % i]) for i in range(len(RESPONSE_TIME_BUCKETS) + 1)),
+        )
+
+
+def rebuild_check_stats(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Check = apps.get_model('aggregator', 'Check')
+    for model_name in ('service', 'layer'):
+        content_type = ContentType.objects.filter(app_label='aggregator', model=model_name).first()
+        if content_type is not None:
+            rebuild(apps.get_model('aggregator', model_name), Check, content_type.id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('aggregator', '0015_indextimebounds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layer',
+            name='checks_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='decayed_reliability',
+            field=models.FloatField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='first_checked',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='last_checked',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='last_status',
+            field=models.NullBooleanField(editable=False),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='max_response_time',
+            field=models.FloatField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='min_response_time',
+            field=models.FloatField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='recent_checks_status',
+            field=models.CharField(default=b'', max_length=32, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='response_time_histogram',
+            field=models.CharField(default=b'', max_length=255, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='response_time_sum',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='success_checks_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='checks_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='decayed_reliability',
+            field=models.FloatField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='first_checked',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='last_checked',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='last_status',
+            field=models.NullBooleanField(editable=False),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='max_response_time',
+            field=models.FloatField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='min_response_time',
+            field=models.FloatField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='recent_checks_status',
+            field=models.CharField(default=b'', max_length=32, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='response_time_histogram',
+            field=models.CharField(default=b'', max_length=255, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='response_time_sum',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='success_checks_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(rebuild_check_stats, migrations.RunPython.noop),
+    ]
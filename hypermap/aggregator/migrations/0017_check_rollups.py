@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('aggregator', '0016_resource_check_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('period', models.CharField(max_length=8, choices=[(b'hour', b'Hour'), (b'day', b'Day')])),
+                ('start_datetime', models.DateTimeField(db_index=True)),
+                ('checks_count', models.PositiveIntegerField()),
+                ('success_checks_count', models.PositiveIntegerField()),
+                ('response_time_sum', models.FloatField()),
+                ('min_response_time', models.FloatField()),
+                ('max_response_time', models.FloatField()),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+            options={
+                'ordering': ['-start_datetime'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='check',
+            name='checked_datetime',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='check',
+            index_together=set([('content_type', 'object_id', 'checked_datetime')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='checkrollup',
+            index_together=set([('content_type', 'object_id', 'start_datetime')]),
+        ),
+    ]
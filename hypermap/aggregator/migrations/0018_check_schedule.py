@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0017_check_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layer',
+            name='check_priority',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='next_check',
+            field=models.DateTimeField(db_index=True, null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='capabilities_change_rate',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='check_priority',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='next_check',
+            field=models.DateTimeField(db_index=True, null=True, editable=False, blank=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0018_check_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='check',
+            name='response_size',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='thumbnail_signature',
+            field=models.CharField(default=b'', max_length=32, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='layer',
+            name='thumbnail_updated',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregator', '0019_layer_probe'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='layer',
+            name='next_check',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='service',
+            name='next_check',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+        ),
+    ]
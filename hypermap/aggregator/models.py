@@ -14,12 +14,11 @@ from django.conf import settings
 from django.db import models
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.db.models import Avg, Min, Max
 from django.db.models import signals
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
 from django_extensions.db.fields import AutoSlugField
-from django.utils.functional import cached_property
+from django.utils import timezone
 
 from taggit.managers import TaggableManager
 from lxml import etree
@@ -29,19 +28,23 @@ from owslib.util import nspath_eval
 from owslib.csw import CatalogueServiceWeb
 from owslib.tms import TileMapService
 from owslib.wms import WebMapService
-from owslib.wmts import WebMapTileService
 from arcrest import MapService as ArcMapService, ImageService as ArcImageService
 
-from enums import CSW_RESOURCE_TYPES, SERVICE_TYPES, DATE_TYPES, SUPPORTED_SRS
+from enums import CSW_RESOURCE_TYPES, SERVICE_TYPES, DATE_TYPES, SUPPORTED_SRS, INDEX_ACTIONS, CHECK_ROLLUP_PERIODS
 from tasks import update_endpoint, update_endpoints, check_service, check_layer, index_layer
-from utils import get_esri_extent, get_esri_service_name, get_wms_version_negotiate, format_float, flip_coordinates
+from utils import get_esri_extent, get_esri_service_name, format_float, flip_coordinates
+from harvest import get_cached_capabilities, get_host
+from layer_sync import LayerRecord, get_mined_layer_dates, sync_layers
 
-from hypermap.dynasty.utils import get_mined_dates
+from hypermap.aggregator import check_scheduler, check_stats, host_governor, layer_probe
 
 LOGGER = logging.getLogger(__name__)
 
 REGISTRY_LIMIT_LAYERS = getattr(settings, 'REGISTRY_LIMIT_LAYERS', -1)
 
+# number of most recent checks used to compute the recent reliability of a resource
+RECENT_CHECKS_NUMBER = 2
+
 if REGISTRY_LIMIT_LAYERS > 0:
     DEBUG_SERVICES = True
     DEBUG_LAYER_NUMBER = REGISTRY_LIMIT_LAYERS
@@ -88,13 +91,7 @@ def add_metadata_dates_to_layer(dates, layer):
 
 
 def add_mined_dates(layer):
-    text_to_mine = ''
-    if layer.title:
-        text_to_mine = text_to_mine + layer.title
-    if layer.abstract:
-        text_to_mine = text_to_mine + ' ' + layer.abstract
-    mined_dates = get_mined_dates(text_to_mine)
-    for date in mined_dates:
+    for date in get_mined_layer_dates(layer):
         layer.layerdate_set.get_or_create(date=date, type=0)
 
 
@@ -119,9 +116,11 @@ class Check(models.Model):
     content_object = generic.GenericForeignKey('content_type', 'object_id')
     content_type = models.ForeignKey(ContentType)
     object_id = models.PositiveIntegerField()
-    checked_datetime = models.DateTimeField(auto_now=True)
+    checked_datetime = models.DateTimeField(auto_now=True, db_index=True)
     success = models.BooleanField(default=False)
     response_time = models.FloatField()
+    # number of bytes of the answer, when known
+    response_size = models.PositiveIntegerField(null=True, blank=True)
     message = models.TextField(default='OK')
 
     def __unicode__(self):
@@ -129,6 +128,39 @@ class Check(models.Model):
 
     class Meta:
         ordering = ['-checked_datetime']
+        index_together = [['content_type', 'object_id', 'checked_datetime']]
+
+
+class CheckRollup(models.Model):
+    """
+    CheckRollup summarizes the checks of a resource (service/layer) during an hour or a day,
+    once they are older than the retention period of the checks.
+    """
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    period = models.CharField(max_length=8, choices=CHECK_ROLLUP_PERIODS)
+    start_datetime = models.DateTimeField(db_index=True)
+    checks_count = models.PositiveIntegerField()
+    success_checks_count = models.PositiveIntegerField()
+    response_time_sum = models.FloatField()
+    min_response_time = models.FloatField()
+    max_response_time = models.FloatField()
+
+    def __unicode__(self):
+        return 'Check rollup %s' % self.id
+
+    @property
+    def average_response_time(self):
+        return self.response_time_sum / self.checks_count
+
+    @property
+    def reliability(self):
+        return (self.success_checks_count/float(self.checks_count)) * 100
+
+    class Meta:
+        ordering = ['-start_datetime']
+        index_together = [['content_type', 'object_id', 'start_datetime']]
 
 
 class Resource(models.Model):
@@ -148,6 +180,7 @@ class Resource(models.Model):
     is_valid = models.BooleanField(default=True)
 
     check_set = generic.GenericRelation(Check, object_id_field='object_id')
+    check_rollup_set = generic.GenericRelation(CheckRollup, object_id_field='object_id')
 
     temporal_extent_start = models.CharField(max_length=255, null=True, blank=True)
     temporal_extent_end = models.CharField(max_length=255, null=True, blank=True)
@@ -172,12 +205,42 @@ class Resource(models.Model):
                            default='<csw:Record xmlns:csw="http://www.opengis.net/cat/2.0.2"/>',
                            blank=True)
 
+    # check statistics, maintained by check_stats.record_check
+    checks_count = models.PositiveIntegerField(default=0, editable=False)
+    success_checks_count = models.PositiveIntegerField(default=0, editable=False)
+    first_checked = models.DateTimeField(null=True, blank=True, editable=False)
+    last_checked = models.DateTimeField(null=True, blank=True, editable=False)
+    last_status = models.NullBooleanField(editable=False)
+    # status of the most recent checks, most recent first: 1 for success, 0 for failure
+    recent_checks_status = models.CharField(max_length=32, blank=True, default='', editable=False)
+    response_time_sum = models.FloatField(default=0, editable=False)
+    min_response_time = models.FloatField(null=True, blank=True, editable=False)
+    max_response_time = models.FloatField(null=True, blank=True, editable=False)
+    decayed_reliability = models.FloatField(null=True, blank=True, editable=False)
+    # number of checks in each check_stats.RESPONSE_TIME_BUCKETS bucket, comma separated
+    response_time_histogram = models.CharField(max_length=255, blank=True, default='', editable=False)
+
+    # check scheduling, maintained by check_scheduler.claim_due_resources, may be set to check a resource sooner
+    next_check = models.DateTimeField(null=True, blank=True, db_index=True)
+    # resources with a higher priority are checked first when their checks are due
+    check_priority = models.IntegerField(default=0)
+
     def __unicode__(self):
         return str(self.id)
 
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        # an instance may be older than its check statistics, which are not overwritten
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in check_stats.STATS_FIELDS and
+                field.name not in check_scheduler.SCHEDULE_FIELDS
+            ]
+        super(Resource, self).save(*args, **kwargs)
+
     @property
     def id_string(self):
         return str(self.uuid)
@@ -202,58 +265,54 @@ class Resource(models.Model):
     def csw_resourcetype(self):
         return CSW_RESOURCE_TYPES[self.type]
 
-    @cached_property
+    @property
     def first_check(self):
-        return self.check_set.order_by('checked_datetime').first()
+        """
+        The first check of the resource, read from its check statistics: only its date is known.
+        """
+        if self.first_checked:
+            return Check(content_object=self, checked_datetime=self.first_checked)
+        return None
 
-    @cached_property
+    @property
     def last_check(self):
-        return self.check_set.order_by('-checked_datetime').first()
+        """
+        The last check of the resource, read from its check statistics: only its date and its status are known.
+        """
+        if self.last_checked:
+            return Check(content_object=self, checked_datetime=self.last_checked, success=self.last_status)
+        return None
 
-    @cached_property
+    @property
     def average_response_time(self):
         # TODO: exclude failed checks with response time = 0.0
-        return self.check_set.aggregate(Avg('response_time')).values()[0]
-
-    @cached_property
-    def min_response_time(self):
-        # TODO: exclude failed checks with response time = 0.0
-        return self.check_set.aggregate(Min('response_time')).values()[0]
-
-    @cached_property
-    def max_response_time(self):
-        # TODO: exclude failed checks with response time = 0.0
-        return self.check_set.aggregate(Max('response_time')).values()[0]
-
-    @cached_property
-    def last_status(self):
-        if self.last_check:
-            return self.last_check.success
-        else:
-            return None
-
-    @cached_property
-    def checks_count(self):
-        return self.check_set.all().count()
+        if self.checks_count:
+            return self.response_time_sum / self.checks_count
+        return None
 
-    @cached_property
+    @property
     def reliability(self):
         if self.checks_count:
-            success_checks = self.check_set.filter(success=True).count()
-            return (success_checks/float(self.checks_count)) * 100
+            return (self.success_checks_count/float(self.checks_count)) * 100
         else:
             return None
 
-    @cached_property
+    @property
     def recent_reliability(self):
-        recent_checks_number = 2
-        if self.checks_count >= recent_checks_number:
-            recent_checks = self.check_set.all().order_by('-checked_datetime')[0:recent_checks_number]
-            success_checks = sum(check.success for check in recent_checks)
-            return (success_checks/float(recent_checks_number)) * 100
+        if self.checks_count >= RECENT_CHECKS_NUMBER:
+            success_checks = self.recent_checks_status[0:RECENT_CHECKS_NUMBER].count('1')
+            return (success_checks/float(RECENT_CHECKS_NUMBER)) * 100
         else:
             return self.reliability
 
+    @property
+    def response_time_distribution(self):
+        """
+        Number of checks by response time, as a list of (upper bound in seconds or None, count).
+        """
+        counts = check_stats.parse_histogram(self.response_time_histogram)
+        return zip(check_stats.RESPONSE_TIME_BUCKETS + (None, ), counts)
+
     def get_checks_admin_url(self):
         path = reverse("admin:%s_%s_changelist" % (self._meta.app_label, "check"))
         return path
@@ -284,6 +343,13 @@ class Service(Resource):
     catalog = models.ForeignKey("Catalog", default=1)
     is_monitored = models.BooleanField(default=True)
 
+    # validators of the last harvested capabilities document, used for incremental harvesting
+    capabilities_etag = models.CharField(max_length=255, null=True, blank=True, editable=False)
+    capabilities_last_modified = models.CharField(max_length=64, null=True, blank=True, editable=False)
+    capabilities_hash = models.CharField(max_length=40, null=True, blank=True, editable=False)
+    # exponentially decayed rate of the harvests finding a changed capabilities document
+    capabilities_change_rate = models.FloatField(default=0, editable=False)
+
     @property
     def id_string(self):
         return str(self.uuid)
@@ -306,24 +372,35 @@ class Service(Resource):
     def get_deleted_number(self):
         return self.layer_set.filter(was_deleted=True).count()
 
-    def update_layers(self):
+    def update_layers(self, capabilities=None):
         """
         Update layers for a service.
+        capabilities is an optional harvest.Capabilities with the already parsed document.
+        For OGC services, returns a dictionary with the number of added, updated and skipped layers.
         """
 
+        if capabilities is not None and not capabilities.success:
+            LOGGER.debug('Not updating layers for service id %s as its capabilities could not be fetched' % self.id)
+            return None
+
+        ows = None
+        if capabilities is not None:
+            ows = capabilities.ows
+        report = None
+
         signals.post_save.disconnect(layer_post_save, sender=Layer)
 
         try:
 
             LOGGER.debug('Updating layers for service id %s' % self.id)
             if self.type == 'OGC:WMS':
-                update_layers_wms(self)
+                report = update_layers_wms(self, wms=ows)
             elif self.type == 'OGC:WMTS':
-                update_layers_wmts(self)
+                report = update_layers_wmts(self, wmts=ows)
             elif self.type == 'ESRI:ArcGIS:MapServer':
-                update_layers_esri_mapserver(self)
+                update_layers_esri_mapserver(self, esri_service=ows)
             elif self.type == 'ESRI:ArcGIS:ImageServer':
-                update_layers_esri_imageserver(self)
+                update_layers_esri_imageserver(self, esri_service=ows)
             elif self.type == 'Hypermap:WorldMap':
                 update_layers_wm(self)
             elif self.type == 'Hypermap:WARPER':
@@ -334,9 +411,104 @@ class Service(Resource):
 
         signals.post_save.connect(layer_post_save, sender=Layer)
 
-    def check_available(self):
+        return report
+
+    def update_metadata(self, ows=None):
+        """
+        Update title, abstract, keywords, extent and metadata record of a service from its capabilities.
+        ows is an optional, already parsed, capabilities document.
+        """
+        title = None
+        abstract = None
+        keywords = []
+        wkt_geometry = None
+        srs = '4326'
+        if self.type == 'OGC:CSW':
+            ows = ows or CatalogueServiceWeb(self.url)
+            title = ows.identification.title
+            abstract = ows.identification.abstract
+            keywords = ows.identification.keywords
+        if self.type == 'OGC:WMS':
+            ows = ows or get_cached_capabilities(self.type, self.url, refresh=True)
+            title = ows.identification.title
+            abstract = ows.identification.abstract
+            keywords = ows.identification.keywords
+            for c in ows.contents:
+                if ows.contents[c].parent is None:
+                    wkt_geometry = bbox2wktpolygon(ows.contents[c].boundingBoxWGS84)
+                break
+        if self.type == 'OGC:WMTS':
+            ows = ows or get_cached_capabilities(self.type, self.url, refresh=True)
+            title = ows.identification.title
+            abstract = ows.identification.abstract
+            keywords = ows.identification.keywords
+        if self.type == 'OSGeo:TMS':
+            ows = ows or TileMapService(self.url)
+            title = ows.identification.title
+            abstract = ows.identification.abstract
+            keywords = ows.identification.keywords
+        if self.type == 'ESRI:ArcGIS:MapServer':
+            esri = ows or ArcMapService(self.url)
+            extent, srs = get_esri_extent(esri)
+            title = esri.mapName
+            if len(title) == 0:
+                title = get_esri_service_name(self.url)
+            wkt_geometry = bbox2wktpolygon([
+                extent['xmin'],
+                extent['ymin'],
+                extent['xmax'],
+                extent['ymax']
+            ])
+        if self.type == 'ESRI:ArcGIS:ImageServer':
+            esri = ows or ArcImageService(self.url)
+            extent, srs = get_esri_extent(esri)
+            title = esri._json_struct['name']
+            if len(title) == 0:
+                title = get_esri_service_name(self.url)
+            wkt_geometry = bbox2wktpolygon([
+                extent['xmin'],
+                extent['ymin'],
+                extent['xmax'],
+                extent['ymax']
+            ])
+        if self.type == 'Hypermap:WorldMap':
+            urllib2.urlopen(self.url)
+            title = 'Harvard WorldMap'
+        if self.type == 'Hypermap:WARPER':
+            urllib2.urlopen(self.url)
+        # update title without raising a signal and recursion
+        if title:
+            self.title = title
+            Service.objects.filter(id=self.id).update(title=title)
+        if abstract:
+            self.abstract = abstract
+            Service.objects.filter(id=self.id).update(abstract=abstract)
+        if keywords:
+            for kw in keywords:
+                # FIXME: persist keywords to Django model
+                self.keywords.add(kw)
+        if wkt_geometry:
+            self.wkt_geometry = wkt_geometry
+            Service.objects.filter(id=self.id).update(wkt_geometry=wkt_geometry)
+        xml = create_metadata_record(
+            identifier=self.id_string,
+            source=self.url,
+            links=[[self.type, self.url]],
+            format=self.type,
+            type='service',
+            title=title,
+            abstract=abstract,
+            keywords=keywords,
+            wkt_geometry=self.wkt_geometry,
+            srs=srs
+        )
+        anytexts = gen_anytext(title, abstract, keywords)
+        Service.objects.filter(id=self.id).update(anytext=anytexts, xml=xml, csw_type='service')
+
+    def check_available(self, capabilities=None):
         """
         Check for availability of a service and provide run metrics.
+        capabilities is an optional harvest.Capabilities with the already parsed document.
         """
         success = True
         start_time = datetime.datetime.utcnow()
@@ -344,93 +516,18 @@ class Service(Resource):
 
         LOGGER.debug('Checking service id %s' % self.id)
 
+        ows = None
+        if capabilities is not None:
+            ows = capabilities.ows
+
         try:
-            title = None
-            abstract = None
-            keywords = []
-            wkt_geometry = None
-            srs = '4326'
-            if self.type == 'OGC:CSW':
-                ows = CatalogueServiceWeb(self.url)
-                title = ows.identification.title
-                abstract = ows.identification.abstract
-                keywords = ows.identification.keywords
-            if self.type == 'OGC:WMS':
-                ows = get_wms_version_negotiate(self.url)
-                title = ows.identification.title
-                abstract = ows.identification.abstract
-                keywords = ows.identification.keywords
-                for c in ows.contents:
-                    if ows.contents[c].parent is None:
-                        wkt_geometry = bbox2wktpolygon(ows.contents[c].boundingBoxWGS84)
-                    break
-            if self.type == 'OGC:WMTS':
-                ows = WebMapTileService(self.url)
-                title = ows.identification.title
-                abstract = ows.identification.abstract
-                keywords = ows.identification.keywords
-            if self.type == 'OSGeo:TMS':
-                ows = TileMapService(self.url)
-                title = ows.identification.title
-                abstract = ows.identification.abstract
-                keywords = ows.identification.keywords
-            if self.type == 'ESRI:ArcGIS:MapServer':
-                esri = ArcMapService(self.url)
-                extent, srs = get_esri_extent(esri)
-                title = esri.mapName
-                if len(title) == 0:
-                    title = get_esri_service_name(self.url)
-                wkt_geometry = bbox2wktpolygon([
-                    extent['xmin'],
-                    extent['ymin'],
-                    extent['xmax'],
-                    extent['ymax']
-                ])
-            if self.type == 'ESRI:ArcGIS:ImageServer':
-                esri = ArcImageService(self.url)
-                extent, srs = get_esri_extent(esri)
-                title = esri._json_struct['name']
-                if len(title) == 0:
-                    title = get_esri_service_name(self.url)
-                wkt_geometry = bbox2wktpolygon([
-                    extent['xmin'],
-                    extent['ymin'],
-                    extent['xmax'],
-                    extent['ymax']
-                ])
-            if self.type == 'Hypermap:WorldMap':
-                urllib2.urlopen(self.url)
-                title = 'Harvard WorldMap'
-            if self.type == 'Hypermap:WARPER':
-                urllib2.urlopen(self.url)
-            # update title without raising a signal and recursion
-            if title:
-                self.title = title
-                Service.objects.filter(id=self.id).update(title=title)
-            if abstract:
-                self.abstract = abstract
-                Service.objects.filter(id=self.id).update(abstract=abstract)
-            if keywords:
-                for kw in keywords:
-                    # FIXME: persist keywords to Django model
-                    self.keywords.add(kw)
-            if wkt_geometry:
-                self.wkt_geometry = wkt_geometry
-                Service.objects.filter(id=self.id).update(wkt_geometry=wkt_geometry)
-            xml = create_metadata_record(
-                identifier=self.id_string,
-                source=self.url,
-                links=[[self.type, self.url]],
-                format=self.type,
-                type='service',
-                title=title,
-                abstract=abstract,
-                keywords=keywords,
-                wkt_geometry=self.wkt_geometry,
-                srs=srs
-            )
-            anytexts = gen_anytext(title, abstract, keywords)
-            Service.objects.filter(id=self.id).update(anytext=anytexts, xml=xml, csw_type='service')
+            if capabilities is not None and not capabilities.success:
+                raise capabilities.error
+            if capabilities is not None and not capabilities.changed:
+                # the capabilities document did not change since the last harvest
+                LOGGER.debug('Capabilities of service id %s did not change' % self.id)
+            else:
+                self.update_metadata(ows)
         except Exception, e:
             LOGGER.error(e, exc_info=True)
             message = str(e)
@@ -439,6 +536,9 @@ class Service(Resource):
         end_time = datetime.datetime.utcnow()
         delta = end_time - start_time
         response_time = '%s.%s' % (delta.seconds, delta.microseconds)
+        if capabilities is not None and capabilities.fetched:
+            # the remote request was done by the harvester
+            response_time = capabilities.response_time
 
         check = Check(
             content_object=self,
@@ -555,6 +655,9 @@ class Layer(Resource):
     bbox_y0 = models.DecimalField(max_digits=19, decimal_places=10, default=-90, blank=True, null=True)
     bbox_y1 = models.DecimalField(max_digits=19, decimal_places=10, default=90, blank=True, null=True)
     thumbnail = models.ImageField(upload_to='layers', blank=True, null=True)
+    # when the thumbnail was generated, and layer_probe.get_thumbnail_signature of the layer at that time
+    thumbnail_updated = models.DateTimeField(null=True, blank=True, editable=False)
+    thumbnail_signature = models.CharField(max_length=32, blank=True, default='', editable=False)
     page_url = models.URLField(max_length=255, blank=True, null=True)
     service = models.ForeignKey(Service, blank=True, null=True)
     is_monitored = models.BooleanField(default=True)
@@ -627,7 +730,8 @@ class Layer(Resource):
                     end_date.append(1)
                     dates.append(end_date)
         # now we return all the other dates
-        for layerdate in self.layerdate_set.all().order_by('date'):
+        # (sorted here, so dates prefetched by prefetch_layers are used)
+        for layerdate in sorted(self.layerdate_set.all(), key=lambda layerdate: layerdate.date):
             sdate = layerdate.date
             # for now we skip ranges
             if 'TO' not in sdate:
@@ -648,7 +752,7 @@ class Layer(Resource):
         format_error_message = 'This layer does not expose valid formats (png, jpeg) to generate the thumbnail'
         img = None
         if self.type == 'OGC:WMS':
-            ows = get_wms_version_negotiate(self.service.url)
+            ows = get_cached_capabilities('OGC:WMS', self.service.url)
             op_getmap = ows.getOperationByName('GetMap')
             image_format = 'image/png'
             if image_format not in op_getmap.formatOptions:
@@ -674,7 +778,7 @@ class Layer(Resource):
                 img = None
         elif self.type == 'OGC:WMTS':
 
-            ows = WebMapTileService(self.service.url)
+            ows = get_cached_capabilities('OGC:WMTS', self.service.url)
             ows_layer = ows.contents[self.name]
             image_format = 'image/png'
             if image_format not in ows_layer.formats:
@@ -791,12 +895,16 @@ class Layer(Resource):
         if img:
             thumbnail_file_name = '%s.jpg' % self.name
             upfile = SimpleUploadedFile(thumbnail_file_name, img.read(), "image/jpeg")
+            self.thumbnail_updated = timezone.now()
+            self.thumbnail_signature = layer_probe.get_thumbnail_signature(self)
             self.thumbnail.save(thumbnail_file_name, upfile, True)
             LOGGER.debug('Thumbnail updated for layer %s' % self.name)
 
     def check_available(self):
         """
         Check for availability of a layer and provide run metrics.
+        The layer is probed with a minimal request, see layer_probe, and its thumbnail is only regenerated
+        when needed, unless REGISTRY_LAYER_CHECK_MODE is 'thumbnail'.
         """
         success = True
         start_time = datetime.datetime.utcnow()
@@ -805,16 +913,35 @@ class Layer(Resource):
 
         signals.post_save.disconnect(layer_post_save, sender=Layer)
 
+        error = None
+        result = None
         try:
-            self.update_thumbnail()
+            if layer_probe.REGISTRY_LAYER_CHECK_MODE == 'thumbnail':
+                self.update_thumbnail()
+            else:
+                result = layer_probe.probe(self)
         except ValueError, err:
-            # caused by update_thumbnail()
-            # self.href is empty in arcserver.ExportMap
-            if str(err).startswith("unknown url type:"):
-                LOGGER.debug('Thumbnail can not be updated: %s' % str(err))
+            if layer_probe.REGISTRY_LAYER_CHECK_MODE == 'thumbnail':
+                # caused by update_thumbnail()
+                # self.href is empty in arcserver.ExportMap
+                if str(err).startswith("unknown url type:"):
+                    LOGGER.debug('Thumbnail can not be updated: %s' % str(err))
+            else:
+                # the layer answered, but not an image
+                message = str(err)
+                success = False
         except Exception, err:
             message = str(err)
             success = False
+            error = err
+        host_governor.record(get_host(self.url), error)
+
+        if result is not None and layer_probe.needs_thumbnail(self):
+            try:
+                self.update_thumbnail()
+            except Exception, err:
+                # the layer is available, even if its thumbnail can not be generated
+                LOGGER.warning('Thumbnail of layer id %s can not be updated: %s' % (self.id, err))
 
         signals.post_save.connect(layer_post_save, sender=Layer)
 
@@ -822,11 +949,16 @@ class Layer(Resource):
 
         delta = end_time - start_time
         response_time = '%s.%s' % (delta.seconds, delta.microseconds)
+        response_size = None
+        if result is not None:
+            response_time = result.response_time
+            response_size = result.response_size
 
         check = Check(
             content_object=self,
             success=success,
             response_time=response_time,
+            response_size=response_size,
             message=message
         )
         check.save()
@@ -863,6 +995,11 @@ class Layer(Resource):
         """
         from pycsw.core.etree import etree
 
+        # most records have no registry tags, do not parse them
+        namespace = query_string[1:query_string.find('}')] if query_string.startswith('{') else ''
+        if not self.xml or namespace not in self.xml:
+            return {}
+
         parsed = etree.fromstring(self.xml, etree.XMLParser(resolve_entities=False))
         registry_tags = parsed.findall(query_string)
 
@@ -969,6 +1106,37 @@ class Issue(models.Model):
     description = models.TextField(blank=True, null=True)
 
 
+class IndexQueueItem(models.Model):
+    """
+    IndexQueueItem represents a layer waiting to be indexed or removed from the search backend.
+    """
+    layer_id = models.PositiveIntegerField(unique=True)
+    action = models.CharField(max_length=16, choices=INDEX_ACTIONS, default='index')
+    enqueued = models.DateTimeField(db_index=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+    retries = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+
+    def __unicode__(self):
+        return '%s layer %s' % (self.action, self.layer_id)
+
+
+class IndexTimeBounds(models.Model):
+    """
+    IndexTimeBounds keeps the earliest and latest layer_date indexed in a search index.
+    Dates are stored as indexed, with a sortable numeric key (dates can be BCE).
+    """
+    index_name = models.CharField(max_length=255, unique=True)
+    min_date = models.CharField(max_length=64, null=True, blank=True)
+    min_key = models.BigIntegerField(null=True, blank=True)
+    max_date = models.CharField(max_length=64, null=True, blank=True)
+    max_key = models.BigIntegerField(null=True, blank=True)
+    last_updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return '%s [%s TO %s]' % (self.index_name, self.min_date, self.max_date)
+
+
 def bbox2wktpolygon(bbox):
     """
     Return OGC WKT Polygon of a simple bbox list
@@ -1057,15 +1225,29 @@ def gen_anytext(*args):
     return ' '.join(bag)
 
 
+def add_srs_to_service(service, codes):
+    """
+    Link a list of spatial reference system codes to a service, with a few queries.
+    """
+    codes = set(codes)
+    srs_list = list(SpatialReferenceSystem.objects.filter(code__in=codes))
+    for code in codes - set(srs.code for srs in srs_list):
+        srs_list.append(SpatialReferenceSystem.objects.create(code=code))
+    service.srs.add(*srs_list)
+
+
 # updatelayers for each service type
 
-def update_layers_wms(service):
+def update_layers_wms(service, wms=None):
     """
     Update layers for an OGC:WMS service.
     Sample endpoint: http://demo.geonode.org/geoserver/ows
+    wms is an optional, already parsed, capabilities document.
+    Returns a dictionary with the number of added, updated and skipped layers.
     """
     try:
-        wms = get_wms_version_negotiate(service.url)
+        if wms is None:
+            wms = get_cached_capabilities('OGC:WMS', service.url)
         layer_names = list(wms.contents)
         parent = wms.contents[layer_names[0]].parent
         # fallback, some endpoint like this one:
@@ -1076,66 +1258,25 @@ def update_layers_wms(service):
         else:
             crsOptions = wms.contents[layer_names[0]].crsOptions
         # set srs
-        for crs_code in crsOptions:
-            srs, created = SpatialReferenceSystem.objects.get_or_create(code=crs_code)
-            service.srs.add(srs)
+        add_srs_to_service(service, crsOptions)
 
         service.update_validity()
 
         # now update layers
-        layer_n = 0
-        total = len(layer_names)
+        if DEBUG_SERVICES:
+            layer_names = layer_names[0:DEBUG_LAYER_NUMBER]
+        records = []
         for layer_name in layer_names:
             ows_layer = wms.contents[layer_name]
-            LOGGER.debug('Updating layer %s' % ows_layer.name)
-            # get or create layer
-            layer, created = Layer.objects.get_or_create(name=ows_layer.name, service=service, catalog=service.catalog)
-            if layer.active:
-                links = [['OGC:WMS', service.url]]
-                # update fields
-                layer.type = 'OGC:WMS'
-                layer.title = ows_layer.title
-                layer.abstract = ows_layer.abstract
-                layer.url = service.url
-                layer.page_url = layer.get_absolute_url
-                links.append([
-                    'WWW:LINK',
-                    settings.SITE_URL.rstrip('/') + layer.page_url
-                ])
-                # bbox
-                bbox = list(ows_layer.boundingBoxWGS84 or (-179.0, -89.0, 179.0, 89.0))
-                layer.bbox_x0 = bbox[0]
-                layer.bbox_y0 = bbox[1]
-                layer.bbox_x1 = bbox[2]
-                layer.bbox_y1 = bbox[3]
-                layer.wkt_geometry = bbox2wktpolygon(bbox)
-                # keywords
-                for keyword in ows_layer.keywords:
-                    layer.keywords.add(keyword)
-                # crsOptions
-                # TODO we may rather prepopulate with fixutres the SpatialReferenceSystem table
-                layer.xml = create_metadata_record(
-                    identifier=str(layer.uuid),
-                    source=service.url,
-                    links=links,
-                    format='OGC:WMS',
-                    type=layer.csw_type,
-                    relation=service.id_string,
-                    title=ows_layer.title,
-                    alternative=ows_layer.name,
-                    abstract=ows_layer.abstract,
-                    keywords=ows_layer.keywords,
-                    wkt_geometry=layer.wkt_geometry
-                )
-                layer.anytext = gen_anytext(layer.title, layer.abstract, ows_layer.keywords.sort())
-                layer.save()
-                # dates
-                add_mined_dates(layer)
-            layer_n = layer_n + 1
-            # exits if DEBUG_SERVICES
-            LOGGER.debug("Updating layer n. %s/%s" % (layer_n, total))
-            if DEBUG_SERVICES and layer_n == DEBUG_LAYER_NUMBER:
-                return
+            records.append(LayerRecord(
+                ows_layer.name,
+                title=ows_layer.title,
+                abstract=ows_layer.abstract,
+                keywords=ows_layer.keywords,
+                bbox=ows_layer.boundingBoxWGS84,
+                anytext=gen_anytext(ows_layer.title, ows_layer.abstract, ows_layer.keywords.sort())
+            ))
+        return sync_layers(service, records, 'OGC:WMS', 'OGC:WMS')
     except Exception as err:
         message = "update_layers_wms: {0}".format(
             err
@@ -1149,74 +1290,42 @@ def update_layers_wms(service):
         check.save()
 
 
-def update_layers_wmts(service):
+def update_layers_wmts(service, wmts=None):
     """
     Update layers for an OGC:WMTS service.
     Sample endpoint: http://map1.vis.earthdata.nasa.gov/wmts-geo/1.0.0/WMTSCapabilities.xml
+    wmts is an optional, already parsed, capabilities document.
+    Returns a dictionary with the number of added, updated and skipped layers.
     """
     try:
-        wmts = WebMapTileService(service.url)
+        if wmts is None:
+            wmts = get_cached_capabilities('OGC:WMTS', service.url)
 
         # set srs
         # WMTS is always in 4326
-        srs, created = SpatialReferenceSystem.objects.get_or_create(code='EPSG:4326')
-        service.srs.add(srs)
+        add_srs_to_service(service, ['EPSG:4326'])
 
         service.update_validity()
 
         layer_names = list(wmts.contents)
-        layer_n = 0
-        total = len(layer_names)
+        if DEBUG_SERVICES:
+            layer_names = layer_names[0:DEBUG_LAYER_NUMBER]
+        records = []
         for layer_name in layer_names:
             ows_layer = wmts.contents[layer_name]
-            LOGGER.debug('Updating layer %s' % ows_layer.name)
-            layer, created = Layer.objects.get_or_create(name=ows_layer.name, service=service, catalog=service.catalog)
-            if layer.active:
-                links = [['OGC:WMTS', service.url]]
-                layer.type = 'OGC:WMTS'
-                layer.title = ows_layer.title
-                layer.abstract = ows_layer.abstract
-                # keywords
-                # @tomkralidis wmts does not seem to support this attribute
-                keywords = None
-                if hasattr(ows_layer, 'keywords'):
-                    keywords = ows_layer.keywords
-                    for keyword in keywords:
-                        layer.keywords.add(keyword)
-                layer.url = service.url
-                layer.page_url = layer.get_absolute_url
-                links.append([
-                    'WWW:LINK',
-                    settings.SITE_URL.rstrip('/') + layer.page_url
-                ])
-                bbox = list(ows_layer.boundingBoxWGS84 or (-179.0, -89.0, 179.0, 89.0))
-                layer.bbox_x0 = bbox[0]
-                layer.bbox_y0 = bbox[1]
-                layer.bbox_x1 = bbox[2]
-                layer.bbox_y1 = bbox[3]
-                layer.wkt_geometry = bbox2wktpolygon(bbox)
-                layer.xml = create_metadata_record(
-                    identifier=str(layer.uuid),
-                    source=service.url,
-                    links=links,
-                    format='OGC:WMS',
-                    type=layer.csw_type,
-                    relation=service.id_string,
-                    title=ows_layer.title,
-                    alternative=ows_layer.name,
-                    abstract=layer.abstract,
-                    keywords=keywords,
-                    wkt_geometry=layer.wkt_geometry
-                )
-                layer.anytext = gen_anytext(layer.title, layer.abstract, keywords)
-                layer.save()
-                # dates
-                add_mined_dates(layer)
-            layer_n = layer_n + 1
-            # exits if DEBUG_SERVICES
-            LOGGER.debug("Updating layer n. %s/%s" % (layer_n, total))
-            if DEBUG_SERVICES and layer_n == DEBUG_LAYER_NUMBER:
-                return
+            # @tomkralidis wmts does not seem to support this attribute
+            keywords = None
+            if hasattr(ows_layer, 'keywords'):
+                keywords = ows_layer.keywords
+            records.append(LayerRecord(
+                ows_layer.name,
+                title=ows_layer.title,
+                abstract=ows_layer.abstract,
+                keywords=keywords,
+                bbox=ows_layer.boundingBoxWGS84,
+                anytext=gen_anytext(ows_layer.title, ows_layer.abstract, keywords)
+            ))
+        return sync_layers(service, records, 'OGC:WMTS', 'OGC:WMS')
     except Exception as err:
         message = "update_layers_wmts: {0}".format(
             err
@@ -1470,13 +1579,15 @@ def update_layers_warper(service):
         check.save()
 
 
-def update_layers_esri_mapserver(service, greedy_opt=False):
+def update_layers_esri_mapserver(service, greedy_opt=False, esri_service=None):
     """
     Update layers for an ESRI REST MapServer.
     Sample endpoint: https://gis.ngdc.noaa.gov/arcgis/rest/services/SampleWorldCities/MapServer/?f=json
+    esri_service is an optional, already fetched, arcrest MapService.
     """
     try:
-        esri_service = ArcMapService(service.url)
+        if esri_service is None:
+            esri_service = ArcMapService(service.url)
         # set srs
         # both mapserver and imageserver exposes just one srs at the service level
         # not sure if other ones are supported, for now we just store this one
@@ -1586,13 +1697,15 @@ def update_layers_esri_mapserver(service, greedy_opt=False):
         check.save()
 
 
-def update_layers_esri_imageserver(service):
+def update_layers_esri_imageserver(service, esri_service=None):
     """
     Update layers for an ESRI REST ImageServer.
     Sample endpoint: https://gis.ngdc.noaa.gov/arcgis/rest/services/bag_bathymetry/ImageServer/?f=json
+    esri_service is an optional, already fetched, arcrest ImageService.
     """
     try:
-        esri_service = ArcImageService(service.url)
+        if esri_service is None:
+            esri_service = ArcImageService(service.url)
         # set srs
         # both mapserver and imageserver exposes just one srs at the service level
         # not sure if other ones are supported, for now we just store this one
@@ -1651,6 +1764,14 @@ def update_layers_esri_imageserver(service):
 
 # signals
 
+def check_post_save(instance, created, raw=False, *args, **kwargs):
+    """
+    Used to update the check statistics of the checked resource.
+    """
+    if created and not raw:
+        check_stats.record_check(instance)
+
+
 def endpointlist_post_save(instance, *args, **kwargs):
     """
     Used to process the lines of the endpoint list.
@@ -1716,29 +1837,36 @@ def service_post_save(instance, *args, **kwargs):
         check_service.delay(instance.id)
 
 
-def layer_pre_save(instance, *args, **kwargs):
+def is_layer_valid(layer):
     """
-    Used to check layer validity.
+    Check layer validity.
     """
 
     is_valid = True
 
     # we do not need to check validity for WM layers
-    if not instance.service.type == 'Hypermap:WorldMap':
+    if not layer.service.type == 'Hypermap:WorldMap':
 
         # 0. a layer is invalid if its service its invalid as well
-        if not instance.service.is_valid:
+        if not layer.service.is_valid:
             is_valid = False
-            LOGGER.debug('Layer with id %s is marked invalid because its service is invalid' % instance.id)
+            LOGGER.debug('Layer with id %s is marked invalid because its service is invalid' % layer.id)
 
         # 1. a layer is invalid with an extent within (-2, -2, +2, +2)
-        if instance.bbox_x0 > -2 and instance.bbox_x1 < 2 and instance.bbox_y0 > -2 and instance.bbox_y1 < 2:
+        if layer.bbox_x0 > -2 and layer.bbox_x1 < 2 and layer.bbox_y0 > -2 and layer.bbox_y1 < 2:
             is_valid = False
             LOGGER.debug(
-                'Layer with id %s is marked invalid because its extent is within (-2, -2, +2, +2)' % instance.id
+                'Layer with id %s is marked invalid because its extent is within (-2, -2, +2, +2)' % layer.id
             )
 
-    instance.is_valid = is_valid
+    return is_valid
+
+
+def layer_pre_save(instance, *args, **kwargs):
+    """
+    Used to check layer validity.
+    """
+    instance.is_valid = is_layer_valid(instance)
 
 
 def layer_post_save(instance, *args, **kwargs):
@@ -1754,6 +1882,7 @@ def layer_post_save(instance, *args, **kwargs):
         index_layer(instance.id)
 
 
+signals.post_save.connect(check_post_save, sender=Check)
 signals.post_save.connect(endpoint_post_save, sender=Endpoint)
 signals.post_save.connect(endpointlist_post_save, sender=EndpointList)
 signals.pre_save.connect(service_pre_save, sender=Service)
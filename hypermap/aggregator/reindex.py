@@ -0,0 +1,250 @@
+"""
+Full reindex of the layers in the search backend.
+
+Layers are streamed in id ranges, serialized in a process pool with
+prefetch_layers (at most two ranges per process are queued or serialized
+ahead of the writers, so memory stays bounded), and written to
+Solr (/update/json/docs) or Elasticsearch (helpers.parallel_bulk) by a pool of
+writer threads. The last written id is stored in a checkpoint file after each
+range, so an interrupted reindex can be resumed.
+
+With Elasticsearch, a blue/green reindex writes the layers to new versioned
+indices, created without refresh and replicas, and then atomically points the
+catalog aliases to them.
+"""
+
+import json
+import logging
+import os
+import time
+
+from collections import deque
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
+
+from hypermap.aggregator import search_transport, time_bounds
+from hypermap.search_api import cache as search_cache
+
+LOGGER = logging.getLogger(__name__)
+
+REGISTRY_SEARCH_URL = getattr(settings, 'REGISTRY_SEARCH_URL', 'solr+http://solr:8983')
+SEARCH_TYPE = REGISTRY_SEARCH_URL.split('+')[0]
+SEARCH_URL = REGISTRY_SEARCH_URL.split('+')[1]
+
+
+def get_layers():
+    from hypermap.aggregator.models import Layer
+    return Layer.objects.filter(is_valid=True, was_deleted=False)
+
+
+def id_chunks(batch_size, start_after=0):
+    """
+    Yield the ids of the layers to index in lists of batch_size ids, in id order.
+    """
+    last_id = start_after
+    while True:
+        ids = list(get_layers().filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def bounded_imap(pool, func, iterable, window):
+    """
+    Like pool.imap, but with at most window items of iterable submitted to the pool and not yet consumed, so a
+    pool faster than the consumer of the results does not hold all of them in memory.
+    """
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def close_connections():
+    """
+    Close the database connections, so processes do not share the connections of their parent.
+    """
+    for connection in connections.all():
+        connection.close()
+
+
+def serialize_layers(layer_ids, index_names=None):
+    """
+    Serialize a list of layers for the search backend.
+    index_names optionally maps catalog slugs to the Elasticsearch indices the documents are written to.
+    Returns the last layer id, the documents and a list of [layer id, error message].
+    """
+    from hypermap.aggregator.utils import layer2dict, prefetch_layers
+
+    documents = []
+    errors = []
+    for layer in prefetch_layers(get_layers().filter(id__in=layer_ids)):
+        try:
+            if SEARCH_TYPE == 'solr':
+                document, message = layer2dict(layer)
+            else:
+                from hypermap.aggregator.elasticsearch_client import ESHypermap
+                document = message = ESHypermap.layer_to_es(layer, with_bulk=True)
+                if index_names and isinstance(document, dict):
+                    document['_index'] = index_names.get(document['_index'], document['_index'])
+            if isinstance(document, dict):
+                documents.append(document)
+            else:
+                errors.append([layer.id, str(message)])
+        except Exception, e:
+            LOGGER.error(e, exc_info=True)
+            errors.append([layer.id, str(e)])
+    return layer_ids[-1], documents, errors
+
+
+def write_solr(documents, batch_size, pool):
+    from hypermap.aggregator.solr import SOLR_CORE_URL
+
+    url_solr_update = '%s/update/json/docs' % SOLR_CORE_URL
+    headers = {"content-type": "application/json"}
+    params = {"commitWithin": 1500}
+
+    def post(batch):
+        response = search_transport.post(url_solr_update, data=json.dumps(batch), params=params, headers=headers)
+        response.raise_for_status()
+        return len(batch)
+
+    batches = [documents[i:i+batch_size] for i in range(0, len(documents), batch_size)]
+    written = sum(pool.map(post, batches))
+    time_bounds.widen(SOLR_CORE_URL, [document.get('layer_date') for document in documents])
+    return written
+
+
+def write_es(documents, batch_size, concurrency):
+    from elasticsearch import helpers
+    from hypermap.aggregator.elasticsearch_client import ESHypermap
+
+    written = 0
+    for success, info in helpers.parallel_bulk(ESHypermap.es, documents, thread_count=concurrency,
+                                               chunk_size=batch_size):
+        if not success:
+            raise Exception('Elasticsearch bulk error: %s' % info)
+        written += 1
+    return written
+
+
+def create_catalog_indices():
+    """
+    Create a new Elasticsearch index for each catalog, returns the index names by catalog slug.
+    """
+    from hypermap.aggregator.elasticsearch_client import ESHypermap
+    from hypermap.aggregator.models import Catalog
+
+    return dict(
+        (slug, ESHypermap.create_versioned_index(slug)) for slug in Catalog.objects.values_list('slug', flat=True)
+    )
+
+
+def swap_catalog_indices(index_names):
+    from hypermap.aggregator.elasticsearch_client import ESHypermap
+
+    for slug, index_name in index_names.items():
+        ESHypermap.swap_alias(slug, index_name)
+    search_cache.invalidate(index_names.keys())
+
+
+def delete_indices(index_names):
+    from hypermap.aggregator.elasticsearch_client import ESHypermap
+
+    for index_name in index_names:
+        ESHypermap.es.indices.delete(index=index_name, ignore=[404])
+
+
+def read_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    return 0
+
+
+def write_checkpoint(path, last_id):
+    if path:
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            f.write(str(last_id))
+        os.rename(tmp_path, path)
+
+
+def reindex_layers(processes=None, concurrency=4, batch_size=None, checkpoint=None, resume=False, report=None,
+                   blue_green=False):
+    """
+    Index all the valid layers in the search backend.
+    processes is the number of processes serializing the layers (1 to serialize them in this process),
+    concurrency the number of concurrent bulk requests and batch_size the number of layers per request.
+    With resume, the layers up to the id stored in the checkpoint file are skipped.
+    report is called with (written, errors, elapsed seconds, last id) after each chunk of layers.
+    With blue_green (Elasticsearch only), layers are written to new indices which replace the catalog
+    indices once all the layers are written, so searches never see a partial catalog.
+    Returns the number of indexed layers and the list of [layer id, error message].
+    """
+    batch_size = batch_size or settings.REGISTRY_SEARCH_BATCH_SIZE
+    processes = processes or cpu_count()
+    start_after = read_checkpoint(checkpoint) if resume else 0
+    if start_after:
+        LOGGER.info('Resuming reindex after layer id %s' % start_after)
+
+    # each chunk of layers is written with concurrency bulk requests
+    index_names = {}
+    if blue_green:
+        index_names = create_catalog_indices()
+    serialize = partial(serialize_layers, index_names=index_names)
+
+    chunks = id_chunks(batch_size * concurrency, start_after)
+    process_pool = None
+    if processes > 1:
+        close_connections()
+        process_pool = Pool(processes, initializer=close_connections)
+        results = bounded_imap(process_pool, serialize, chunks, processes * 2)
+    else:
+        results = (serialize(chunk) for chunk in chunks)
+    writer_pool = ThreadPool(concurrency)
+
+    written = 0
+    errors = []
+    start_time = time.time()
+    try:
+        # results are ordered by id, so the checkpoint is only moved past written layers
+        for last_id, documents, chunk_errors in results:
+            if documents:
+                if SEARCH_TYPE == 'solr':
+                    written += write_solr(documents, batch_size, writer_pool)
+                else:
+                    written += write_es(documents, batch_size, concurrency)
+            errors.extend(chunk_errors)
+            write_checkpoint(checkpoint, last_id)
+            if documents and not index_names:
+                search_cache.invalidate()
+
+            elapsed = time.time() - start_time
+            LOGGER.info('Reindexed %s layers (%.1f layers/s), %s errors, last id %s' % (
+                written, written / elapsed if elapsed else 0, len(errors), last_id))
+            if report:
+                report(written, errors, elapsed, last_id)
+    except:
+        if index_names:
+            delete_indices(index_names.values())
+        raise
+    finally:
+        writer_pool.close()
+        writer_pool.join()
+        if process_pool:
+            process_pool.terminate()
+            process_pool.join()
+
+    if index_names:
+        swap_catalog_indices(index_names)
+
+    return written, errors
@@ -0,0 +1,91 @@
+"""
+Shared HTTP transport for the search backend.
+
+All the requests to Solr, Elasticsearch and remote catalogs go through one
+requests.Session per process, keeping connections alive in a pool, with a
+default timeout and retries with exponential backoff. Sessions are not shared
+with forked processes (celery and reindex workers), each process creates its
+own one.
+"""
+
+import os
+import threading
+
+import pysolr
+import requests
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# connections kept alive per host
+REGISTRY_SEARCH_POOL_SIZE = getattr(settings, 'REGISTRY_SEARCH_POOL_SIZE', 10)
+# seconds before a search backend request times out
+REGISTRY_SEARCH_TIMEOUT = getattr(settings, 'REGISTRY_SEARCH_TIMEOUT', 30)
+# retries of failed connections, and of idempotent requests answered with 502, 503 or 504
+REGISTRY_SEARCH_RETRIES = getattr(settings, 'REGISTRY_SEARCH_RETRIES', 3)
+REGISTRY_SEARCH_BACKOFF = getattr(settings, 'REGISTRY_SEARCH_BACKOFF', 0.1)
+
+_local = {}
+_lock = threading.Lock()
+
+
+def create_session():
+    session = requests.Session()
+    retry = Retry(
+        total=REGISTRY_SEARCH_RETRIES,
+        backoff_factor=REGISTRY_SEARCH_BACKOFF,
+        status_forcelist=(502, 503, 504)
+    )
+    adapter = HTTPAdapter(pool_maxsize=REGISTRY_SEARCH_POOL_SIZE, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Return the session of the current process.
+    """
+    pid = os.getpid()
+    with _lock:
+        if _local.get('pid') != pid:
+            _local.clear()
+            _local.update(pid=pid, session=create_session(), solr={})
+        return _local['session']
+
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', REGISTRY_SEARCH_TIMEOUT)
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    kwargs.setdefault('timeout', REGISTRY_SEARCH_TIMEOUT)
+    return get_session().post(url, **kwargs)
+
+
+def get_solr(url, timeout=60):
+    """
+    Return a pysolr client for a Solr core, using the session of the current process.
+    """
+    session = get_session()
+    with _lock:
+        solr = _local['solr'].get((url, timeout))
+        if solr is None:
+            solr = pysolr.Solr(url, timeout=timeout)
+            solr.session = session
+            _local['solr'][(url, timeout)] = solr
+        return solr
+
+
+def get_elasticsearch_options():
+    """
+    Options of the elasticsearch-py client, which keeps its own connection pool.
+    """
+    return {
+        'maxsize': REGISTRY_SEARCH_POOL_SIZE,
+        'timeout': REGISTRY_SEARCH_TIMEOUT,
+        'max_retries': REGISTRY_SEARCH_RETRIES,
+        'retry_on_timeout': True,
+    }
@@ -1,14 +1,16 @@
 import sys
-import pysolr
-import requests
 import logging
 import json
 
 from django.conf import settings
 
-from hypermap.aggregator.utils import layer2dict
+from hypermap.aggregator import search_transport, time_bounds
+from hypermap.search_api import cache as search_cache
+from hypermap.aggregator.utils import layer2dict, prefetch_layers
 
 SEARCH_URL = settings.REGISTRY_SEARCH_URL.split('+')[1]
+# the Solr core of the layers, also the name of its time bounds
+SOLR_CORE_URL = '%s/solr/hypermap' % SEARCH_URL
 
 
 LOGGER = logging.getLogger(__name__)
@@ -25,7 +27,7 @@ class SolrHypermap(object):
         layers_success_ids = []
         layers_errors_ids = []
 
-        for layer in layers:
+        for layer in prefetch_layers(layers):
             layer_dict, message = layer2dict(layer)
             if not layer_dict:
                 layers_errors_ids.append([layer.id, message])
@@ -39,7 +41,8 @@ class SolrHypermap(object):
             url_solr_update = '%s/solr/hypermap/update/json/docs' % SEARCH_URL
             headers = {"content-type": "application/json"}
             params = {"commitWithin": 1500}
-            requests.post(url_solr_update, data=layers_json, params=params, headers=headers)
+            search_transport.post(url_solr_update, data=layers_json, params=params, headers=headers)
+            time_bounds.widen(SOLR_CORE_URL, [doc.get('layer_date') for doc in layers_dict_list])
             LOGGER.info('Solr synced for the given layers')
         except Exception:
             message = "Error saving solr records: %s" % sys.exc_info()[1]
@@ -65,11 +68,13 @@ class SolrHypermap(object):
                 url_solr_update = '%s/solr/hypermap/update/json/docs' % SEARCH_URL
                 headers = {"content-type": "application/json"}
                 params = {"commitWithin": 1500}
-                res = requests.post(url_solr_update, data=layer_json, params=params,  headers=headers)
+                res = search_transport.post(url_solr_update, data=layer_json, params=params,  headers=headers)
                 res = res.json()
                 if 'error' in res:
                     success = False
                     message = "Error syncing layer id %s to Solr: %s" % (layer.id, res["error"].get("msg"))
+                else:
+                    time_bounds.widen(SOLR_CORE_URL, [layer_dict.get('layer_date')])
             except Exception, e:
                 success = False
                 message = "Error syncing layer id %s to Solr: %s" % (layer.id, sys.exc_info()[1])
@@ -83,8 +88,10 @@ class SolrHypermap(object):
     def clear_solr(self, catalog="hypermap"):
         """Clear all indexes in the solr core"""
         solr_url = "{0}/solr/{1}".format(SEARCH_URL, catalog)
-        solr = pysolr.Solr(solr_url, timeout=60)
+        solr = search_transport.get_solr(solr_url, timeout=60)
         solr.delete(q='*:*')
+        time_bounds.reset(solr_url)
+        search_cache.invalidate()
         LOGGER.debug('Solr core cleared')
 
     def remove_layer(self, layer_uiid, catalog="hypermap"):
@@ -92,10 +99,21 @@ class SolrHypermap(object):
         Remove a layer from Solr.
         """
         solr_url = "{0}/solr/{1}".format(SEARCH_URL, catalog)
-        solr = pysolr.Solr(solr_url, timeout=60)
+        solr = search_transport.get_solr(solr_url, timeout=60)
         solr.delete(q='uuid:%s' % layer_uiid)
         LOGGER.debug('Layer %s removed from Solr' % layer_uiid)
 
+    def remove_layers(self, layer_uuids, catalog="hypermap"):
+        """
+        Remove layers from Solr with a single delete by query.
+        """
+        if not layer_uuids:
+            return
+        solr_url = "{0}/solr/{1}".format(SEARCH_URL, catalog)
+        solr = search_transport.get_solr(solr_url, timeout=60)
+        solr.delete(q='uuid:(%s)' % ' OR '.join('"%s"' % layer_uuid for layer_uuid in layer_uuids))
+        LOGGER.debug('%s layers removed from Solr' % len(layer_uuids))
+
     def update_schema(self, catalog="hypermap"):
         """
         set the mapping in solr.
@@ -117,7 +135,7 @@ class SolrHypermap(object):
                 "distanceUnits": "degrees"
             }
         }
-        requests.post(schema_url, json=location_rpt_quad_5m_payload)
+        search_transport.post(schema_url, json=location_rpt_quad_5m_payload)
 
         # now the other fields
         fields = [
@@ -164,4 +182,4 @@ class SolrHypermap(object):
             data = {
                 "add-field": field
             }
-            requests.post(schema_url, json=data, headers=headers)
+            search_transport.post(schema_url, json=data, headers=headers)
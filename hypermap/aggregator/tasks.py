@@ -6,7 +6,9 @@ from celery import shared_task, states
 from celery.exceptions import Ignore
 
 from django.conf import settings
-from django.core.cache import cache
+
+from hypermap.aggregator import index_queue
+from hypermap.search_api import cache as search_cache
 
 
 LOGGER = logging.getLogger(__name__)
@@ -24,6 +26,9 @@ else:
     SEARCH_URL = REGISTRY_SEARCH_URL.split('+')[1]
 
 
+# service fields needed by the harvester
+HARVEST_FIELDS = ('id', 'type', 'url', 'capabilities_etag', 'capabilities_last_modified', 'capabilities_hash')
+
 if REGISTRY_LIMIT_LAYERS > 0:
     DEBUG_SERVICES = True
     DEBUG_LAYERS_NUMBER = REGISTRY_LIMIT_LAYERS
@@ -34,29 +39,129 @@ else:
 
 @shared_task(bind=True)
 def check_all_services(self):
+    """
+    Check all the active services, in batches of services with their remote hosts interleaved.
+    """
+    from hypermap.aggregator.models import Service
+    from hypermap.aggregator.harvest import batch_by_host
+    service_to_processes = Service.objects.filter(active=True).values_list('id', 'type', 'url')
+    for batch in batch_by_host(list(service_to_processes)):
+        service_ids = [service[0] for service in batch]
+        if not settings.REGISTRY_SKIP_CELERY:
+            check_services.delay(service_ids)
+        else:
+            check_services(service_ids)
+
+
+@shared_task(bind=True)
+def check_due_resources(self):
+    """
+    Check the services and layers whose next check is due, within the checks budget.
+    Services are checked in batches with their remote hosts interleaved, without their layers
+    which are scheduled on their own.
+    """
+    from hypermap.aggregator.models import Service
+    from hypermap.aggregator.harvest import batch_by_host
+    from hypermap.aggregator.check_scheduler import claim_due_resources
+    service_ids, layer_ids = claim_due_resources()
+    services = Service.objects.filter(id__in=service_ids).values_list('id', 'type', 'url')
+    for batch in batch_by_host(list(services)):
+        batch_ids = [service[0] for service in batch]
+        if not settings.REGISTRY_SKIP_CELERY:
+            check_services.delay(batch_ids, check_layers=False)
+        else:
+            check_services(batch_ids, check_layers=False)
+    for layer_id in layer_ids:
+        if not settings.REGISTRY_SKIP_CELERY:
+            check_layer.delay(layer_id)
+        else:
+            check_layer(layer_id)
+    LOGGER.debug('Checking %s due services and %s due layers' % (len(service_ids), len(layer_ids)))
+
+
+@shared_task(bind=True)
+def check_services(self, service_ids, check_layers=True):
+    """
+    Check a batch of services: capabilities are fetched concurrently, then each service is processed.
+    Returns a report with the number of services whose capabilities did not change,
+    and of added, updated and skipped layers.
+    """
     from hypermap.aggregator.models import Service
-    service_to_processes = Service.objects.filter(active=True)
-    for service in service_to_processes:
-        check_service.delay(service.id)
+    from hypermap.aggregator.harvest import fetch_all_capabilities
+    services = Service.objects.filter(id__in=service_ids)
+    capabilities = fetch_all_capabilities(services.values_list(*HARVEST_FIELDS))
+
+    report = {'services': 0, 'unchanged_services': 0, 'added': 0, 'updated': 0, 'skipped': 0}
+    for service in services:
+        service_report = process_service(service, capabilities.get(service.id), check_layers)
+        report['services'] += 1
+        if service_report is not None:
+            if service_report['unchanged']:
+                report['unchanged_services'] += 1
+            for key in ('added', 'updated', 'skipped'):
+                report[key] += service_report[key]
+    LOGGER.info('Checked %s services, %s unchanged: %s layers added, %s updated, %s skipped' % (
+        report['services'], report['unchanged_services'], report['added'], report['updated'], report['skipped']))
+    return report
 
 
 @shared_task(bind=True)
 def check_service(self, service_id):
     from hypermap.aggregator.models import Service
+    from hypermap.aggregator.harvest import fetch_capabilities
     service = Service.objects.get(pk=service_id)
+    capabilities = fetch_capabilities([getattr(service, field) for field in HARVEST_FIELDS])
+    return process_service(service, capabilities)
+
+
+def process_service(service, capabilities=None, check_layers=True):
+    """
+    Update layers, check and index a service, using its already fetched capabilities if available.
+    Returns a report with the number of added, updated and skipped layers if they were harvested.
+    """
+    from django.utils import timezone
+    from hypermap.aggregator.models import Service
+    from hypermap.aggregator.check_scheduler import record_capabilities
+    from hypermap.aggregator.host_governor import HostBusyError
+
+    if capabilities is not None and isinstance(capabilities.error, HostBusyError):
+        # the host is rate limited, the service is not checked and is due again at the next poll
+        LOGGER.debug('Not checking service id %s: %s' % (service.id, capabilities.error))
+        Service.objects.filter(id=service.id).update(next_check=timezone.now())
+        return None
 
     # 1. update layers and check service
+    report = None
+    if capabilities is not None and capabilities.success:
+        record_capabilities(service.id, capabilities.changed)
     if getattr(settings, 'REGISTRY_HARVEST_SERVICES', True):
-        service.update_layers()
+        store_validators = False
+        if capabilities is not None and capabilities.success and not capabilities.changed:
+            LOGGER.debug('Not updating layers for service id %s as its capabilities did not change' % service.id)
+            report = {'unchanged': True, 'added': 0, 'updated': 0, 'skipped': service.layer_set.count()}
+            # the server may send new validators (ETag, Last-Modified) for the same document
+            store_validators = True
+        else:
+            layers_report = service.update_layers(capabilities)
+            if layers_report is not None:
+                report = dict(layers_report, unchanged=False)
+                # the harvest succeeded, store the validators of the document for the next one
+                store_validators = True
+        if store_validators and capabilities is not None and capabilities.fetched:
+            Service.objects.filter(id=service.id).update(
+                capabilities_etag=capabilities.etag,
+                capabilities_last_modified=capabilities.last_modified,
+                capabilities_hash=capabilities.content_hash
+            )
 
     layer_to_process = service.layer_set.all()
     if DEBUG_SERVICES:
         layer_to_process = layer_to_process[0:DEBUG_LAYERS_NUMBER]
 
-    service.check_available()
+    service.check_available(capabilities)
 
     # 2. check layers if the service is monitored and the layer is monitored
-    if service.is_monitored:
+    if check_layers and service.is_monitored:
         for layer in layer_to_process:
             if layer.is_monitored:
                 if not settings.REGISTRY_SKIP_CELERY:
@@ -71,11 +176,33 @@ def check_service(self, service_id):
         else:
             index_service(service.id)
 
+    return report
+
 
 @shared_task(bind=True, soft_time_limit=10)
 def check_layer(self, layer_id):
-    from hypermap.aggregator.models import Layer
+    from django.utils import timezone
+    from hypermap.aggregator import host_governor
+    from hypermap.aggregator.harvest import get_host
+    from hypermap.aggregator.models import Layer, Check
     layer = Layer.objects.get(pk=layer_id)
+    host = get_host(layer.url)
+    if host_governor.is_open(host):
+        # the host keeps failing, the check fails without waiting for the request to time out
+        LOGGER.debug('Not checking layer %s, the circuit of %s is open' % (layer.name, host))
+        Check.objects.create(content_object=layer, success=False, response_time=0,
+                             message=str(host_governor.CircuitOpenError(host)))
+        return
+    if not host_governor.acquire(host):
+        max_retries = host_governor.REGISTRY_HOST_MAX_RETRIES
+        if not settings.REGISTRY_SKIP_CELERY and self.request.retries < max_retries:
+            # the host is busy, retry the check later instead of waiting in the worker
+            raise self.retry(countdown=host_governor.get_backoff(host, self.request.retries),
+                             max_retries=max_retries)
+        # a busy host is not a failing one: the layer is not checked and is due again at the next poll
+        LOGGER.debug('Not checking layer %s: %s' % (layer.name, host_governor.HostBusyError(host)))
+        Layer.objects.filter(id=layer.id).update(next_check=timezone.now())
+        return
     LOGGER.debug('Checking layer %s' % layer.name)
     success, message = layer.check_available()
     # every time a layer is checked it should be indexed
@@ -90,102 +217,70 @@ def check_layer(self, layer_id):
 @shared_task(bind=True)
 def index_cached_layers(self):
     """
-    Index and unindex all layers in the Django cache (Index all layers who have been checked).
+    Index and unindex all layers in the index queue (Index all layers who have been checked).
     """
     from hypermap.aggregator.models import Layer
+    from hypermap.search_api import engines
 
-    if SEARCH_TYPE == 'solr':
-        from hypermap.aggregator.solr import SolrHypermap
-        solrobject = SolrHypermap()
-    else:
-        from hypermap.aggregator.elasticsearch_client import ESHypermap
-        from elasticsearch import helpers
-        es_client = ESHypermap()
-
-    layers_cache = cache.get('layers')
-    deleted_layers_cache = cache.get('deleted_layers')
-
-    # 1. added layers cache
-    if layers_cache:
-        layers_list = list(layers_cache)
-        LOGGER.debug('There are %s layers in cache: %s' % (len(layers_list), layers_list))
-
-        batch_size = settings.REGISTRY_SEARCH_BATCH_SIZE
-        batch_lists = [layers_list[i:i+batch_size] for i in range(0, len(layers_list), batch_size)]
-
-        for batch_list_ids in batch_lists:
-            layers = Layer.objects.filter(id__in=batch_list_ids)
-
-            if batch_size > len(layers):
-                batch_size = len(layers)
-
-            LOGGER.debug('Syncing %s/%s layers to %s: %s' % (batch_size, len(layers_cache), layers, SEARCH_TYPE))
-
-            try:
-                # SOLR
-                if SEARCH_TYPE == 'solr':
-                    success, layers_errors_ids = solrobject.layers_to_solr(layers)
-                    if success:
-                        # remove layers from cache here
-                        layers_cache = layers_cache.difference(set(batch_list_ids))
-                        LOGGER.debug('Removing layers with id %s from cache' % batch_list_ids)
-                        cache.set('layers', layers_cache)
-                # ES
-                elif SEARCH_TYPE == 'elasticsearch':
-                    with_bulk, success = True, False
-                    layers_to_index = [es_client.layer_to_es(layer, with_bulk) for layer in layers]
-                    message = helpers.bulk(es_client.es, layers_to_index)
-
-                    # Check that all layers where indexed...if not, don't clear cache.
-                    # TODO: Check why es does not index all layers at first.
-                    len_indexed_layers = message[0]
-                    if len_indexed_layers == len(layers):
-                        LOGGER.debug('%d layers indexed successfully' % (len_indexed_layers))
-                        success = True
-                    if success:
-                        # remove layers from cache here
-                        layers_cache = layers_cache.difference(set(batch_list_ids))
-                        cache.set('layers', layers_cache)
-                else:
-                    raise Exception("Incorrect SEARCH_TYPE=%s" % SEARCH_TYPE)
-            except Exception as e:
-                LOGGER.error('Layers were NOT indexed correctly')
-                LOGGER.error(e, exc_info=True)
-    else:
-        LOGGER.debug('No cached layers to add in search engine.')
-
-    # 2. deleted layers cache
-    if deleted_layers_cache:
-        layers_list = list(deleted_layers_cache)
-        LOGGER.debug('There are %s layers in cache for deleting: %s' % (len(layers_list), layers_list))
-        # TODO implement me: batch layer index deletion
-        for layer_id in layers_list:
-            # SOLR
-            if SEARCH_TYPE == 'solr':
-                if Layer.objects.filter(pk=layer_id).exists():
-                    layer = Layer.objects.get(id=layer_id)
-                    unindex_layer(layer.id, use_cache=False)
-                    deleted_layers_cache = deleted_layers_cache.difference(set([layer_id]))
-                    cache.set('deleted_layers', deleted_layers_cache)
+    batch_size = settings.REGISTRY_SEARCH_BATCH_SIZE
+    # catalogs whose index changed
+    catalog_slugs = set()
+
+    # 1. layers to add
+    LOGGER.debug('There are %s layers in the index queue' % index_queue.size('index'))
+    while True:
+        items = index_queue.dequeue_batch(batch_size, 'index')
+        if not items:
+            break
+        batch_list_ids = [item.layer_id for item in items]
+        layers = Layer.objects.filter(id__in=batch_list_ids)
+
+        LOGGER.debug('Syncing %s layers to %s: %s' % (len(items), SEARCH_TYPE, batch_list_ids))
+
+        try:
+            success, layers_errors = engines.get_engine(SEARCH_TYPE).index_layers(layers)
+            if success:
+                LOGGER.debug('Removing layers with id %s from the index queue' % batch_list_ids)
+                index_queue.ack(items)
+                catalog_slugs.update(layers.values_list('catalog__slug', flat=True))
             else:
-                # TODO implement me
-                raise NotImplementedError
-    else:
-        LOGGER.debug('No cached layers to remove in search engine.')
+                index_queue.nack(items, layers_errors)
+        except Exception as e:
+            LOGGER.error('Layers were NOT indexed correctly')
+            LOGGER.error(e, exc_info=True)
+            index_queue.nack(items, e)
+
+    # 2. layers to remove
+    LOGGER.debug('There are %s layers in the index queue for deleting' % index_queue.size('unindex'))
+    while True:
+        items = index_queue.dequeue_batch(batch_size, 'unindex')
+        if not items:
+            break
+        # layers deleted from the database in the meantime are just removed from the queue
+        layers = list(Layer.objects.filter(id__in=[item.layer_id for item in items]).select_related('catalog'))
+
+        LOGGER.debug('Removing %s layers from %s' % (len(layers), SEARCH_TYPE))
+
+        try:
+            if layers:
+                engines.get_engine(SEARCH_TYPE).remove_layers(layers)
+            index_queue.ack(items)
+            catalog_slugs.update(layer.catalog.slug for layer in layers)
+        except Exception as e:
+            LOGGER.error('Layers were NOT removed correctly')
+            LOGGER.error(e, exc_info=True)
+            index_queue.nack(items, e)
+
+    if catalog_slugs:
+        search_cache.invalidate(catalog_slugs)
 
 
 @shared_task(name="clear_index")
 def clear_index():
-    if SEARCH_TYPE == 'solr':
-        LOGGER.debug('Clearing the solr indexes')
-        from hypermap.aggregator.solr import SolrHypermap
-        solrobject = SolrHypermap()
-        solrobject.clear_solr()
-    elif SEARCH_TYPE == 'elasticsearch':
-        LOGGER.debug('Clearing the ES indexes')
-        from hypermap.aggregator.elasticsearch_client import ESHypermap
-        esobject = ESHypermap()
-        esobject.clear_es()
+    from hypermap.search_api import engines
+
+    if SEARCH_ENABLED:
+        engines.get_engine(SEARCH_TYPE).clear()
 
 
 @shared_task(bind=True)
@@ -193,13 +288,29 @@ def remove_service_checks(self, service_id):
     """
     Remove all checks from a service.
     """
-    from hypermap.aggregator.models import Service
+    from hypermap.aggregator import check_stats
+    from hypermap.aggregator.models import Layer, Service
     service = Service.objects.get(id=service_id)
 
     service.check_set.all().delete()
+    service.check_rollup_set.all().delete()
+    check_stats.reset(Service, [service.id])
     layer_to_process = service.layer_set.all()
     for layer in layer_to_process:
         layer.check_set.all().delete()
+        layer.check_rollup_set.all().delete()
+    check_stats.reset(Layer, [layer.id for layer in layer_to_process])
+
+
+@shared_task(bind=True)
+def rollup_checks(self):
+    """
+    Roll up the checks older than the retention period into hourly and daily rollups.
+    """
+    from hypermap.aggregator import check_history
+    hourly_checks, daily_checks = check_history.rollup_checks()
+    LOGGER.info('Rolled up %s checks into hourly rollups and %s into daily rollups' % (
+        hourly_checks, daily_checks))
 
 
 @shared_task(bind=True)
@@ -234,6 +345,7 @@ def index_layer(self, layer_id, use_cache=False):
     """
 
     from hypermap.aggregator.models import Layer
+    from hypermap.search_api import engines
     layer = Layer.objects.get(id=layer_id)
 
     if not layer.is_valid:
@@ -248,36 +360,13 @@ def index_layer(self, layer_id, use_cache=False):
 
     # 1. if we use cache
     if use_cache:
-        LOGGER.debug('Caching layer with id %s for syncing with search engine' % layer.id)
-        layers = cache.get('layers')
-        if layers is None:
-            layers = set([layer.id])
-        else:
-            layers.add(layer.id)
-        cache.set('layers', layers)
+        LOGGER.debug('Queueing layer with id %s for syncing with search engine' % layer.id)
+        index_queue.enqueue([layer.id], 'index')
         return
 
     # 2. if we don't use cache
-    # TODO: Make this function more DRY
-    # by abstracting the common bits.
-    if SEARCH_TYPE == 'solr':
-        from hypermap.aggregator.solr import SolrHypermap
-        LOGGER.debug('Syncing layer %s to solr' % layer.name)
-        solrobject = SolrHypermap()
-        success, message = solrobject.layer_to_solr(layer)
-        # update the error message if using celery
-        if not settings.REGISTRY_SKIP_CELERY:
-            if not success:
-                self.update_state(
-                    state=states.FAILURE,
-                    meta=message
-                    )
-                raise Ignore()
-    elif SEARCH_TYPE == 'elasticsearch':
-        from hypermap.aggregator.elasticsearch_client import ESHypermap
-        LOGGER.debug('Syncing layer %s to es' % layer.name)
-        esobject = ESHypermap()
-        success, message = esobject.layer_to_es(layer)
+    if SEARCH_ENABLED:
+        success, message = engines.get_engine(SEARCH_TYPE).index_layer(layer)
         # update the error message if using celery
         if not settings.REGISTRY_SKIP_CELERY:
             if not success:
@@ -287,6 +376,8 @@ def index_layer(self, layer_id, use_cache=False):
                     )
                 raise Ignore()
 
+    search_cache.invalidate([layer.catalog.slug])
+
 
 @shared_task(bind=True)
 def unindex_layers_with_issues(self, use_cache=False):
@@ -315,29 +406,20 @@ def unindex_layer(self, layer_id, use_cache=False):
     """
 
     from hypermap.aggregator.models import Layer
+    from hypermap.search_api import engines
     layer = Layer.objects.get(id=layer_id)
 
     if use_cache:
-        LOGGER.debug('Caching layer with id %s for being removed from search engine' % layer.id)
-        deleted_layers = cache.get('deleted_layers')
-        if deleted_layers is None:
-            deleted_layers = set([layer.id])
-        else:
-            deleted_layers.add(layer.id)
-        cache.set('deleted_layers', deleted_layers)
+        LOGGER.debug('Queueing layer with id %s for being removed from search engine' % layer.id)
+        index_queue.enqueue([layer.id], 'unindex')
         return
 
-    if SEARCH_TYPE == 'solr':
-        from hypermap.aggregator.solr import SolrHypermap
-        LOGGER.debug('Removing layer %s from solr' % layer.id)
+    if SEARCH_ENABLED:
         try:
-            solrobject = SolrHypermap()
-            solrobject.remove_layer(layer.uuid)
+            engines.get_engine(SEARCH_TYPE).remove_layer(layer)
         except Exception:
-            LOGGER.error('Layer NOT correctly removed from Solr')
-    elif SEARCH_TYPE == 'elasticsearch':
-        # TODO implement me
-        pass
+            LOGGER.error('Layer NOT correctly removed from %s' % SEARCH_TYPE)
+    search_cache.invalidate([layer.catalog.slug])
 
 
 @shared_task(bind=True)
@@ -348,13 +430,11 @@ def index_all_layers(self):
     from hypermap.aggregator.models import Layer
 
     if not settings.REGISTRY_SKIP_CELERY:
-        layers_cache = set(Layer.objects.filter(is_valid=True).values_list('id', flat=True))
-        deleted_layers_cache = set(Layer.objects.filter(is_valid=False).values_list('id', flat=True))
-        cache.set('layers', layers_cache)
-        cache.set('deleted_layers', deleted_layers_cache)
+        index_queue.enqueue(Layer.objects.filter(is_valid=True).values_list('id', flat=True), 'index')
+        index_queue.enqueue(Layer.objects.filter(is_valid=False).values_list('id', flat=True), 'unindex')
     else:
-        for layer in Layer.objects.all():
-            index_layer(layer.id)
+        for layer_id in Layer.objects.values_list('id', flat=True).iterator():
+            index_layer(layer_id)
 
 
 @shared_task(bind=True)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the capabilities cache.
+"""
+
+import shutil
+import tempfile
+import time
+import unittest
+
+from httmock import HTTMock, urlmatch
+import mocks.wms
+
+from hypermap.aggregator.capabilities_cache import CapabilitiesCache
+from hypermap.aggregator.harvest import get_capabilities
+from hypermap.aggregator.lru import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_maxsize(self):
+        lru = LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        # a is now the most recently used item
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(len(lru), 2)
+
+    def test_timeout(self):
+        lru = LRUCache(maxsize=2, timeout=60)
+        lru.set('a', 1)
+        lru.set('b', 2, timeout=-1)
+        self.assertTrue('a' in lru)
+        self.assertFalse('b' in lru)
+
+
+class TestCapabilitiesCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.requests = []
+
+        @urlmatch(netloc=mocks.wms.NETLOC, method=mocks.wms.GET)
+        def counting_get(url, request):
+            self.requests.append(request.url)
+            return mocks.wms.resource_get(url, request)
+
+        self.mock = counting_get
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory_and_disk_tiers(self):
+        url = 'http://wms.example.com/ows130?'
+        with HTTMock(self.mock):
+            wms = get_capabilities('OGC:WMS', url)
+        self.assertEqual(len(self.requests), 1)
+
+        cache = CapabilitiesCache(timeout=60, maxsize=5, directory=self.directory)
+        cache.set(url, 'OGC:WMS', wms)
+        self.assertTrue(cache.get(url, 'OGC:WMS') is wms)
+        self.assertEqual(cache.get(url, 'OGC:WMTS'), None)
+
+        # another process reads the document from disk, without requests
+        other_cache = CapabilitiesCache(timeout=60, maxsize=5, directory=self.directory)
+        with HTTMock(self.mock):
+            cached_wms = other_cache.get(url, 'OGC:WMS')
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(cached_wms.version, wms.version)
+        self.assertEqual(sorted(cached_wms.contents), sorted(wms.contents))
+
+    def test_expiration(self):
+        url = 'http://wms.example.com/ows130?'
+        with HTTMock(self.mock):
+            wms = get_capabilities('OGC:WMS', url)
+        cache = CapabilitiesCache(timeout=0.01, maxsize=5, directory=self.directory)
+        cache.set(url, 'OGC:WMS', wms)
+        time.sleep(0.05)
+        self.assertEqual(cache.get(url, 'OGC:WMS'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the retention and the rollups of the checks.
+"""
+
+import datetime
+import unittest
+
+from django.utils import timezone
+
+from hypermap.aggregator import check_history
+from hypermap.aggregator.models import Service, Catalog, Check
+
+
+class TestCheckHistory(unittest.TestCase):
+
+    def setUp(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.service = Service(
+            type='OGC:WMS',
+            url='http://check-history.example.com/ows?',
+            catalog=catalog,
+            is_monitored=False
+        )
+        self.service.save()
+        self.addCleanup(self.service.delete)
+        self.now = timezone.now().replace(hour=12, minute=30, second=0, microsecond=0)
+
+    def add_check(self, success, response_time, checked_datetime):
+        check = Check.objects.create(content_object=self.service, success=success, response_time=response_time)
+        Check.objects.filter(id=check.id).update(checked_datetime=checked_datetime)
+
+    def test_rollup_checks(self):
+        old_hour = self.now - datetime.timedelta(days=check_history.REGISTRY_CHECK_RETENTION_DAYS, hours=3)
+        old_hour = old_hour.replace(minute=0)
+        self.add_check(True, 0.2, old_hour + datetime.timedelta(minutes=5))
+        self.add_check(False, 3.0, old_hour + datetime.timedelta(minutes=50))
+        self.add_check(True, 0.4, old_hour + datetime.timedelta(hours=1))
+        self.add_check(True, 0.1, self.now)
+
+        self.assertEqual(check_history.rollup_checks(self.now), (3, 0))
+
+        # recent checks are kept, older ones are rolled up by hour
+        self.assertEqual(list(self.service.check_set.values_list('response_time', flat=True)), [0.1])
+        rollups = list(self.service.check_rollup_set.order_by('start_datetime'))
+        self.assertEqual([(rollup.period, rollup.start_datetime) for rollup in rollups],
+                         [('hour', old_hour), ('hour', old_hour + datetime.timedelta(hours=1))])
+        self.assertEqual((rollups[0].checks_count, rollups[0].success_checks_count), (2, 1))
+        self.assertEqual((rollups[0].min_response_time, rollups[0].max_response_time), (0.2, 3.0))
+        self.assertAlmostEqual(rollups[0].average_response_time, 1.6)
+        self.assertEqual(rollups[0].reliability, 50.0)
+
+        # statistics still count the rolled up checks
+        service = Service.objects.get(id=self.service.id)
+        self.assertEqual((service.checks_count, service.success_checks_count), (4, 3))
+
+        # a second run has nothing to roll up
+        self.assertEqual(check_history.rollup_checks(self.now), (0, 0))
+
+        # hourly rollups are rolled up by day
+        later = self.now + datetime.timedelta(days=check_history.REGISTRY_CHECK_HOURLY_RETENTION_DAYS)
+        check_history.rollup_checks(later)
+        rollups = list(self.service.check_rollup_set.all())
+        self.assertEqual([(rollup.period, rollup.start_datetime) for rollup in rollups[1:]],
+                         [('day', old_hour.replace(hour=0))])
+        self.assertEqual((rollups[1].checks_count, rollups[1].success_checks_count), (3, 2))
+        self.assertEqual((rollups[1].min_response_time, rollups[1].max_response_time), (0.2, 3.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
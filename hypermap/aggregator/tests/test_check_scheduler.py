@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the adaptive scheduling of the checks.
+"""
+
+import datetime
+import unittest
+
+from django.utils import timezone
+
+from hypermap.aggregator import check_scheduler
+from hypermap.aggregator.models import Service, Catalog
+
+
+class TestCheckScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.settings = (check_scheduler.REGISTRY_CHECK_JITTER, check_scheduler.REGISTRY_CHECK_MIN_PERIOD,
+                         check_scheduler.REGISTRY_CHECK_MAX_PERIOD)
+        check_scheduler.REGISTRY_CHECK_JITTER = 0
+        check_scheduler.REGISTRY_CHECK_MIN_PERIOD = 100
+        check_scheduler.REGISTRY_CHECK_MAX_PERIOD = check_scheduler.REGISTRY_CHECK_PERIOD * 3
+
+    def tearDown(self):
+        (check_scheduler.REGISTRY_CHECK_JITTER, check_scheduler.REGISTRY_CHECK_MIN_PERIOD,
+         check_scheduler.REGISTRY_CHECK_MAX_PERIOD) = self.settings
+
+    def interval(self, reliability, recent_checks_status='11', response_time=0, change_rate=0):
+        service = Service(checks_count=10, decayed_reliability=reliability, recent_checks_status=recent_checks_status,
+                          response_time_sum=response_time * 10, capabilities_change_rate=change_rate)
+        return check_scheduler.get_check_interval(service)
+
+    def test_check_interval(self):
+        period = check_scheduler.REGISTRY_CHECK_PERIOD
+        self.assertEqual(check_scheduler.get_check_interval(Service()), check_scheduler.REGISTRY_CHECK_MIN_PERIOD)
+
+        # stable resources are checked less often than flapping ones
+        self.assertEqual(self.interval(100), period * 2)
+        self.assertEqual(self.interval(0, '00'), period * 2)
+        self.assertEqual(self.interval(50), period / 2.0)
+        self.assertEqual(self.interval(50, '01'), period / 4.0)
+
+        # changing services more often, slow resources less often
+        self.assertEqual(self.interval(100, change_rate=1), period / 2.0)
+        self.assertEqual(self.interval(100, response_time=15), period * 3)
+
+        # within the bounds
+        self.assertEqual(self.interval(100, response_time=60), check_scheduler.REGISTRY_CHECK_MAX_PERIOD)
+        self.assertEqual(self.interval(50, '10', change_rate=1), check_scheduler.REGISTRY_CHECK_MIN_PERIOD)
+
+    def test_claim_due(self):
+        now = timezone.now()
+        services = []
+        for i in range(3):
+            service = Service(type='OGC:WMS', url='http://%s.check-scheduler.example.com/ows?' % i,
+                              catalog=self.catalog, is_monitored=False)
+            service.save()
+            self.addCleanup(service.delete)
+            services.append(service)
+        Service.objects.filter(id=services[1].id).update(
+            next_check=now - datetime.timedelta(minutes=5), checks_count=1, decayed_reliability=100,
+            recent_checks_status='1')
+        Service.objects.filter(id=services[2].id).update(next_check=now + datetime.timedelta(minutes=5))
+        Service.objects.filter(id=services[0].id).update(check_priority=1)
+        queryset = Service.objects.filter(id__in=[due.id for due in services])
+
+        # never checked services first, then the due ones, within the limit
+        self.assertEqual(check_scheduler.claim_due(queryset, 1, now), [services[0].id])
+        self.assertEqual(check_scheduler.claim_due(queryset, 5, now), [services[1].id])
+        self.assertEqual(check_scheduler.claim_due(queryset, 5, now), [])
+
+        next_checks = dict(queryset.values_list('id', 'next_check'))
+        self.assertEqual(next_checks[services[0].id],
+                         now + datetime.timedelta(minutes=check_scheduler.REGISTRY_CHECK_MIN_PERIOD))
+        self.assertEqual(next_checks[services[1].id],
+                         now + datetime.timedelta(minutes=check_scheduler.REGISTRY_CHECK_PERIOD * 2))
+
+        # the next check of a service can be set
+        services[1].next_check = now
+        services[1].save()
+        self.assertEqual(check_scheduler.claim_due(queryset, 5, now), [services[1].id])
+
+    def test_record_capabilities(self):
+        service = Service(type='OGC:WMS', url='http://check-scheduler.example.com/ows?',
+                          catalog=self.catalog, is_monitored=False)
+        service.save()
+        self.addCleanup(service.delete)
+        check_scheduler.record_capabilities(service.id, True)
+        check_scheduler.record_capabilities(service.id, False)
+        self.assertAlmostEqual(Service.objects.get(id=service.id).capabilities_change_rate,
+                               check_scheduler.CHANGE_RATE_DECAY * (1 - check_scheduler.CHANGE_RATE_DECAY))
+
+
+if __name__ == '__main__':
+    unittest.main()
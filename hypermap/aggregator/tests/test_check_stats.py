@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the check statistics of the resources.
+"""
+
+import unittest
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from hypermap.aggregator import check_stats
+from hypermap.aggregator.models import Service, Catalog, Layer, Check
+
+
+class TestCheckStats(unittest.TestCase):
+
+    def setUp(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.service = Service(
+            type='OGC:WMS',
+            url='http://check-stats.example.com/ows?',
+            catalog=catalog,
+            is_monitored=False
+        )
+        self.service.save()
+        self.addCleanup(self.service.delete)
+        Layer.objects.bulk_create([
+            Layer(name='stats', title='Stats', service=self.service, catalog=catalog,
+                  url=self.service.url, is_monitored=False)
+        ])
+        self.layer = Layer.objects.get(service=self.service)
+
+    def add_checks(self, resource, checks):
+        for success, response_time in checks:
+            Check.objects.create(content_object=resource, success=success, response_time=response_time)
+
+    def test_record_check(self):
+        stale_layer = Layer.objects.get(id=self.layer.id)
+        self.add_checks(self.layer, [(True, 0.2), (False, 3.0), (True, 0.05), (False, 40)])
+
+        # the statistics are stored on the resource
+        layer = Layer.objects.get(id=self.layer.id)
+        self.assertEqual(layer.checks_count, 4)
+        self.assertEqual(layer.success_checks_count, 2)
+        self.assertEqual(layer.reliability, 50.0)
+        self.assertEqual(layer.recent_checks_status, '01')
+        self.assertEqual(layer.recent_reliability, 50.0)
+        self.assertEqual(layer.last_status, False)
+        self.assertEqual((layer.min_response_time, layer.max_response_time), (0.05, 40))
+        self.assertAlmostEqual(layer.average_response_time, 43.25 / 4)
+        self.assertEqual([count for bound, count in layer.response_time_distribution], [1, 1, 0, 0, 0, 1, 0, 0, 1])
+        self.assertAlmostEqual(layer.decayed_reliability, ((100 * 0.9) * 0.9 + 10) * 0.9)
+        self.assertEqual(layer.first_checked, Check.objects.filter(object_id=layer.id).earliest(
+            'checked_datetime').checked_datetime)
+
+        # the first and last checks are read from the statistics, without a query
+        with CaptureQueriesContext(connection) as queries:
+            first_check, last_check = layer.first_check, layer.last_check
+        self.assertEqual(len(queries.captured_queries), 0)
+        self.assertEqual(first_check.checked_datetime, layer.first_checked)
+        self.assertEqual((last_check.checked_datetime, last_check.success), (layer.last_checked, False))
+
+        # saving an instance loaded before the checks does not overwrite them
+        stale_layer.title = 'Renamed'
+        stale_layer.save()
+        layer = Layer.objects.get(id=self.layer.id)
+        self.assertEqual((layer.title, layer.checks_count), ('Renamed', 4))
+
+        # a check runs a constant number of queries: insert, select and update of the resource
+        with CaptureQueriesContext(connection) as queries:
+            self.add_checks(layer, [(True, 0.1)])
+        statements = [query['sql'] for query in queries.captured_queries if 'BEGIN' not in query['sql']]
+        self.assertEqual(len(statements), 3)
+
+    def test_rebuild(self):
+        self.add_checks(self.service, [(True, 0.2), (False, 3.0), (True, 0.3)])
+        recorded = Service.objects.get(id=self.service.id)
+
+        Service.objects.filter(id=self.service.id).update(**check_stats.EMPTY_STATS)
+        check_stats.rebuild(Service, Check, ContentType.objects.get_for_model(Service).id)
+        rebuilt = Service.objects.get(id=self.service.id)
+        for name in check_stats.STATS_FIELDS:
+            if name != 'decayed_reliability':
+                self.assertEqual(getattr(rebuilt, name), getattr(recorded, name), name)
+        self.assertAlmostEqual(rebuilt.decayed_reliability, 200 / 3.0)
+
+        self.service.check_set.all().delete()
+        check_stats.reset(Service, [self.service.id])
+        service = Service.objects.get(id=self.service.id)
+        self.assertEqual((service.checks_count, service.reliability, service.last_status), (0, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
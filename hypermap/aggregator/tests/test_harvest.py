@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the concurrent capabilities harvester.
+"""
+
+import unittest
+
+from httmock import HTTMock, response, urlmatch
+import mocks.wms
+
+from hypermap.aggregator.harvest import batch_by_host, interleave, fetch_all_capabilities
+from hypermap.aggregator.models import Service, Catalog
+from hypermap.aggregator.tasks import check_services
+
+
+class TestHostBatching(unittest.TestCase):
+
+    def test_interleave(self):
+        services = [
+            (1, 'OGC:WMS', 'http://a.example.com/wms1'),
+            (2, 'OGC:WMS', 'http://a.example.com/wms2'),
+            (3, 'OGC:WMS', 'http://a.example.com/wms3'),
+            (4, 'OGC:WMS', 'http://b.example.com/wms'),
+            (5, 'OGC:WMS', 'http://c.example.com/wms'),
+        ]
+        ids = [service[0] for service in interleave(services)]
+        self.assertEqual(ids, [1, 4, 5, 2, 3])
+
+    def test_batch_by_host(self):
+        services = [(i, 'OGC:WMS', 'http://host%s.example.com/wms' % (i % 2)) for i in range(5)]
+        batches = batch_by_host(services, 2)
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        # each batch of two services hits two different hosts
+        for batch in batches[:2]:
+            self.assertEqual(len(set(service[2] for service in batch)), 2)
+
+
+class TestFetchCapabilities(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+
+        @urlmatch(netloc=mocks.wms.NETLOC, method=mocks.wms.GET)
+        def counting_get(url, request):
+            self.requests.append(request.url)
+            return mocks.wms.resource_get(url, request)
+
+        self.mock = counting_get
+
+    def test_fetch_all_capabilities(self):
+        services = [
+            (1, 'OGC:WMS', 'http://wms.example.com/ows111?'),
+            (2, 'OGC:WMS', 'http://wms.example.com/ows130?'),
+            (3, 'OGC:WMS', 'http://wms.example.com/missing?'),
+        ]
+        with HTTMock(self.mock):
+            capabilities = fetch_all_capabilities(services, max_workers=3, max_per_host=2)
+        self.assertEqual(sorted(capabilities.keys()), [1, 2, 3])
+        self.assertTrue(capabilities[1].success)
+        self.assertEqual(len(capabilities[1].ows.contents), 9)
+        self.assertTrue(capabilities[2].success)
+        self.assertFalse(capabilities[3].success)
+
+    def test_check_services_fetches_once(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        with HTTMock(self.mock):
+            service = Service(
+                type='OGC:WMS',
+                url='http://wms.example.com/ows111?',
+                catalog=catalog,
+                is_monitored=False
+            )
+            service.save()
+            self.addCleanup(service.delete)
+            self.requests = []
+            check_services([service.id])
+
+        # a single version negotiation (1.3.0, then 1.1.1) for updating layers and checking the service
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(service.layer_set.all().count(), 9)
+        self.assertEqual(service.check_set.filter(success=True).count(), 1)
+
+
+class TestIncrementalHarvest(unittest.TestCase):
+
+    def setUp(self):
+        self.statuses = []
+
+        @urlmatch(netloc=mocks.wms.NETLOC, method=mocks.wms.GET)
+        def etag_get(url, request):
+            if request.headers.get('If-None-Match') == '"ows130"':
+                self.statuses.append(304)
+                return response(304, '', {}, None, 5, request)
+            content = mocks.wms.resource_get(url, request)
+            content.headers['ETag'] = '"ows130"'
+            self.statuses.append(content.status_code)
+            return content
+
+        self.mock = etag_get
+
+    def test_check_services_incremental(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        with HTTMock(self.mock):
+            service = Service(
+                type='OGC:WMS',
+                url='http://wms.example.com/ows130?',
+                catalog=catalog,
+                is_monitored=False
+            )
+            service.save()
+            self.addCleanup(service.delete)
+
+            report = check_services([service.id])
+            self.assertEqual(report['unchanged_services'], 0)
+            self.assertEqual(report['added'], 3)
+            service.refresh_from_db()
+            self.assertEqual(service.capabilities_etag, '"ows130"')
+            self.assertEqual(len(service.capabilities_hash), 40)
+
+            # the server tells the document was not modified
+            self.statuses = []
+            report = check_services([service.id])
+            self.assertEqual(self.statuses, [304])
+            self.assertEqual(report, {'services': 1, 'unchanged_services': 1, 'added': 0, 'updated': 0, 'skipped': 3})
+
+            # the server does not support conditional requests, but the content did not change
+            Service.objects.filter(id=service.id).update(capabilities_etag=None)
+            report = check_services([service.id])
+            self.assertEqual(report['unchanged_services'], 1)
+            self.assertEqual(report['skipped'], 3)
+            # the new ETag of the same document is stored, so the next harvest is conditional again
+            service.refresh_from_db()
+            self.assertEqual(service.capabilities_etag, '"ows130"')
+            self.statuses = []
+            check_services([service.id])
+            self.assertEqual(self.statuses, [304])
+
+        # the service is available in every check
+        self.assertEqual(service.check_set.filter(success=True).count(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the rate limiting and circuit breaking of the requests to the remote hosts.
+"""
+
+import unittest
+
+import requests
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from httmock import HTTMock, response, urlmatch
+
+from hypermap.aggregator import host_governor, layer_probe
+from hypermap.aggregator.harvest import HostLimiter, fetch_capabilities
+from hypermap.aggregator.models import Service, Catalog, Layer, Check
+from hypermap.aggregator.tasks import check_layer
+
+PNG = '\x89PNG\r\n\x1a\n' + '\x00' * 60
+
+
+class TestHostGovernor(unittest.TestCase):
+
+    def create_layer(self, url):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        service = Service(type='OGC:WMS', url=url, catalog=catalog, is_monitored=False)
+        service.save()
+        self.addCleanup(service.delete)
+        Layer.objects.bulk_create([
+            Layer(name='down', title='Down', service=service, catalog=catalog, url=service.url, is_monitored=False)
+        ])
+        return Layer.objects.get(service=service)
+
+    def test_token_bucket(self):
+        host = 'bucket.example.com'
+        now = 1000000.0
+        rate = float(host_governor.REGISTRY_HOST_RATE)
+
+        # an idle host gets burst requests at once, then one request per 1 / rate seconds
+        delays = [host_governor.reserve(host, now) for i in range(host_governor.REGISTRY_HOST_BURST + 2)]
+        self.assertEqual(delays, [0] * host_governor.REGISTRY_HOST_BURST + [1 / rate, 2 / rate])
+
+        # a released token is available again
+        host_governor.release(host)
+        self.assertEqual(host_governor.reserve(host, now), 2 / rate)
+
+        # the bucket is refilled, up to burst tokens
+        later = now + 60
+        delays = [host_governor.reserve(host, later) for i in range(host_governor.REGISTRY_HOST_BURST + 1)]
+        self.assertEqual(delays, [0] * host_governor.REGISTRY_HOST_BURST + [1 / rate])
+
+    def test_circuit_breaker(self):
+        host = 'circuit.example.com'
+        error = requests.ConnectionError('Name or service not known')
+        for i in range(host_governor.REGISTRY_HOST_FAILURE_THRESHOLD - 1):
+            host_governor.record(host, error)
+        self.assertFalse(host_governor.is_open(host))
+        # an answering host is alive, even with a client error
+        host_governor.record(host, requests.HTTPError('404 Client Error'))
+        for i in range(host_governor.REGISTRY_HOST_FAILURE_THRESHOLD - 1):
+            host_governor.record(host, error)
+        self.assertFalse(host_governor.is_open(host))
+        host_governor.record(host, error)
+        self.assertTrue(host_governor.is_open(host))
+
+        # a successful request closes the circuit
+        host_governor.record(host)
+        self.assertFalse(host_governor.is_open(host))
+
+    def test_failure_of_another_host(self):
+        error = requests.ConnectionError(
+            'Name or service not known', request=requests.Request('GET', 'http://GetMap.example.com/wms').prepare())
+        for i in range(host_governor.REGISTRY_HOST_FAILURE_THRESHOLD):
+            host_governor.record('layer.example.com', error)
+        self.assertFalse(host_governor.is_open('layer.example.com'))
+        self.assertTrue(host_governor.is_open('getmap.example.com'))
+
+    def test_fetch_capabilities_host_busy(self):
+        max_wait = host_governor.REGISTRY_HOST_MAX_WAIT
+        host_governor.REGISTRY_HOST_MAX_WAIT = -1
+        self.addCleanup(setattr, host_governor, 'REGISTRY_HOST_MAX_WAIT', max_wait)
+        limiter = HostLimiter(1)
+        service = (1, 'OGC:WMS', 'http://busy.example.com/ows?')
+
+        # the service is skipped without waiting, and without taking a slot of the host
+        capabilities = fetch_capabilities(service, limiter)
+        self.assertIsInstance(capabilities.error, host_governor.HostBusyError)
+        self.assertTrue(limiter.semaphore(service[2]).acquire(False))
+
+    def test_check_layers_host_busy(self):
+        max_wait = host_governor.REGISTRY_HOST_MAX_WAIT
+        host_governor.REGISTRY_HOST_MAX_WAIT = 0
+        self.addCleanup(setattr, host_governor, 'REGISTRY_HOST_MAX_WAIT', max_wait)
+        # the bucket is not refilled while the layers are checked
+        rate = host_governor.REGISTRY_HOST_RATE
+        host_governor.REGISTRY_HOST_RATE = 0.001
+        self.addCleanup(setattr, host_governor, 'REGISTRY_HOST_RATE', rate)
+        service = self.create_layer('http://crowded.example.com/ows?').service
+        catalog = service.catalog
+        layers = [Layer(name='crowded_%s' % i, title='Crowded', service=service, catalog=catalog, url=service.url,
+                        is_monitored=False, thumbnail='layers/crowded.jpg', thumbnail_updated=timezone.now())
+                  for i in range(host_governor.REGISTRY_HOST_BURST + 3)]
+        for layer in layers:
+            # thumbnails up to date, the checks only probe the layers
+            layer.thumbnail_signature = layer_probe.get_thumbnail_signature(layer)
+        Layer.objects.bulk_create(layers)
+
+        @urlmatch(netloc='crowded.example.com')
+        def getmap(url, request):
+            return response(200, PNG, {'Content-Type': 'image/png'}, None, 0, request)
+
+        with HTTMock(getmap):
+            for layer in service.layer_set.all():
+                check_layer(layer.id)
+
+        # more checks than the bucket of the host allows: the others are not failures, they are due again
+        checks = Check.objects.filter(object_id__in=service.layer_set.values('id'),
+                                      content_type=ContentType.objects.get_for_model(Layer))
+        self.assertEqual(checks.filter(success=False).count(), 0)
+        self.assertEqual(checks.count(), host_governor.REGISTRY_HOST_BURST)
+        unchecked = service.layer_set.exclude(id__in=checks.values('object_id'))
+        self.assertEqual(unchecked.count(), 4)
+        self.assertFalse(unchecked.filter(next_check__isnull=True).exists())
+
+    def test_backoff(self):
+        rate = float(host_governor.REGISTRY_HOST_RATE)
+        backoffs = [host_governor.get_backoff('backoff.example.com', retries) for retries in range(3)]
+        for retries, backoff in enumerate(backoffs):
+            self.assertTrue(2 ** retries / rate <= backoff <= 2 ** (retries + 1) / rate)
+
+    def test_check_layer_circuit_open(self):
+        layer = self.create_layer('http://down.example.com/ows?')
+
+        for i in range(host_governor.REGISTRY_HOST_FAILURE_THRESHOLD):
+            host_governor.record('down.example.com', requests.Timeout('Read timed out'))
+        self.addCleanup(host_governor.record, 'down.example.com')
+        check_layer(layer.id)
+
+        check = layer.check_set.get()
+        self.assertEqual((check.success, check.response_time), (False, 0))
+        self.assertIn('down.example.com', check.message)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the durable index queue.
+"""
+
+import unittest
+
+from hypermap.aggregator import index_queue, tasks
+from hypermap.aggregator.models import IndexQueueItem, Service, Catalog, Layer
+from hypermap.search_api import engines
+
+
+class RemovingEngine(engines.SearchEngine):
+    """
+    Records the batches of removed layers.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def remove_layers(self, layers):
+        self.batches.append(sorted(layer.id for layer in layers))
+
+
+class TestIndexQueue(unittest.TestCase):
+
+    def setUp(self):
+        index_queue.clear()
+        self.addCleanup(index_queue.clear)
+
+    def test_enqueue_deduplicates(self):
+        index_queue.enqueue([1, 2, 2, 3])
+        index_queue.enqueue([3, 4])
+        self.assertEqual(index_queue.size(), 4)
+        self.assertEqual(index_queue.size('index'), 4)
+
+        # the last action wins
+        index_queue.enqueue([4], 'unindex')
+        self.assertEqual(index_queue.size('index'), 3)
+        self.assertEqual(index_queue.size('unindex'), 1)
+
+    def test_dequeue_claims_items(self):
+        index_queue.enqueue([1, 2, 3])
+        items = index_queue.dequeue_batch(2)
+        self.assertEqual(len(items), 2)
+        # claimed items are not dequeued again
+        others = index_queue.dequeue_batch(2)
+        self.assertEqual([item.layer_id for item in others], [3])
+        self.assertEqual(index_queue.dequeue_batch(2), [])
+        self.assertEqual(index_queue.dequeue_batch(2, 'unindex'), [])
+
+        index_queue.ack(items + others)
+        self.assertEqual(index_queue.size(), 0)
+
+    def test_enqueue_after_claim(self):
+        index_queue.enqueue([1])
+        items = index_queue.dequeue_batch(10)
+        # the layer changed while it was being indexed
+        index_queue.enqueue([1])
+        index_queue.ack(items)
+        self.assertEqual([item.layer_id for item in index_queue.dequeue_batch(10)], [1])
+
+    def test_nack_retries(self):
+        index_queue.enqueue([1])
+        for i in range(index_queue.REGISTRY_INDEX_QUEUE_MAX_RETRIES):
+            items = index_queue.dequeue_batch(10)
+            self.assertEqual(len(items), 1)
+            index_queue.nack(items, 'error %s' % i)
+            # release the lease
+            IndexQueueItem.objects.update(claimed=None)
+
+        # the item failed too many times
+        self.assertEqual(index_queue.dequeue_batch(10), [])
+        item = IndexQueueItem.objects.get(layer_id=1)
+        self.assertEqual(item.last_error, 'error 4')
+
+    def test_unindex_batch(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        service = Service(type='OGC:WMS', url='http://unindex.example.com/ows?', catalog=catalog,
+                          is_monitored=False)
+        service.save()
+        self.addCleanup(service.delete)
+        Layer.objects.bulk_create([
+            Layer(name='layer_%s' % i, service=service, catalog=catalog, url=service.url, is_monitored=False)
+            for i in range(3)
+        ])
+        layer_ids = sorted(service.layer_set.values_list('id', flat=True))
+
+        engine = RemovingEngine()
+        self.addCleanup(engines._engines.pop, tasks.SEARCH_TYPE, None)
+        engines._engines[tasks.SEARCH_TYPE] = engine
+        # a deleted layer is only removed from the queue
+        index_queue.enqueue(layer_ids + [max(layer_ids) + 1000], 'unindex')
+        tasks.index_cached_layers()
+
+        # the layers are removed with a single request
+        self.assertEqual(engine.batches, [layer_ids])
+        self.assertEqual(index_queue.size('unindex'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the lightweight availability probes of the layers.
+"""
+
+import datetime
+import unittest
+import urlparse
+
+from django.utils import timezone
+from httmock import HTTMock, response, urlmatch
+
+from hypermap.aggregator import host_governor, layer_probe
+from hypermap.aggregator.models import Service, Catalog, Layer
+
+PNG = '\x89PNG\r\n\x1a\n' + '\x00' * 60
+
+
+class TestLayerProbe(unittest.TestCase):
+
+    def setUp(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.service = Service(type='OGC:WMS', url='http://probe.example.com/ows?', catalog=catalog,
+                               is_monitored=False)
+        self.service.save()
+        self.addCleanup(self.service.delete)
+        Layer.objects.bulk_create([
+            Layer(name='probed', title='Probed', service=self.service, catalog=catalog, url=self.service.url,
+                  bbox_x0=-10, bbox_y0=-5, bbox_x1=10, bbox_y1=5, is_monitored=False)
+        ])
+        self.layer = Layer.objects.get(service=self.service)
+        # a thumbnail up to date
+        self.layer.thumbnail = 'layers/probed.jpg'
+        self.layer.thumbnail_updated = timezone.now()
+        self.layer.thumbnail_signature = layer_probe.get_thumbnail_signature(self.layer)
+        self.requests = []
+
+    def probe_mock(self, content_type, content):
+        @urlmatch(netloc='probe.example.com')
+        def mock(url, request):
+            self.requests.append((request.method, request.url))
+            return response(200, content, {'Content-Type': content_type}, None, 0, request)
+        return mock
+
+    def test_check_available(self):
+        with HTTMock(self.probe_mock('image/png', PNG)):
+            success, message = self.layer.check_available()
+        self.assertTrue(success)
+
+        # a single 1x1 GetMap, the thumbnail is not regenerated
+        self.assertEqual(len(self.requests), 1)
+        params = dict(urlparse.parse_qsl(urlparse.urlparse(self.requests[0][1]).query))
+        self.assertEqual((params['REQUEST'], params['LAYERS'], params['WIDTH'], params['HEIGHT']),
+                         ('GetMap', 'probed', '1', '1'))
+        self.assertEqual(params['BBOX'], '-10.0,-5.0,10.0,5.0')
+
+        check = self.layer.check_set.get()
+        self.assertTrue(check.success)
+        self.assertEqual(check.response_size, len(PNG))
+
+    def test_service_exception(self):
+        exception = '<ServiceExceptionReport><ServiceException>Unknown layer</ServiceException>' \
+                    '</ServiceExceptionReport>'
+        with HTTMock(self.probe_mock('application/vnd.ogc.se_xml', exception)):
+            success, message = self.layer.check_available()
+        self.assertFalse(success)
+        self.assertIn('Unknown layer', message)
+        # the host answered, it is not failing
+        self.assertIsNone(host_governor.cache.get(host_governor.FAILURES_KEY % 'probe.example.com'))
+
+    def test_probe_request(self):
+        self.layer.type = 'ESRI:ArcGIS:MapServer'
+        self.layer.service.url = 'http://probe.example.com/arcgis/rest/services/Roads/MapServer/?f=json'
+        method, url, params = layer_probe.get_probe_request(self.layer)
+        self.assertEqual((method, url), ('GET', 'http://probe.example.com/arcgis/rest/services/Roads/MapServer/export'))
+        self.assertEqual((params['size'], params['layers'], params['f']), ('1,1', 'show:probed', 'image'))
+
+        # without a valid extent, or a map operation, a HEAD request to the layer
+        self.layer.bbox_x0 = 20
+        self.assertEqual(layer_probe.get_probe_request(self.layer), ('HEAD', self.layer.url, None))
+        self.layer.type = 'OSGeo:TMS'
+        with HTTMock(self.probe_mock('text/html', '')):
+            result = layer_probe.probe(self.layer)
+        self.assertEqual(self.requests, [('HEAD', 'http://probe.example.com/ows')])
+        self.assertEqual(result.response_size, 0)
+
+    def test_needs_thumbnail(self):
+        now = timezone.now()
+        self.assertFalse(layer_probe.needs_thumbnail(self.layer, now))
+
+        # expired
+        later = now + datetime.timedelta(days=layer_probe.REGISTRY_THUMBNAIL_TTL + 1)
+        self.assertTrue(layer_probe.needs_thumbnail(self.layer, later))
+
+        # the extent changed
+        self.layer.bbox_x1 = 20
+        self.assertTrue(layer_probe.needs_thumbnail(self.layer, now))
+
+        # missing
+        self.layer.thumbnail_signature = layer_probe.get_thumbnail_signature(self.layer)
+        self.layer.thumbnail = None
+        self.assertTrue(layer_probe.needs_thumbnail(self.layer, now))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the bulk layers synchronisation.
+"""
+
+import unittest
+
+from httmock import with_httmock
+import mocks.wms
+
+from hypermap.aggregator.layer_sync import LayerRecord, sync_layers
+from hypermap.aggregator.models import Service, Catalog, Layer, update_layers_wms
+
+
+class TestLayerSync(unittest.TestCase):
+
+    @with_httmock(mocks.wms.resource_get)
+    def test_update_layers_wms(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+
+        service = Service(
+            type='OGC:WMS',
+            url='http://wms.example.com/ows111?',
+            catalog=catalog,
+            is_monitored=False
+        )
+        service.save()
+        self.addCleanup(service.delete)
+        report = service.update_layers()
+        self.assertEqual(report, {'added': 9, 'updated': 0, 'skipped': 0})
+        self.assertEqual(service.layer_set.all().count(), 9)
+
+        # nothing changed
+        report = update_layers_wms(service)
+        self.assertEqual(report, {'added': 0, 'updated': 0, 'skipped': 9})
+
+        # one layer was changed and one layer was removed
+        Layer.objects.filter(service=service, name='geonode:_30river_project1_1').update(title='Changed')
+        service.layer_set.get(name='geonode:roads_2').delete()
+        report = update_layers_wms(service)
+        self.assertEqual(report, {'added': 1, 'updated': 1, 'skipped': 7})
+
+        layer = service.layer_set.get(name='geonode:_30river_project1_1')
+        self.assertEqual(layer.title, 'Rivers')
+        self.assertEqual(layer.keywords.all().count(), 3)
+        layer = service.layer_set.get(name='geonode:roads_2')
+        self.assertTrue(str(layer.uuid) in layer.xml)
+        self.assertTrue(layer.page_url.endswith('%s/' % layer.uuid))
+
+    def test_duplicated_name(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        service = Service(
+            type='OGC:WMS',
+            url='http://nested.example.com/ows?',
+            catalog=catalog,
+            is_monitored=False
+        )
+        service.save()
+        self.addCleanup(service.delete)
+
+        # a layer listed twice in nested WMS layers
+        records = [
+            LayerRecord('roads', title='Roads', keywords=['roads']),
+            LayerRecord('rivers', title='Rivers'),
+            LayerRecord('roads', title='Roads 1990', keywords=['roads']),
+        ]
+        report = sync_layers(service, records, 'OGC:WMS', 'OGC:WMS')
+        self.assertEqual(report, {'added': 2, 'updated': 0, 'skipped': 0})
+        self.assertEqual(service.layer_set.filter(name='roads').count(), 1)
+        layer = service.layer_set.get(name='roads')
+        self.assertEqual(layer.title, 'Roads 1990')
+        self.assertEqual(layer.keywords.all().count(), 1)
+        self.assertEqual([str(date.date) for date in layer.layerdate_set.all()], ['1990-01-01'])
+
+
+if __name__ == '__main__':
+    unittest.main()
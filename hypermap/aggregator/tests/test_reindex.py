@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the full reindex.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from multiprocessing.pool import ThreadPool
+
+from httmock import HTTMock, urlmatch
+
+from hypermap.aggregator import reindex
+from hypermap.aggregator.elasticsearch_client import ESHypermap
+from hypermap.aggregator.models import Service, Catalog, Layer
+
+
+class TestReindex(unittest.TestCase):
+
+    def setUp(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.service = Service(
+            type='OGC:WMS',
+            url='http://reindex.example.com/ows?',
+            catalog=catalog,
+            is_monitored=False
+        )
+        self.service.save()
+        self.addCleanup(self.service.delete)
+        Layer.objects.bulk_create([
+            Layer(name='layer_%s' % i, title='Layer %s' % i, service=self.service, catalog=catalog,
+                  url=self.service.url, is_monitored=False, bbox_x0=-10, bbox_y0=-10, bbox_x1=10, bbox_y1=10)
+            for i in range(7)
+        ])
+        # only reindex the layers of this test
+        Layer.objects.exclude(service=self.service).update(was_deleted=True)
+        self.addCleanup(Layer.objects.exclude(service=self.service).update, was_deleted=False)
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.checkpoint = os.path.join(self.directory, 'checkpoint')
+        self.documents = []
+
+    def solr_mock(self, fail_after=None):
+        @urlmatch(path=r'.*/update/json/docs')
+        def solr_update(url, request):
+            if fail_after is not None and len(self.documents) >= fail_after:
+                return {'status_code': 500, 'content': 'error'}
+            self.documents.extend(json.loads(request.body))
+            return {'status_code': 200, 'content': '{}'}
+        return solr_update
+
+    @unittest.skipIf(reindex.SEARCH_TYPE != 'solr', 'the Solr backend is not configured')
+    def test_reindex_and_resume(self):
+        layer_ids = sorted(self.service.layer_set.values_list('id', flat=True))
+
+        # the second chunk of 2x2 layers fails
+        with HTTMock(self.solr_mock(fail_after=4)):
+            with self.assertRaises(Exception):
+                reindex.reindex_layers(processes=1, concurrency=2, batch_size=2, checkpoint=self.checkpoint)
+        self.assertEqual(reindex.read_checkpoint(self.checkpoint), layer_ids[3])
+
+        with HTTMock(self.solr_mock()):
+            written, errors = reindex.reindex_layers(processes=1, concurrency=2, batch_size=2,
+                                                     checkpoint=self.checkpoint, resume=True)
+        self.assertEqual(written, 3)
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(document['id'] for document in self.documents), layer_ids)
+        self.assertEqual(reindex.read_checkpoint(self.checkpoint), layer_ids[-1])
+
+    def test_bounded_imap(self):
+        submitted = []
+
+        def chunks():
+            for i in range(10):
+                submitted.append(i)
+                yield i
+
+        pool = ThreadPool(2)
+        self.addCleanup(pool.terminate)
+        results = []
+        for result in reindex.bounded_imap(pool, lambda i: i * 2, chunks(), 3):
+            # no more than the window of chunks are submitted ahead of the consumed results
+            self.assertLessEqual(len(submitted) - len(results), 4)
+            results.append(result)
+        self.assertEqual(results, [i * 2 for i in range(10)])
+
+
+class FakeIndicesClient(object):
+    """
+    Records the calls to the Elasticsearch indices API.
+    """
+
+    def __init__(self, aliases, indices):
+        self.aliases = aliases
+        self.indices = indices
+        self.calls = []
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return dict((index, {}) for index in self.aliases[name])
+
+    def exists(self, index):
+        return index in self.indices
+
+    def get_settings(self, index):
+        return {index: {'settings': {'index': {'number_of_replicas': '2'}}}}
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, kwargs))
+
+
+class FakeElasticsearch(object):
+
+    def __init__(self, aliases, indices):
+        self.indices = FakeIndicesClient(aliases, indices)
+
+
+class TestSwapAlias(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, ESHypermap, 'es', ESHypermap.es)
+        self.addCleanup(ESHypermap.cluster_info.clear)
+
+    def test_swap_alias(self):
+        ESHypermap.es = FakeElasticsearch({'hypermap': ['hypermap_1']}, ['hypermap_1'])
+        ESHypermap.swap_alias('hypermap', 'hypermap_2')
+        self.assertEqual(ESHypermap.es.indices.calls, [
+            ('put_settings', {'index': 'hypermap_2',
+                              'body': {'index': {'refresh_interval': '1s', 'number_of_replicas': '2'}}}),
+            ('refresh', {'index': 'hypermap_2'}),
+            ('update_aliases', {'body': {'actions': [
+                {'remove': {'index': 'hypermap_1', 'alias': 'hypermap'}},
+                {'add': {'index': 'hypermap_2', 'alias': 'hypermap'}},
+            ]}}),
+            ('delete', {'index': 'hypermap_1'}),
+        ])
+
+    def test_swap_legacy_index(self):
+        ESHypermap.cluster_info.set('version', 5)
+        ESHypermap.es = FakeElasticsearch({}, ['hypermap'])
+        ESHypermap.swap_alias('hypermap', 'hypermap_2')
+        calls = ESHypermap.es.indices.calls
+        self.assertEqual(calls[2:], [('update_aliases', {'body': {'actions': [
+            {'remove_index': {'index': 'hypermap'}},
+            {'add': {'index': 'hypermap_2', 'alias': 'hypermap'}},
+        ]}})])
+
+    def test_swap_legacy_index_old_cluster(self):
+        ESHypermap.cluster_info.set('version', 2)
+        ESHypermap.es = FakeElasticsearch({}, ['hypermap'])
+        ESHypermap.swap_alias('hypermap', 'hypermap_2')
+        calls = ESHypermap.es.indices.calls
+        self.assertEqual(calls[2], ('delete', {'index': 'hypermap'}))
+        self.assertEqual(calls[3], ('update_aliases', {'body': {'actions': [
+            {'add': {'index': 'hypermap_2', 'alias': 'hypermap'}},
+        ]}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the search backend clients.
+"""
+
+import unittest
+
+from hypermap.aggregator import search_transport
+from hypermap.aggregator.elasticsearch_client import ESHypermap
+
+
+class CountingIndicesClient(object):
+
+    def __init__(self):
+        self.created = []
+
+    def create(self, index, **kwargs):
+        self.created.append(index)
+
+    def delete(self, index, **kwargs):
+        pass
+
+
+class CountingElasticsearch(object):
+
+    def __init__(self):
+        self.info_requests = 0
+        self.indices = CountingIndicesClient()
+
+    def info(self):
+        self.info_requests += 1
+        return {'version': {'number': '5.6.3'}}
+
+
+class TestSearchClientCache(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, ESHypermap, 'es', ESHypermap.es)
+        ESHypermap.es = CountingElasticsearch()
+        ESHypermap.cluster_info.clear()
+        ESHypermap.known_indices.clear()
+        self.addCleanup(ESHypermap.cluster_info.clear)
+        self.addCleanup(ESHypermap.known_indices.clear)
+
+    def test_version(self):
+        self.assertEqual(ESHypermap.get_version(), 5)
+        self.assertEqual(ESHypermap.get_version(), 5)
+        self.assertEqual(ESHypermap.es.info_requests, 1)
+
+    def test_ensure_index(self):
+        ESHypermap.ensure_index('hypermap')
+        ESHypermap.ensure_index('hypermap')
+        ESHypermap.ensure_index('other')
+        self.assertEqual(ESHypermap.es.indices.created, ['hypermap', 'other'])
+
+        # the index is created again once cleared
+        ESHypermap.clear_es()
+        ESHypermap.ensure_index('hypermap')
+        self.assertEqual(ESHypermap.es.indices.created, ['hypermap', 'other', 'hypermap'])
+
+
+class TestSearchTransport(unittest.TestCase):
+
+    def test_shared_session(self):
+        session = search_transport.get_session()
+        self.assertTrue(search_transport.get_session() is session)
+        adapter = session.get_adapter('http://solr:8983/solr/hypermap/select')
+        self.assertEqual(adapter._pool_maxsize, search_transport.REGISTRY_SEARCH_POOL_SIZE)
+        self.assertEqual(adapter.max_retries.total, search_transport.REGISTRY_SEARCH_RETRIES)
+
+        solr = search_transport.get_solr('http://solr:8983/solr/hypermap')
+        self.assertTrue(search_transport.get_solr('http://solr:8983/solr/hypermap') is solr)
+        self.assertTrue(solr.session is session)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the batched layers serialization.
+"""
+
+import datetime
+import unittest
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from hypermap.aggregator.models import Service, Catalog, Layer, LayerDate, Check, SpatialReferenceSystem
+from hypermap.aggregator.utils import layer2dict, prefetch_layers
+
+
+class TestPrefetchLayers(unittest.TestCase):
+
+    def setUp(self):
+        catalog, created = Catalog.objects.get_or_create(
+            name="hypermap", slug="hypermap",
+            url="search_api"
+        )
+        self.service = Service(
+            type='OGC:WMS',
+            url='http://serialization.example.com/ows?',
+            catalog=catalog,
+            is_monitored=False
+        )
+        self.service.save()
+        self.addCleanup(self.service.delete)
+        srs, created = SpatialReferenceSystem.objects.get_or_create(code='EPSG:4326')
+        self.service.srs.add(srs)
+
+        Layer.objects.bulk_create([
+            Layer(name='layer_%s' % i, title='Layer %s' % i, service=self.service, catalog=catalog,
+                  url=self.service.url, is_monitored=False, bbox_x0=-10, bbox_y0=-10, bbox_x1=10, bbox_y1=10)
+            for i in range(6)
+        ])
+        now = timezone.now()
+        for i, layer in enumerate(self.layers()):
+            layer.keywords.add('keyword %s' % i, 'common')
+            LayerDate.objects.create(layer=layer, date='2000-01-0%s' % (i + 1), type=1)
+            LayerDate.objects.create(layer=layer, date='1999-01-01', type=0)
+            # checks are ordered: success, failure, success... and i of them
+            for j in range(i):
+                check = Check.objects.create(content_object=layer, success=(j % 2 == 0), response_time=0.1)
+                Check.objects.filter(id=check.id).update(checked_datetime=now - datetime.timedelta(minutes=j))
+
+    def layers(self):
+        return Layer.objects.filter(service=self.service).order_by('id')
+
+    def test_same_documents(self):
+        expected = [layer2dict(layer) for layer in self.layers()]
+        prefetched = [layer2dict(layer) for layer in prefetch_layers(self.layers())]
+        self.assertEqual(prefetched, expected)
+
+        layer_dict = prefetched[3][0]
+        self.assertEqual(sorted(layer_dict['keywords']), ['common', 'keyword 3'])
+        self.assertEqual(layer_dict['reliability'], 2 / 3.0 * 100)
+        self.assertEqual(layer_dict['recent_reliability'], 50.0)
+        self.assertEqual(layer_dict['last_status'], True)
+        self.assertTrue(layer_dict['layer_date'].startswith('1999-01-01'))
+        self.assertEqual(prefetched[0][0]['reliability'], None)
+
+    def test_constant_queries(self):
+        with CaptureQueriesContext(connection) as few:
+            [layer2dict(layer) for layer in prefetch_layers(self.layers()[:2])]
+        with CaptureQueriesContext(connection) as many:
+            [layer2dict(layer) for layer in prefetch_layers(self.layers())]
+        self.assertEqual(len(few), len(many))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the layer_date bounds of the search indices.
+"""
+
+import json
+import unittest
+
+from httmock import with_httmock, urlmatch
+
+from hypermap.aggregator import time_bounds
+from hypermap.aggregator.models import IndexTimeBounds
+from hypermap.search_api.utils import asterisk_to_min_max
+
+CORE_URL = 'http://bounds-solr:8983/solr/hypermap'
+
+stats_requests = []
+
+
+@urlmatch(netloc=r'bounds-solr:8983', path=r'/solr/hypermap/select')
+def solr_stats(url, request):
+    stats_requests.append(url)
+    return json.dumps({
+        'stats': {'stats_fields': {'layer_date': {
+            'min': '1900-01-01T00:00:00Z', 'max': '2000-01-01T00:00:00Z'
+        }}}
+    })
+
+
+class TestTimeBounds(unittest.TestCase):
+
+    def setUp(self):
+        del stats_requests[:]
+        self.addCleanup(IndexTimeBounds.objects.filter(index_name=CORE_URL).delete)
+
+    def test_date_key(self):
+        dates = ['2000-03-01T00:00:00Z', '-5000-01-01T00:00:00Z', '1999-12-31T23:59:59Z', '-0100-06-01T00:00:00Z']
+        self.assertEqual(
+            sorted(dates, key=time_bounds.date_key),
+            ['-5000-01-01T00:00:00Z', '-0100-06-01T00:00:00Z', '1999-12-31T23:59:59Z', '2000-03-01T00:00:00Z']
+        )
+        self.assertIsNone(time_bounds.date_key('not a date'))
+
+    def test_widen(self):
+        # bounds are only maintained once known
+        time_bounds.widen(CORE_URL, ['2000-01-01T00:00:00Z'])
+        self.assertIsNone(time_bounds.get_bounds(CORE_URL))
+
+        time_bounds.reset(CORE_URL)
+        self.assertIsNone(time_bounds.get_bounds(CORE_URL))
+        time_bounds.widen(CORE_URL, ['2000-01-01T00:00:00Z', None, '1990-01-01T00:00:00Z'])
+        self.assertEqual(time_bounds.get_bounds(CORE_URL), ('1990-01-01T00:00:00Z', '2000-01-01T00:00:00Z'))
+        time_bounds.widen(CORE_URL, ['1995-01-01T00:00:00Z'])
+        self.assertEqual(time_bounds.get_bounds(CORE_URL), ('1990-01-01T00:00:00Z', '2000-01-01T00:00:00Z'))
+        time_bounds.widen(CORE_URL, ['-0500-01-01T00:00:00Z', '2010-01-01T00:00:00Z'])
+        self.assertEqual(time_bounds.get_bounds(CORE_URL), ('-0500-01-01T00:00:00Z', '2010-01-01T00:00:00Z'))
+
+    @with_httmock(solr_stats)
+    def test_asterisk_to_min_max(self):
+        endpoint = '%s/select' % CORE_URL
+
+        # unknown bounds are computed with a stats query, then stored
+        self.assertEqual(
+            asterisk_to_min_max('layer_date', '[* TO *]', endpoint),
+            '[1900-01-01T00:00:00Z TO 2000-01-01T00:00:00Z]'
+        )
+        self.assertEqual(len(stats_requests), 1)
+
+        time_bounds.widen(CORE_URL, ['2005-01-01T00:00:00Z'])
+        self.assertEqual(
+            asterisk_to_min_max('layer_date', '[1950-01-01T00:00:00Z TO *]', endpoint),
+            '[1950-01-01T00:00:00Z TO 2005-01-01T00:00:00Z]'
+        )
+        self.assertEqual(len(stats_requests), 1)
@@ -0,0 +1,81 @@
+"""
+Earliest and latest layer_date of the layers indexed in a search index.
+
+The bounds are stored in the IndexTimeBounds table and widened by the indexers
+after each write, with conditional updates (so concurrent indexers can not
+narrow them), and read by the Search API to translate "*" in time filters
+without a stats query. Bounds are only maintained once they are known for the
+whole index: they are initialized by the stats query fallback of the Search
+API, or reset when the index is cleared. Removed layers do not narrow them.
+"""
+
+import logging
+import re
+
+from django.db.models import Q
+
+LOGGER = logging.getLogger(__name__)
+
+SOLR_DATE_RE = re.compile(r'^(-?)(\d+)-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)')
+
+
+def date_key(date):
+    """
+    Return a number sorting indexed dates (like 2000-03-01T00:00:00Z or -5000-01-01T00:00:00Z) chronologically.
+    """
+    match = SOLR_DATE_RE.match(date or '')
+    if not match:
+        return None
+    sign, year, month, day, hour, minute, second = match.groups()
+    year = -int(year) if sign else int(year)
+    return year * 10 ** 10 + int(month + day + hour + minute + second)
+
+
+def get_bounds(index_name):
+    """
+    Return the (min date, max date) of an index, or None if they are not known.
+    """
+    from hypermap.aggregator.models import IndexTimeBounds
+
+    bounds = IndexTimeBounds.objects.filter(index_name=index_name, min_key__isnull=False).first()
+    if bounds is None:
+        return None
+    return bounds.min_date, bounds.max_date
+
+
+def widen(index_name, dates):
+    """
+    Widen the bounds of an index, if they are known, to include the given dates.
+    """
+    from hypermap.aggregator.models import IndexTimeBounds
+
+    keys = [(date_key(date), date) for date in dates if date]
+    keys = [key for key in keys if key[0] is not None]
+    if not keys:
+        return
+    min_key, min_date = min(keys)
+    max_key, max_date = max(keys)
+    bounds = IndexTimeBounds.objects.filter(index_name=index_name)
+    bounds.filter(Q(min_key__isnull=True) | Q(min_key__gt=min_key)).update(min_key=min_key, min_date=min_date)
+    bounds.filter(Q(max_key__isnull=True) | Q(max_key__lt=max_key)).update(max_key=max_key, max_date=max_date)
+
+
+def set_bounds(index_name, min_date, max_date):
+    """
+    Store the bounds of a whole index, as computed by the search backend.
+    """
+    from hypermap.aggregator.models import IndexTimeBounds
+
+    IndexTimeBounds.objects.get_or_create(index_name=index_name)
+    widen(index_name, [min_date, max_date])
+
+
+def reset(index_name):
+    """
+    The index was cleared: its bounds are known, and empty.
+    """
+    from hypermap.aggregator.models import IndexTimeBounds
+
+    bounds, created = IndexTimeBounds.objects.get_or_create(index_name=index_name)
+    if not created:
+        IndexTimeBounds.objects.filter(id=bounds.id).update(min_key=None, min_date=None, max_key=None, max_date=None)
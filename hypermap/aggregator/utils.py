@@ -567,6 +567,18 @@ def get_domain(url):
     return hostname
 
 
+def prefetch_layers(layers):
+    """
+    Return a list with the layers of a queryset, loaded with everything needed to serialize them
+    with layer2dict or ESHypermap.layer_to_es using a constant number of queries: services, catalogs,
+    WorldMap attributes, keywords, srs and dates are prefetched. Check statistics are fields of the layers.
+    """
+    return list(
+        layers.select_related('service', 'catalog', 'layerwm').prefetch_related(
+            'keywords', 'service__srs', 'layerdate_set')
+    )
+
+
 def layer2dict(layer):
     """
     Return a json representation for a layer.
@@ -652,7 +664,7 @@ def layer2dict(layer):
         layer_dict['bbox'] = wkt
         layer_dict['centroid_x'] = rectangle.centroid.x
         layer_dict['centroid_y'] = rectangle.centroid.y
-        srs_list = [srs.encode('utf-8') for srs in layer.service.srs.values_list('code', flat=True)]
+        srs_list = [srs.code.encode('utf-8') for srs in layer.service.srs.all()]
         layer_dict['srs'] = srs_list
     if layer.get_tile_url():
         layer_dict['tile_url'] = layer.get_tile_url()
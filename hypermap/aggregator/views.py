@@ -8,13 +8,14 @@ from django.shortcuts import render
 from django.shortcuts import get_object_or_404
 from django.db.models import Count
 from django.contrib.auth.decorators import login_required
-from django.core.cache import cache
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
 from djmp.views import get_mapproxy
 
 
 from models import Service, Layer, Catalog
+import check_stats
+import index_queue
 from tasks import (check_all_services, check_service, check_layer, remove_service_checks, unindex_layers_with_issues,
                    index_service, index_all_layers, index_layer, index_cached_layers, clear_index,
                    SEARCH_TYPE, SEARCH_URL)
@@ -23,6 +24,9 @@ from enums import SERVICE_TYPES
 
 LOGGER = logging.getLogger(__name__)
 
+# number of check rollups in the check history charts
+CHECK_ROLLUPS_CHART_SIZE = 500
+
 
 class BootstrapPaginator(Paginator):
     def __init__(self, *args, **kwargs):
@@ -58,6 +62,23 @@ def serialize_checks(check_set):
     return check_set_list
 
 
+def serialize_check_rollups(check_rollup_set):
+    """
+    Serialize the hourly and daily rollups of a check_rollup_set for raphael
+    """
+    check_rollup_set_list = []
+    for rollup in check_rollup_set.all()[:CHECK_ROLLUPS_CHART_SIZE]:
+        check_rollup_set_list.append(
+            {
+                'datetime': rollup.start_datetime.isoformat(),
+                'value': rollup.average_response_time,
+                'reliability': rollup.reliability,
+                'success': 1 if rollup.success_checks_count == rollup.checks_count else 0
+            }
+        )
+    return check_rollup_set_list
+
+
 @login_required
 def domains(request):
     """
@@ -89,13 +110,13 @@ def index(request, catalog_slug=None):
     filter_by = request.GET.get('filter_by', None)
     query = request.GET.get('q', None)
 
-    services = Service.objects.prefetch_related('check_set').all()
+    services = Service.objects.all()
     if catalog_slug:
         services = Service.objects.filter(catalog__slug=catalog_slug)
 
     # order_by
     if 'total_checks' in order_by:
-        services = services.annotate(total_checks=Count('resource_ptr__check')).order_by(order_by)
+        services = services.order_by(order_by.replace('total_checks', 'checks_count'))
     elif 'layers_count' in order_by:
         services = services.annotate(layers_count=Count('layer')).order_by(order_by)
     else:
@@ -164,9 +185,11 @@ def service_detail(request, catalog_slug, service_uuid=None, service_id=None):
                 index_service(service.id)
             else:
                 index_service.delay(service.id)
+        # check statistics are updated in the database
+        service.refresh_from_db()
 
     page = request.GET.get('page', 1)
-    layers = service.layer_set.select_related('catalog').prefetch_related('check_set').all()
+    layers = service.layer_set.select_related('catalog').all()
     paginator = BootstrapPaginator(layers, settings.PAGINATION_DEFAULT_PAGINATION)
 
     try:
@@ -186,6 +209,7 @@ def service_detail(request, catalog_slug, service_uuid=None, service_id=None):
 def service_checks(request, catalog_slug, service_uuid):
     service = get_object_or_404(Service, uuid=service_uuid)
     resource = serialize_checks(service.check_set)
+    history = serialize_check_rollups(service.check_rollup_set)
 
     page = request.GET.get('page', 1)
     checks = service.check_set.all()
@@ -200,7 +224,8 @@ def service_checks(request, catalog_slug, service_uuid):
 
     return render(request, 'aggregator/service_checks.html', {'service': service,
                                                               'checks': checks,
-                                                              'resource': resource})
+                                                              'resource': resource,
+                                                              'history': history})
 
 
 def layer_detail(request, catalog_slug, layer_uuid=None, layer_id=None):
@@ -217,11 +242,15 @@ def layer_detail(request, catalog_slug, layer_uuid=None, layer_id=None):
                 check_layer.delay(layer.id)
         if 'remove' in request.POST:
             layer.check_set.all().delete()
+            layer.check_rollup_set.all().delete()
+            check_stats.reset(Layer, [layer.id])
         if 'index' in request.POST:
             if settings.REGISTRY_SKIP_CELERY:
                 index_layer(layer.id)
             else:
                 index_layer.delay(layer.id)
+        # check statistics are updated in the database
+        layer.refresh_from_db()
 
     return render(request, 'aggregator/layer_detail.html', {'layer': layer,
                                                             'SEARCH_TYPE': SEARCH_TYPE,
@@ -232,6 +261,7 @@ def layer_detail(request, catalog_slug, layer_uuid=None, layer_id=None):
 def layer_checks(request, catalog_slug, layer_uuid):
     layer = get_object_or_404(Layer, uuid=layer_uuid)
     resource = serialize_checks(layer.check_set)
+    history = serialize_check_rollups(layer.check_rollup_set)
 
     page = request.GET.get('page', 1)
     checks = layer.check_set.all()
@@ -246,7 +276,8 @@ def layer_checks(request, catalog_slug, layer_uuid):
 
     return render(request, 'aggregator/layer_checks.html', {'layer': layer,
                                                             'checks': checks,
-                                                            'resource': resource})
+                                                            'resource': resource,
+                                                            'history': history})
 
 
 @login_required
@@ -256,15 +287,8 @@ def tasks_runner(request):
     """
 
     # server info
-    cached_layers_number = 0
-    cached_layers = cache.get('layers')
-    if cached_layers:
-        cached_layers_number = len(cached_layers)
-
-    cached_deleted_layers_number = 0
-    cached_deleted_layers = cache.get('deleted_layers')
-    if cached_deleted_layers:
-        cached_deleted_layers_number = len(cached_deleted_layers)
+    cached_layers_number = index_queue.size('index')
+    cached_deleted_layers_number = index_queue.size('unindex')
 
     # task actions
     if request.method == 'POST':
@@ -284,8 +308,7 @@ def tasks_runner(request):
             else:
                 index_cached_layers.delay()
         if 'drop_cached' in request.POST:
-            cache.set('layers', None)
-            cache.set('deleted_layers', None)
+            index_queue.clear()
         if 'clear_index' in request.POST:
             if settings.REGISTRY_SKIP_CELERY:
                 clear_index()
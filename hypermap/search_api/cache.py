@@ -0,0 +1,155 @@
+"""
+Cache of the Search API responses.
+
+Responses are cached by catalog, search engine and normalized search
+parameters, in an in-process LRU tier in front of the Django cache (the shared
+tier). Each catalog has an index generation, stored in the Django cache, which
+is part of the keys: the indexing tasks bump it when they change the index of
+a catalog, so cached responses of the previous generation are never read again.
+With Solr, all the catalogs are searched in the same core and share a generation.
+"""
+
+import hashlib
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from hypermap.aggregator.lru import LRUCache
+
+LOGGER = logging.getLogger(__name__)
+
+# seconds a search response is cached, 0 disables the cache
+REGISTRY_SEARCH_CACHE_TTL = getattr(settings, 'REGISTRY_SEARCH_CACHE_TTL', 300)
+# highest number of search responses kept in memory by each process
+REGISTRY_SEARCH_CACHE_SIZE = getattr(settings, 'REGISTRY_SEARCH_CACHE_SIZE', 500)
+# seconds after an invalidation during which responses are not cached, as the search backend
+# makes indexed documents visible after a delay (Solr commitWithin, Elasticsearch refresh interval)
+REGISTRY_SEARCH_CACHE_DELAY = getattr(settings, 'REGISTRY_SEARCH_CACHE_DELAY', 2)
+REGISTRY_SEARCH_URL = getattr(settings, 'REGISTRY_SEARCH_URL', 'elasticsearch+http://localhost:9200')
+SEARCH_TYPE = REGISTRY_SEARCH_URL.split('+')[0]
+
+GENERATION_KEY = 'search_api:generation:%s'
+INVALIDATED_KEY = 'search_api:invalidated:%s'
+RESPONSE_KEY = 'search_api:response:%s'
+STATS_KEY = 'search_api:stats:%s'
+STATS = ('hits', 'local_hits', 'misses')
+
+local_cache = LRUCache(maxsize=REGISTRY_SEARCH_CACHE_SIZE, timeout=REGISTRY_SEARCH_CACHE_TTL)
+# hits and misses of this process
+local_cache_stats = dict((name, 0) for name in STATS)
+
+
+def is_enabled():
+    return REGISTRY_SEARCH_CACHE_TTL > 0
+
+
+def new_generation():
+    # generations start from the current time, so a generation lost by the Django cache is not reused
+    return int(time.time())
+
+
+def get_index_name(catalog_slug):
+    if SEARCH_TYPE == 'solr':
+        # all the catalogs are searched in the same Solr core
+        return 'solr'
+    return catalog_slug
+
+
+def get_generation(catalog_slug):
+    index_name = get_index_name(catalog_slug)
+    generation = cache.get(GENERATION_KEY % index_name)
+    if generation is None:
+        cache.add(GENERATION_KEY % index_name, new_generation(), None)
+        generation = cache.get(GENERATION_KEY % index_name, 0)
+    return generation
+
+
+def invalidate(catalog_slugs=None):
+    """
+    Bump the index generation of the given catalogs (all the catalogs if None).
+    """
+    if SEARCH_TYPE == 'solr':
+        index_names = ['solr']
+    elif catalog_slugs is None:
+        from hypermap.aggregator.models import Catalog
+        index_names = Catalog.objects.values_list('slug', flat=True)
+    else:
+        index_names = catalog_slugs
+    for index_name in set(index_names):
+        try:
+            cache.incr(GENERATION_KEY % index_name)
+        except ValueError:
+            # not in the cache yet
+            cache.set(GENERATION_KEY % index_name, new_generation(), None)
+        cache.set(INVALIDATED_KEY % index_name, time.time(), None)
+        LOGGER.debug('Search cache invalidated for %s' % index_name)
+
+
+def get_key(catalog_slug, search_engine, params):
+    """
+    Return the cache key of a search: validated parameters are normalized, so equivalent queries share a key.
+    """
+    normalized = json.dumps(
+        [catalog_slug, search_engine, sorted((name, value) for name, value in params.items() if value is not None)],
+        default=unicode
+    )
+    digest = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+    return '%s:%s:%s' % (catalog_slug, get_generation(catalog_slug), digest)
+
+
+def is_settled(catalog_slug):
+    """
+    True if the last changes of the catalog index are visible to searches, so responses can be cached.
+    """
+    invalidated = cache.get(INVALIDATED_KEY % get_index_name(catalog_slug))
+    return invalidated is None or time.time() - invalidated >= REGISTRY_SEARCH_CACHE_DELAY
+
+
+def incr_stat(name):
+    local_cache_stats[name] += 1
+    try:
+        cache.incr(STATS_KEY % name)
+    except ValueError:
+        cache.add(STATS_KEY % name, 1, None)
+
+
+def get_response(key):
+    """
+    Return a cached (status, data) response, or None.
+    """
+    response = local_cache.get(key)
+    if response is not None:
+        incr_stat('local_hits')
+        return response
+    response = cache.get(RESPONSE_KEY % key)
+    if response is not None:
+        local_cache.set(key, response)
+        incr_stat('hits')
+        return response
+    incr_stat('misses')
+    return None
+
+
+def set_response(key, response):
+    local_cache.set(key, response)
+    cache.set(RESPONSE_KEY % key, response, REGISTRY_SEARCH_CACHE_TTL)
+
+
+def get_stats():
+    """
+    Return the hits (in memory and in the shared cache) and misses of all the processes, and the hit rate.
+    """
+    stats = dict((name, cache.get(STATS_KEY % name, 0)) for name in STATS)
+    total = sum(stats.values())
+    stats['hit_rate'] = (stats['hits'] + stats['local_hits']) / float(total) if total else None
+    stats['process'] = dict(local_cache_stats)
+    return stats
+
+
+def reset_stats():
+    for name in STATS:
+        cache.delete(STATS_KEY % name)
+        local_cache_stats[name] = 0
@@ -0,0 +1,1008 @@
+# -*- coding: utf-8 -*-
+"""
+Search engines of the Search API.
+
+A search engine answers the searches of a catalog and keeps its index of
+layers. The views and the indexing tasks use the same interface for every
+backend: a SearchQuery (the validated search params) goes in, and a
+(status, data) response following the swagger model comes out. The request
+parts are compiled once per query plan (see query_plan.py) for all the
+engines, and new engines are registered with REGISTRY_SEARCH_ENGINES.
+
+The local engine keeps the documents in memory, for the tests and the
+benchmarks which do not have a Solr or Elasticsearch at hand.
+"""
+
+import json
+import logging
+import math
+import re
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from hypermap.aggregator import search_transport
+from hypermap.aggregator.elasticsearch_client import ESHypermap
+from hypermap.search_api import export, heatmap
+from hypermap.search_api import query_plan
+from hypermap.search_api.utils import parse_geo_box, request_time_facet, \
+    request_heatmap_facet, gap_to_elastic, asterisk_to_min_max, \
+    encode_cursor, decode_cursor, parse_solr_time_range_as_pair
+
+LOGGER = logging.getLogger(__name__)
+
+TIME_FILTER_FIELD = "layer_date"
+GEO_FILTER_FIELD = "bbox"
+GEO_HEATMAP_FIELD = "bbox"
+USER_FIELD = "layer_originator"
+TEXT_FIELD = "title"
+TIME_SORT_FIELD = "layer_date"
+GEO_SORT_FIELD = "bbox"
+
+REGISTRY_SEARCH_URL = getattr(settings, "REGISTRY_SEARCH_URL", "elasticsearch+http://localhost:9200")
+
+SEARCH_TYPE = REGISTRY_SEARCH_URL.split('+')[0]
+SEARCH_URL = REGISTRY_SEARCH_URL.split('+')[1]
+
+# engines added to the built-in ones, as {name: dotted path of a SearchEngine subclass}
+REGISTRY_SEARCH_ENGINES = getattr(settings, 'REGISTRY_SEARCH_ENGINES', {})
+
+ENGINES = {
+    'solr': 'hypermap.search_api.engines.SolrEngine',
+    'elasticsearch': 'hypermap.search_api.engines.ElasticsearchEngine',
+    'local': 'hypermap.search_api.engines.LocalEngine',
+}
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+class SearchQuery(object):
+    """
+    Normalized search, read by the engines: the validated search params are attributes
+    (query.q_text, query.d_docs_limit...), None when not given.
+    """
+
+    def __init__(self, serializer):
+        # a validated SearchSerializer, or a QueryPlan
+        self.serializer = serializer
+        self.validated_data = serializer.validated_data
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.validated_data.get(name)
+
+    def compiled(self, name, build, *args):
+        """
+        Return build(*args), compiled once per query plan.
+        """
+        return query_plan.compiled(self.serializer, name, build, *args)
+
+
+class SearchEngine(object):
+    """
+    Interface of the search engines. Subclasses implement execute, documents and the indexing methods.
+    """
+
+    name = None
+
+    def search(self, query, catalog):
+        """
+        Search a catalog.
+        :return: (status, data) tuple, data follows the swagger model of the responses
+        (or is the response of the backend with original_response).
+        """
+        try:
+            result = self.execute(query, catalog)
+        except Exception, e:
+            LOGGER.error(e, exc_info=True)
+            return 500, {"error": {"msg": str(e)}}
+        if type(result) is tuple:
+            return result
+        return 400 if 'error' in result else 200, result
+
+    def execute(self, query, catalog):
+        """
+        Search a catalog, returns the data of the response or a (status, data) tuple.
+        """
+        raise NotImplementedError
+
+    def documents(self, query, catalog, fields=None):
+        """
+        Yield all the documents matching the q params of a query, for the export.
+        """
+        raise NotImplementedError
+
+    def index_layers(self, layers):
+        """
+        Index a queryset of layers, returns (success, errors).
+        """
+        raise NotImplementedError
+
+    def index_layer(self, layer):
+        """
+        Index a layer, returns (success, message).
+        """
+        raise NotImplementedError
+
+    def remove_layer(self, layer):
+        raise NotImplementedError
+
+    def remove_layers(self, layers):
+        """
+        Remove a list of layers from the index, raises an exception if they could not be removed.
+        """
+        for layer in layers:
+            self.remove_layer(layer)
+
+    def clear(self):
+        raise NotImplementedError
+
+
+def get_engine(name=None):
+    """
+    Return the search engine registered with a name, the one of REGISTRY_SEARCH_URL by default.
+    """
+    name = name or SEARCH_TYPE
+    with _engines_lock:
+        if name not in _engines:
+            path = REGISTRY_SEARCH_ENGINES.get(name) or ENGINES.get(name)
+            if path is None:
+                raise Exception("Incorrect search engine: %s" % name)
+            _engines[name] = import_string(path)()
+        return _engines[name]
+
+
+def count_facet(values, limit):
+    """
+    [{"value": ..., "count": ...}] facet of the values, most frequent values first.
+    """
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    facet = [{"value": value, "count": count} for value, count in counts.items()]
+    facet.sort(key=lambda item: (-item["count"], item["value"]))
+    return facet[:limit]
+
+
+def pairs_facet(values):
+    """
+    [{"value": ..., "count": ...}] facet of a flat [value, count, value, count...] Solr list.
+    """
+    value_count = iter(values)
+    return [{"value": value, "count": count} for value, count in zip(value_count, value_count)]
+
+
+def elasticsearch_user_filter(q_user, es_version):
+    """
+    Elasticsearch filter of q_user.
+    """
+    user_match = {
+        "match": {
+            "layer_originator": q_user
+        }
+    }
+    if es_version < 2:
+        # queries are wrapped to be used as filters
+        return {"query": user_match}
+    return user_match
+
+
+def elasticsearch_filters(q_time, q_geo, q_user, es_version):
+    """
+    Elasticsearch filters of the q_time, q_geo and q_user params. They do not score the documents,
+    so Elasticsearch caches them.
+    :return: list of filter clauses.
+    """
+    filters = []
+
+    if q_time:
+        gte, lte = parse_solr_time_range_as_pair(str(q_time))
+        layer_date = {}
+        if gte != '*':
+            layer_date["gte"] = gte  # greater than
+        if lte != '*':
+            layer_date["lte"] = lte  # less than
+        if layer_date:
+            filters.append({"range": {"layer_date": layer_date}})
+
+    # geo_shape searching
+    if q_geo:
+        q_geo = str(q_geo)
+        q_geo = q_geo[1:-1]
+        Ymin, Xmin = q_geo.split(" TO ")[0].split(",")
+        Ymax, Xmax = q_geo.split(" TO ")[1].split(",")
+        geoshape_query = {
+            "layer_geoshape": {
+                "shape": {
+                    "type": "envelope",
+                    "coordinates": [[Xmin, Ymax], [Xmax, Ymin]]
+                },
+                "relation": "intersects"
+            }
+        }
+        filters.append({"geo_shape": geoshape_query})
+
+    if q_user:
+        filters.append(elasticsearch_user_filter(q_user, es_version))
+
+    return filters
+
+
+def elasticsearch_query(q_text, q_time, q_geo, q_user, es_version):
+    """
+    Elasticsearch query of the q_ params, shared by the search and the export. Only q_text scores
+    the documents, the other params are filters.
+    :return: search body, with the query only.
+    """
+    filters = elasticsearch_filters(q_time, q_geo, q_user, es_version)
+
+    # String searching
+    query_string = None
+    if q_text:
+        query_string = {
+            "query_string": {
+                "query": q_text
+            }
+        }
+
+    if es_version >= 2:
+        dic_query = {
+            "query": {
+                "bool": {
+                    "must": [query_string] if query_string else [],
+                    "filter": filters
+                }
+            }
+        }
+    else:
+        filtered = {
+            "query": query_string or {"match_all": {}}
+        }
+        if filters:
+            filtered["filter"] = {
+                "bool": {
+                    "must": filters
+                }
+            }
+        dic_query = {
+            "query": {
+                "filtered": filtered
+            }
+        }
+
+    return dic_query
+
+
+def elasticsearch_body(validated_data, es_version):
+    """
+    Elasticsearch request body of a search.
+    :return: the JSON body, or an error dict (a 400 response) if the params can not be searched.
+    """
+
+    q_text = validated_data.get("q_text")
+    q_time = validated_data.get("q_time")
+    q_geo = validated_data.get("q_geo")
+    q_user = validated_data.get("q_user")
+    d_docs_sort = validated_data.get("d_docs_sort")
+    d_docs_limit = int(validated_data.get("d_docs_limit"))
+    d_docs_page = int(validated_data.get("d_docs_page"))
+    d_docs_cursor = validated_data.get("d_docs_cursor")
+    d_docs_fields = validated_data.get("d_docs_fields")
+    a_text_limit = validated_data.get("a_text_limit")
+    a_user_limit = validated_data.get("a_user_limit")
+    a_time_gap = validated_data.get("a_time_gap")
+    a_time_limit = validated_data.get("a_time_limit")
+
+    aggs_dic = {}
+
+    # as the tagged user fq of Solr, q_user filters the documents and the other facets, but not the users facet
+    user_post_filter = bool(q_user and a_user_limit)
+    dic_query = elasticsearch_query(q_text, q_time, q_geo, None if user_post_filter else q_user, es_version)
+    if q_time:
+        gte, lte = parse_solr_time_range_as_pair(str(q_time))
+
+    # Page
+    if d_docs_limit:
+        dic_query["size"] = d_docs_limit
+
+    if d_docs_page:
+        dic_query["from"] = d_docs_limit * d_docs_page - d_docs_limit
+
+    if d_docs_fields:
+        dic_query["_source"] = list(d_docs_fields)
+
+    if d_docs_sort == "score":
+        dic_query["sort"] = {"_score": {"order": "desc"}}
+
+    if d_docs_sort == "time":
+        dic_query["sort"] = {"layer_date": {"order": "desc"}}
+
+    if d_docs_sort == "distance":
+        if q_geo:
+            # distance_x = float(((float(Xmin) - float(Xmax)) ** 2.0) ** (0.5))
+            # distance_y = float(((float(Ymin) - float(Ymax)) ** 2.0) ** (0.5))
+            msg = ("Sorting by distance is different on ElasticSearch than Solr, because this"
+                   "feature on elastic is unavailable to geo_shape type.ElasticSearch docs said:"
+                   "Due to the complex input structure and index representation of shapes,"
+                   "it is not currently possible to sort shapes or retrieve their fields directly."
+                   "The geo_shape value is only retrievable through the _source field."
+                   " Link: https://www.elastic.co/guide/en/elasticsearch/reference/current/geo-shape.html")
+            return {"error": {"msg": msg}}
+
+        else:
+            msg = "q_qeo MUST BE NO ZERO if you wanna sort by distance"
+            return {"error": {"msg": msg}}
+
+    if d_docs_cursor:
+        # pages start after the sort values of the last document of the previous page,
+        # with the unique document id as tiebreak so the order is stable.
+        if es_version < 5:
+            return {"error": {"msg": "d_docs_cursor requires Elasticsearch 5 or later"}}
+        dic_query.pop("from", None)
+        dic_query["sort"] = [
+            dic_query.get("sort", {"_score": {"order": "desc"}}),
+            {"_uid" if es_version < 6 else "_id": {"order": "asc"}}
+        ]
+        if d_docs_cursor != "*":
+            search_after = decode_cursor(d_docs_cursor)
+            if search_after is None:
+                return {"error": {"msg": "invalid d_docs_cursor"}}
+            dic_query["search_after"] = search_after
+
+    if a_text_limit:
+        # getting most frequently occurring users.
+        text_limit = {
+            "terms": {
+                "field": "abstract",
+                "size": a_text_limit
+            }
+        }
+        aggs_dic['popular_text'] = text_limit
+
+    if a_user_limit:
+        # getting most frequently occurring users.
+        users_limit = {
+
+            "terms": {
+                "field": "layer_originator",
+                "size": a_user_limit
+            }
+        }
+        aggs_dic['popular_users'] = users_limit
+
+    if a_time_limit:
+        # TODO: Work in progress, a_time_limit is incomplete.
+        # TODO: when times are * it does not work. also a a_time_gap is not required.
+        if q_time:
+            if not a_time_gap:
+                # getting time limit histogram.
+                time_limt = {
+                    "date_range": {
+                        "field": "layer_date",
+                        "format": "yyyy-MM-dd'T'HH:mm:ssZ",
+                        "ranges": [
+                            {"from": gte, "to": lte}
+                        ]
+                    }
+                }
+                aggs_dic['range'] = time_limt
+            else:
+                pass
+
+        else:
+            msg = "If you want to use a_time_limit feature, q_time MUST BE initialized"
+            return {"error": {"msg": msg}}
+
+    if a_time_gap:
+        interval = gap_to_elastic(a_time_gap)
+        time_gap = {
+            "date_histogram": {
+                "field": "layer_date",
+                "format": "yyyy-MM-dd'T'HH:mm:ssZ",
+                "interval": interval
+            }
+        }
+        aggs_dic['articles_over_time'] = time_gap
+
+    if user_post_filter:
+        user_filter = elasticsearch_user_filter(q_user, es_version)
+        dic_query["post_filter"] = user_filter
+        user_aggs = dict((name, agg) for name, agg in aggs_dic.items() if name != 'popular_users')
+        if user_aggs:
+            aggs_dic = {
+                'popular_users': aggs_dic['popular_users'],
+                'user_filtered': {
+                    "filter": user_filter,
+                    "aggs": user_aggs
+                }
+            }
+
+    # adding aggreations on body query
+    if aggs_dic:
+        dic_query['aggs'] = aggs_dic
+
+    return json.dumps(dic_query)
+
+
+def solr_filters(q_time, q_geo, q_user):
+    """
+    Solr filter queries of the q_ params, shared by the search and the export.
+    :return: list of fq params.
+    """
+    filters = []
+    if q_time:
+        # TODO: when user sends incomplete dates like 2000, its completed: 2000-(TODAY-MONTH)-(TODAY-DAY)T00:00:00Z
+        # TODO: "Invalid Date in Date Math String:'[* TO 2000-12-05T00:00:00Z]'"
+        # Kotlin like: "{!field f=layer_date tag=layer_date}[* TO 2000-12-05T00:00:00Z]"
+        # then do it simple:
+        filters.append("{0}:{1}".format(TIME_FILTER_FIELD, q_time))
+    if q_geo:
+        filters.append("{0}:{1}".format(GEO_FILTER_FIELD, q_geo))
+
+    if q_user:
+        filters.append("{{!field f={0} tag={0}}}{1}".format(USER_FIELD, q_user))
+
+    return filters
+
+
+def solr_params(validated_data):
+    """
+    Solr params of a search, but its time and heatmap facets which depend on the index.
+    :param validated_data:
+    :return:
+    """
+    q_time = validated_data.get("q_time")
+    q_geo = validated_data.get("q_geo")
+    q_text = validated_data.get("q_text")
+    q_user = validated_data.get("q_user")
+    d_docs_limit = validated_data.get("d_docs_limit")
+    d_docs_page = validated_data.get("d_docs_page")
+    d_docs_sort = validated_data.get("d_docs_sort")
+    d_docs_cursor = validated_data.get("d_docs_cursor")
+    d_docs_fields = validated_data.get("d_docs_fields")
+    a_text_limit = validated_data.get("a_text_limit")
+    a_user_limit = validated_data.get("a_user_limit")
+
+    # query params to be sent via restful solr
+    params = {
+        "q": "*:*",
+        "indent": "on",
+        "wt": "json",
+        "rows": d_docs_limit,
+        "facet": "off",
+        "facet.field": [],
+        "debug": "timing"
+    }
+    if q_text:
+        params["q"] = q_text
+
+    if d_docs_limit >= 0:
+        d_docs_page -= 1
+        d_docs_page = d_docs_limit * d_docs_page
+        params["start"] = d_docs_page
+
+    if d_docs_fields:
+        params["fl"] = ','.join(d_docs_fields)
+
+    # query params for filters
+    filters = solr_filters(q_time, q_geo, q_user)
+    if filters:
+        params["fq"] = filters
+
+    # query params for ordering
+    if d_docs_sort == 'score' and q_text:
+        params["sort"] = 'score desc'
+    elif d_docs_sort == 'time':
+        params["sort"] = '{} desc'.format(TIME_SORT_FIELD)
+    elif d_docs_sort == 'distance':
+        rectangle = parse_geo_box(q_geo)
+        params["sort"] = 'geodist() asc'
+        params["sfield"] = GEO_SORT_FIELD
+        params["pt"] = '{0},{1}'.format(rectangle.centroid.x, rectangle.centroid.y)
+
+    if d_docs_cursor:
+        # cursorMark pages need the uniqueKey as tiebreak, and no start.
+        params.pop("start", None)
+        params["cursorMark"] = d_docs_cursor
+        params["sort"] = '{0},id asc'.format(params.get("sort", 'score desc'))
+
+    # query params for facets
+    if a_text_limit > 0:
+        params["facet"] = 'on'
+        params["facet.field"].append(TEXT_FIELD)
+        params["f.{}.facet.limit".format(TEXT_FIELD)] = a_text_limit
+
+    if a_user_limit > 0:
+        params["facet"] = 'on'
+        params["facet.field"].append("{{! ex={0}}}{0}".format(USER_FIELD))
+        params["f.{}.facet.limit".format(USER_FIELD)] = a_user_limit
+
+    return params
+
+
+class SolrEngine(SearchEngine):
+    """
+    Searches the Solr core of search_engine_endpoint, indexes the layers in the hypermap core.
+    """
+
+    name = 'solr'
+
+    def request_params(self, query, catalog=None):
+        """
+        Params of the Solr request of a search, and its heatmap if assembled from the cached tiles.
+        :param query:
+        :param catalog: searched catalog, heatmap tiles are cached when given.
+        :return: (params, heatmap or None)
+        """
+        # the facets added below do not change the lists of the compiled params
+        params = dict(query.compiled('solr', solr_params, query.validated_data))
+
+        if query.a_time_limit > 0:
+            params["facet"] = 'on'
+            time_filter = query.a_time_filter or query.q_time or None
+
+            # traduce * to actual min/max dates.
+            time_filter = asterisk_to_min_max(TIME_FILTER_FIELD, time_filter, query.search_engine_endpoint)
+
+            # create the range faceting params.
+            facet_parms = query.compiled(('solr_time_facet', time_filter), request_time_facet,
+                                         TIME_FILTER_FIELD, time_filter, query.a_time_gap, query.a_time_limit)
+            params.update(facet_parms)
+
+        hm_facet = None
+        if query.a_hm_limit > 0 and catalog and heatmap.is_enabled() and not query.original_response:
+            # assembled from the cached tiles, the heatmap is not counted by the search request
+            hm_facet = heatmap.get_heatmap(query.search_engine_endpoint, catalog.slug, params, GEO_HEATMAP_FIELD,
+                                           query.a_hm_filter, query.a_hm_gridlevel, query.a_hm_limit)
+
+        if query.a_hm_limit > 0 and hm_facet is None:
+            params["facet"] = 'on'
+            hm_facet_params = query.compiled('solr_heatmap_facet', request_heatmap_facet, GEO_HEATMAP_FIELD,
+                                             query.a_hm_filter, query.a_hm_gridlevel, query.a_hm_limit)
+            params.update(hm_facet_params)
+
+        return params, hm_facet
+
+    def execute(self, query, catalog):
+        params, hm_facet = self.request_params(query, catalog)
+
+        try:
+            res = search_transport.get(
+                query.search_engine_endpoint, params=params
+            )
+        except Exception as e:
+            return 500, {"error": {"msg": str(e)}}
+
+        solr_response = res.json()
+        solr_response["solr_request"] = res.url
+
+        if query.original_response > 0:
+            return solr_response
+
+        # create the response dict following the swagger model:
+        data = {}
+
+        if 'error' in solr_response:
+            data["error"] = solr_response["error"]
+            return 400, data
+
+        response = solr_response["response"]
+        data["a.matchDocs"] = response.get("numFound")
+
+        if response.get("docs"):
+            data["d.docs"] = response.get("docs")
+
+        if query.d_docs_cursor:
+            # Solr returns the same cursor after the last page
+            next_cursor = solr_response.get("nextCursorMark")
+            data["d.docs.nextCursor"] = next_cursor if next_cursor != query.d_docs_cursor else None
+
+        if query.a_time_limit > 0:
+            date_facet = solr_response["facet_counts"]["facet_ranges"][TIME_FILTER_FIELD]
+            data["a.time"] = {
+                "start": date_facet.get("start"),
+                "end": date_facet.get("end"),
+                "gap": date_facet.get("gap"),
+                "counts": pairs_facet(date_facet.get("counts"))
+            }
+
+        if hm_facet is not None:
+            data["a.hm"] = hm_facet
+        elif query.a_hm_limit > 0:
+            hm_facet_raw = solr_response["facet_counts"]["facet_heatmaps"][GEO_HEATMAP_FIELD]
+            hm_facet = {
+                'gridLevel': hm_facet_raw[1],
+                'columns': hm_facet_raw[3],
+                'rows': hm_facet_raw[5],
+                'minX': hm_facet_raw[7],
+                'maxX': hm_facet_raw[9],
+                'minY': hm_facet_raw[11],
+                'maxY': hm_facet_raw[13],
+                'counts_ints2D': hm_facet_raw[15],
+                'projection': 'EPSG:4326'
+            }
+            data["a.hm"] = hm_facet
+
+        if query.a_user_limit > 0:
+            data["a.user"] = pairs_facet(solr_response["facet_counts"]["facet_fields"][USER_FIELD])
+
+        if query.a_text_limit > 0:
+            data["a.text"] = pairs_facet(solr_response["facet_counts"]["facet_fields"][TEXT_FIELD])
+
+        subs = []
+        for label, values in solr_response["debug"]["timing"].iteritems():
+            if type(values) is not dict:
+                continue
+            subs_data = {"label": label, "subs": []}
+            for label, values in values.iteritems():
+                if type(values) is not dict:
+                    subs_data["millis"] = values
+                    continue
+                subs_data["subs"].append({
+                    "label": label,
+                    "millis": values.get("time")
+                })
+            subs.append(subs_data)
+
+        timing = {
+            "label": "requests.get.elapsed",
+            "millis": res.elapsed,
+            "subs": [{
+                "label": "QTime",
+                "millis": solr_response["responseHeader"].get("QTime"),
+                "subs": subs
+            }]
+        }
+
+        data["timing"] = timing
+        data["request_url"] = res.url
+
+        return data
+
+    def documents(self, query, catalog, fields=None):
+        from hypermap.aggregator.solr import SOLR_CORE_URL
+
+        return export.solr_documents(
+            query.search_engine_endpoint or '%s/select' % SOLR_CORE_URL, query.q_text,
+            solr_filters(query.q_time, query.q_geo, query.q_user), fields
+        )
+
+    def index_layers(self, layers):
+        from hypermap.aggregator.solr import SolrHypermap
+
+        return SolrHypermap().layers_to_solr(layers)
+
+    def index_layer(self, layer):
+        from hypermap.aggregator.solr import SolrHypermap
+
+        LOGGER.debug('Syncing layer %s to solr' % layer.name)
+        return SolrHypermap().layer_to_solr(layer)
+
+    def remove_layer(self, layer):
+        from hypermap.aggregator.solr import SolrHypermap
+
+        LOGGER.debug('Removing layer %s from solr' % layer.id)
+        SolrHypermap().remove_layer(layer.uuid)
+
+    def remove_layers(self, layers):
+        from hypermap.aggregator.solr import SolrHypermap
+
+        LOGGER.debug('Removing %s layers from solr' % len(layers))
+        SolrHypermap().remove_layers([layer.uuid for layer in layers])
+
+    def clear(self):
+        from hypermap.aggregator.solr import SolrHypermap
+
+        LOGGER.debug('Clearing the solr indexes')
+        SolrHypermap().clear_solr()
+
+
+class ElasticsearchEngine(SearchEngine):
+    """
+    Searches and indexes the layers of a catalog in the Elasticsearch index named by its slug.
+    """
+
+    name = 'elasticsearch'
+
+    def request_body(self, query, es_version):
+        return query.compiled(('elasticsearch', es_version), elasticsearch_body, query.validated_data, es_version)
+
+    def execute(self, query, catalog):
+        """
+        https://www.elastic.co/guide/en/elasticsearch/reference/current/_the_search_api.html
+        """
+        search_engine_endpoint = "{0}/{1}/_search".format(SEARCH_URL, catalog.slug)
+
+        d_docs_limit = int(query.d_docs_limit)
+
+        # get ES version to make the query builder to be backward compatible with
+        # diffs versions.
+        # TODO: ask for ES_VERSION when building queries with an elegant way.
+        ES_VERSION = ESHypermap.get_version()
+
+        request_body = self.request_body(query, ES_VERSION)
+        if not isinstance(request_body, basestring):
+            return 400, request_body
+        if query.q_time:
+            gte, lte = parse_solr_time_range_as_pair(str(query.q_time))
+
+        try:
+            res = search_transport.post(search_engine_endpoint, data=request_body)
+        except Exception as e:
+            return 500, {"error": {"msg": str(e)}}
+
+        es_response = res.json()
+
+        if query.original_response:
+            return es_response
+
+        data = {}
+
+        if 'error' in es_response:
+            data["error"] = es_response["error"]
+            return 400, data
+
+        data["request_url"] = res.url
+        data["request_body"] = request_body
+        data["a.matchDocs"] = es_response['hits']['total']
+        docs = []
+        # aggreations response: facets searching
+        if 'aggregations' in es_response:
+            aggs = es_response['aggregations']
+            # aggregations filtered by the user, see elasticsearch_body
+            aggs.update(aggs.pop('user_filtered', {}))
+            # getting the most frequently occurring users.
+            if 'popular_users' in aggs:
+                data["a.user"] = [{'count': item['doc_count'], 'value': item['key']}
+                                  for item in aggs["popular_users"]["buckets"]]
+
+            # getting most frequently ocurring words
+            if 'popular_text' in aggs:
+                data["a.text"] = [{'count': item['doc_count'], 'value': item['key']}
+                                  for item in aggs["popular_text"]["buckets"]]
+
+            if 'articles_over_time' in aggs:
+                gap_count = []
+                a_gap = {}
+                gap_resp = aggs["articles_over_time"]["buckets"]
+
+                start = "*"
+                end = "*"
+
+                if len(gap_resp) > 0:
+                    start = gap_resp[0]['key_as_string'].replace('+0000', 'z')
+                    end = gap_resp[-1]['key_as_string'].replace('+0000', 'z')
+
+                a_gap['start'] = start
+                a_gap['end'] = end
+                a_gap['gap'] = query.a_time_gap
+
+                for item in gap_resp:
+                    temp = {}
+                    if item['doc_count'] != 0:
+                        temp['count'] = item['doc_count']
+                        temp['value'] = item['key_as_string'].replace('+0000', 'z')
+                        gap_count.append(temp)
+                a_gap['counts'] = gap_count
+                data['a.time'] = a_gap
+
+            if 'range' in aggs:
+                # Work in progress
+                # Pay attention in the following code lines: Make it better!!!!
+                time_count = []
+                time_resp = aggs["range"]["buckets"]
+                a_time = {}
+                a_time['start'] = gte
+                a_time['end'] = lte
+                a_time['gap'] = None
+
+                for item in time_resp:
+                    temp = {}
+                    if item['doc_count'] != 0:
+                        temp['count'] = item['doc_count']
+                        temp['value'] = item['key'].replace('+0000', 'z')
+                        time_count.append(temp)
+                a_time['counts'] = time_count
+                data['a.time'] = a_time
+
+        if not int(d_docs_limit) == 0:
+            for item in es_response['hits']['hits']:
+                # data
+                if 'abstract' in item['_source']:
+                    temp = item['_source']['abstract']
+                    temp = temp.replace(u'\u201c', "\"")
+                    temp = temp.replace(u'\u201d', "\"")
+                    temp = temp.replace('"', "\"")
+                    temp = temp.replace("'", "\'")
+                    temp = temp.replace(u'\u2019', "\'")
+                    item['_source']['abstract'] = temp
+                docs.append(item['_source'])
+
+        data["d.docs"] = docs
+
+        if query.d_docs_cursor:
+            hits = es_response['hits']['hits']
+            data["d.docs.nextCursor"] = None
+            if hits and len(hits) == d_docs_limit:
+                data["d.docs.nextCursor"] = encode_cursor(hits[-1]['sort'])
+
+        return data
+
+    def documents(self, query, catalog, fields=None):
+        es_version = ESHypermap.get_version()
+        return export.elasticsearch_documents(
+            catalog.slug, elasticsearch_query(query.q_text, query.q_time, query.q_geo, query.q_user, es_version),
+            es_version, fields
+        )
+
+    def index_layers(self, layers):
+        from elasticsearch import helpers
+
+        layers_to_index = ESHypermap.layers_to_es(layers)
+        message = helpers.bulk(ESHypermap.es, layers_to_index)
+
+        # Check that all layers where indexed...if not, keep them in the queue.
+        # TODO: Check why es does not index all layers at first.
+        len_indexed_layers = message[0]
+        if len_indexed_layers == len(layers_to_index):
+            LOGGER.debug('%d layers indexed successfully' % (len_indexed_layers))
+            return True, []
+        return False, message
+
+    def index_layer(self, layer):
+        LOGGER.debug('Syncing layer %s to es' % layer.name)
+        return ESHypermap.layer_to_es(layer)
+
+    def remove_layer(self, layer):
+        LOGGER.debug('Removing layer %s from es' % layer.id)
+        ESHypermap.es.delete(index=layer.catalog.slug, doc_type='layer', id=str(layer.id), ignore=404)
+
+    def remove_layers(self, layers):
+        from elasticsearch import helpers
+
+        LOGGER.debug('Removing %s layers from es' % len(layers))
+        actions = [{'_op_type': 'delete', '_index': layer.catalog.slug, '_type': 'layer', '_id': str(layer.id)}
+                   for layer in layers]
+        deleted, errors = helpers.bulk(ESHypermap.es, actions, raise_on_error=False)
+        # layers which were not indexed are removed
+        errors = [error for error in errors if error.get('delete', {}).get('status') != 404]
+        if errors:
+            raise Exception('%s layers could not be removed from es: %s' % (len(errors), errors))
+
+    def clear(self):
+        LOGGER.debug('Clearing the ES indexes')
+        ESHypermap.clear_es()
+
+
+class LocalEngine(SearchEngine):
+    """
+    Searches documents kept in memory, by catalog slug. q.text matches the documents containing all its words
+    in their title, abstract or keywords, the a.time and a.hm facets are not supported.
+    """
+
+    name = 'local'
+    WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self):
+        self.indexes = {}
+        self._lock = threading.Lock()
+
+    def add_documents(self, catalog_slug, docs):
+        with self._lock:
+            index = self.indexes.setdefault(catalog_slug, {})
+            for doc in docs:
+                index[doc['id']] = doc
+
+    def words(self, text):
+        return set(word.lower() for word in self.WORD_RE.findall(text or ''))
+
+    def matches(self, doc, q_text, q_time, q_geo, q_user):
+        if q_text:
+            text = u' '.join([doc.get('title') or '', doc.get('abstract') or ''] + doc.get('keywords', []))
+            if not q_text <= self.words(text):
+                return False
+        if q_time:
+            layer_date = doc.get('layer_date')
+            start, end = q_time
+            if layer_date is None or (start != '*' and layer_date < start) or (end != '*' and layer_date > end):
+                return False
+        if q_geo:
+            min_y, min_x, max_y, max_x = q_geo
+            if 'min_x' not in doc or doc['min_x'] > max_x or doc['max_x'] < min_x or \
+                    doc['min_y'] > max_y or doc['max_y'] < min_y:
+                return False
+        if q_user and doc.get(USER_FIELD) != q_user:
+            return False
+        return True
+
+    def filter(self, query, catalog):
+        """
+        Documents of a catalog matching the q params of a query, in index order.
+        """
+        q_text = None
+        if query.q_text and query.q_text.strip() not in ('*', '*:*'):
+            q_text = self.words(query.q_text)
+        q_time = parse_solr_time_range_as_pair(query.q_time) if query.q_time else None
+        # the box is parsed as (y, x)
+        q_geo = parse_geo_box(query.q_geo).bounds if query.q_geo else None
+        with self._lock:
+            docs = list(self.indexes.get(catalog.slug, {}).values())
+        docs.sort(key=lambda doc: doc['id'])
+        return [doc for doc in docs if self.matches(doc, q_text, q_time, q_geo, query.q_user)]
+
+    def execute(self, query, catalog):
+        if query.a_time_limit > 0 or query.a_hm_limit > 0:
+            return 400, {"error": {"msg": "a.time and a.hm facets are not supported by the local engine"}}
+        if query.d_docs_sort == 'distance' and not query.q_geo:
+            return 400, {"error": {"msg": "q_qeo MUST BE NO ZERO if you wanna sort by distance"}}
+
+        docs = self.filter(query, catalog)
+        data = {"a.matchDocs": len(docs)}
+
+        if query.a_user_limit > 0:
+            data["a.user"] = count_facet([doc.get(USER_FIELD) for doc in docs], query.a_user_limit)
+        if query.a_text_limit > 0:
+            data["a.text"] = count_facet(
+                [word for doc in docs for word in self.words(doc.get(TEXT_FIELD))], query.a_text_limit
+            )
+
+        if query.d_docs_sort == 'time':
+            docs.sort(key=lambda doc: doc.get(TIME_SORT_FIELD) or '', reverse=True)
+        elif query.d_docs_sort == 'distance':
+            center = parse_geo_box(query.q_geo).centroid
+            docs.sort(key=lambda doc: math.hypot(doc.get('centroid_x', 0) - center.y,
+                                                 doc.get('centroid_y', 0) - center.x))
+
+        limit = query.d_docs_limit
+        start = limit * (query.d_docs_page - 1)
+        if query.d_docs_cursor:
+            # the cursor holds the position of the next document
+            start = 0
+            if query.d_docs_cursor != '*':
+                position = decode_cursor(query.d_docs_cursor)
+                if not position or not isinstance(position[0], int) or position[0] < 0:
+                    return {"error": {"msg": "invalid d_docs_cursor"}}
+                start = position[0]
+            data["d.docs.nextCursor"] = encode_cursor([start + limit]) if start + limit < len(docs) else None
+        if limit > 0:
+            data["d.docs"] = [self.project(doc, query.d_docs_fields) for doc in docs[start:start + limit]]
+        return data
+
+    def project(self, doc, fields):
+        if fields:
+            return dict((field, doc[field]) for field in fields if field in doc)
+        return doc
+
+    def documents(self, query, catalog, fields=None):
+        for doc in self.filter(query, catalog):
+            yield self.project(doc, fields)
+
+    def index_layers(self, layers):
+        from hypermap.aggregator.utils import prefetch_layers
+
+        errors = []
+        for layer in prefetch_layers(layers):
+            success, message = self.index_layer(layer)
+            if not success:
+                errors.append([layer.id, message])
+        return True, errors
+
+    def index_layer(self, layer):
+        from hypermap.aggregator.utils import layer2dict
+
+        layer_dict, message = layer2dict(layer)
+        if not layer_dict:
+            return False, message
+        self.add_documents(layer.catalog.slug, [layer_dict])
+        return True, message
+
+    def remove_layer(self, layer):
+        with self._lock:
+            self.indexes.get(layer.catalog.slug, {}).pop(layer.id, None)
+
+    def clear(self):
+        with self._lock:
+            self.indexes.clear()
@@ -0,0 +1,120 @@
+"""
+Streaming export of the documents matching a search.
+
+Documents are read from the search backend a batch at a time (Solr cursorMark
+pages, Elasticsearch scroll) and written to the response as soon as they are
+read, as NDJSON (a JSON document per line) or CSV, so the memory used by an
+export does not depend on its number of documents.
+"""
+
+import csv
+import json
+import logging
+
+from StringIO import StringIO
+
+from django.conf import settings
+
+from hypermap.aggregator import search_transport
+
+LOGGER = logging.getLogger(__name__)
+
+# documents read from the search backend per request
+REGISTRY_SEARCH_EXPORT_BATCH_SIZE = getattr(settings, 'REGISTRY_SEARCH_EXPORT_BATCH_SIZE', 1000)
+
+# fields exported in CSV when none are requested
+CSV_FIELDS = ['id', 'title', 'layer_date', 'layer_originator', 'url', 'domain_name',
+              'min_x', 'min_y', 'max_x', 'max_y']
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+def solr_documents(search_engine_endpoint, q, filters, fields=None, batch_size=None):
+    """
+    Yield the documents matching a Solr query, requested in pages of batch_size documents with cursorMark.
+    """
+    params = {
+        'q': q or '*:*',
+        'fq': filters,
+        'rows': batch_size or REGISTRY_SEARCH_EXPORT_BATCH_SIZE,
+        'sort': 'id asc',
+        'wt': 'json',
+    }
+    if fields:
+        params['fl'] = ','.join(fields)
+    cursor = '*'
+    while True:
+        params['cursorMark'] = cursor
+        res = search_transport.get(search_engine_endpoint, params=params)
+        res.raise_for_status()
+        solr_response = res.json()
+        for doc in solr_response['response']['docs']:
+            yield doc
+        # Solr returns the same cursor after the last page
+        if solr_response['nextCursorMark'] == cursor:
+            return
+        cursor = solr_response['nextCursorMark']
+
+
+def elasticsearch_documents(index, query, es_version, fields=None, batch_size=None):
+    """
+    Yield the documents matching an Elasticsearch query, scrolled in batches of batch_size documents.
+    """
+    from elasticsearch import helpers
+    from hypermap.aggregator.elasticsearch_client import ESHypermap
+
+    query = dict(query)
+    if fields:
+        query['_source'] = fields
+    if es_version >= 2:
+        # scrolling in index order is as cheap as the deprecated scan search type
+        query['sort'] = ['_doc']
+    for hit in helpers.scan(ESHypermap.es, query=query, index=index, scroll='2m',
+                            preserve_order=es_version >= 2, size=batch_size or REGISTRY_SEARCH_EXPORT_BATCH_SIZE):
+        yield hit['_source']
+
+
+def ndjson_lines(docs):
+    for doc in docs:
+        yield json.dumps(doc) + '\n'
+
+
+def csv_lines(docs, fields=None):
+    fields = fields or CSV_FIELDS
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    def line(values):
+        writer.writerow(values)
+        value = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return value
+
+    def encode(value):
+        if value is None:
+            return ''
+        if isinstance(value, list):
+            value = '|'.join(unicode(item) for item in value)
+        return unicode(value).encode('utf-8')
+
+    yield line(fields)
+    for doc in docs:
+        yield line([encode(doc.get(field)) for field in fields])
+
+
+def export_lines(docs, export_format, fields=None):
+    """
+    Return a generator of the lines of an export, logging the errors of the search backend
+    (the response is already being sent when they happen).
+    """
+    lines = csv_lines(docs, fields) if export_format == 'csv' else ndjson_lines(docs)
+    try:
+        for line in lines:
+            yield line
+    except Exception, e:
+        LOGGER.error('Export interrupted: %s' % e, exc_info=True)
+        raise
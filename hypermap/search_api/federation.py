@@ -0,0 +1,145 @@
+"""
+Federated search of several catalogs.
+
+The catalogs, local or remote, are searched concurrently by a pool of threads,
+each within REGISTRY_SEARCH_FEDERATION_TIMEOUT seconds, and their responses are
+merged: match counts and facet counts are added, and documents are
+interleaved. Catalogs which time out or fail are reported in the response,
+which is then partial.
+"""
+
+import logging
+import time
+
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+
+LOGGER = logging.getLogger(__name__)
+
+# seconds a catalog has to answer a federated search
+REGISTRY_SEARCH_FEDERATION_TIMEOUT = getattr(settings, 'REGISTRY_SEARCH_FEDERATION_TIMEOUT', 10)
+
+
+def merge_counts(facets, limit=None):
+    """
+    Add the counts of [{"value": ..., "count": ...}] facets by value, most frequent values first.
+    """
+    counts = {}
+    for facet in facets:
+        for item in facet:
+            counts[item['value']] = counts.get(item['value'], 0) + item['count']
+    merged = [{'value': value, 'count': count} for value, count in counts.items()]
+    merged.sort(key=lambda item: (-item['count'], item['value']))
+    return merged[:limit] if limit else merged
+
+
+def merge_time(facets):
+    """
+    Add the counts of a.time facets by time range.
+    """
+    merged = dict(facets[0])
+    counts = {}
+    for facet in facets:
+        for item in facet.get('counts', []):
+            counts[item['value']] = counts.get(item['value'], 0) + item['count']
+    merged['counts'] = [{'value': value, 'count': counts[value]} for value in sorted(counts)]
+    merged['start'] = min(facet.get('start') for facet in facets)
+    merged['end'] = max(facet.get('end') for facet in facets)
+    return merged
+
+
+def merge_heatmaps(heatmaps):
+    """
+    Add the cells of a.hm facets over the same grid. Heatmaps over another grid are not merged.
+    """
+    grid_keys = ('gridLevel', 'columns', 'rows', 'minX', 'maxX', 'minY', 'maxY')
+    merged = dict(heatmaps[0])
+    merged['counts_ints2D'] = None
+    for heatmap in heatmaps:
+        if any(heatmap[key] != merged[key] for key in grid_keys):
+            LOGGER.debug('Heatmap over another grid not merged')
+            continue
+        for i, row in enumerate(heatmap.get('counts_ints2D') or []):
+            if not row:
+                continue
+            if merged['counts_ints2D'] is None:
+                merged['counts_ints2D'] = [None] * merged['rows']
+            merged_row = merged['counts_ints2D'][i] or [0] * merged['columns']
+            merged['counts_ints2D'][i] = [a + b for a, b in zip(merged_row, row)]
+    return merged
+
+
+def merge_docs(docs_lists, limit):
+    """
+    Interleave the documents of the catalogs, keeping the order of each catalog.
+    """
+    docs = []
+    for i in range(max(len(docs_list) for docs_list in docs_lists)):
+        for docs_list in docs_lists:
+            if i < len(docs_list):
+                docs.append(docs_list[i])
+    return docs[:limit] if limit > 0 else docs
+
+
+def merge_responses(responses, d_docs_limit=0, a_text_limit=None, a_user_limit=None):
+    """
+    Merge the search responses (data dicts) of several catalogs.
+    """
+    data = {'a.matchDocs': sum(response.get('a.matchDocs') or 0 for response in responses)}
+
+    docs_lists = [response['d.docs'] for response in responses if response.get('d.docs')]
+    if docs_lists:
+        data['d.docs'] = merge_docs(docs_lists, d_docs_limit)
+
+    times = [response['a.time'] for response in responses if response.get('a.time')]
+    if times:
+        data['a.time'] = merge_time(times)
+
+    heatmaps = [response['a.hm'] for response in responses if response.get('a.hm')]
+    if heatmaps:
+        data['a.hm'] = merge_heatmaps(heatmaps)
+
+    for name, limit in (('a.text', a_text_limit), ('a.user', a_user_limit)):
+        facets = [response[name] for response in responses if response.get(name)]
+        if facets:
+            data[name] = merge_counts(facets, limit)
+
+    return data
+
+
+def search_catalogs(catalogs, search, timeout=None):
+    """
+    Search catalogs concurrently with search(catalog), which returns a (status, data) tuple.
+    Returns a list of (catalog, status, data): status is None for the catalogs which did not answer in time.
+    """
+    timeout = timeout or REGISTRY_SEARCH_FEDERATION_TIMEOUT
+
+    def search_catalog(catalog):
+        try:
+            return search(catalog)
+        except Exception, e:
+            LOGGER.error(e, exc_info=True)
+            return 500, {'error': {'msg': str(e)}}
+        finally:
+            # threads do not share the database connection of the request
+            connection.close()
+
+    pool = ThreadPool(len(catalogs))
+    try:
+        results = [pool.apply_async(search_catalog, (catalog, )) for catalog in catalogs]
+        deadline = time.time() + timeout
+        responses = []
+        for catalog, result in zip(catalogs, results):
+            try:
+                status, data = result.get(max(deadline - time.time(), 0))
+            except TimeoutError:
+                LOGGER.warning('Catalog %s did not answer in %s seconds' % (catalog.slug, timeout))
+                status, data = None, None
+            responses.append((catalog, status, data))
+        return responses
+    finally:
+        # threads still searching are not waited for
+        pool.close()
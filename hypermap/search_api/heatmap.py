@@ -0,0 +1,213 @@
+"""
+Tiled cache of the Solr heatmap facets.
+
+The heatmap field is a packedQuad prefix tree over the ENVELOPE(-180, 180, 180,
+-180) world: at grid level L, cells are squares of 360 / 2^L degrees. The cells
+are grouped in tiles of REGISTRY_SEARCH_HEATMAP_TILE_SIZE x
+REGISTRY_SEARCH_HEATMAP_TILE_SIZE cells, whose count grids are cached by query,
+grid level and position, like the search responses (see cache.py). The grid of
+a.hm.filter is assembled from the cached tiles, and the missing tiles are
+requested to Solr in a single heatmap facet covering them, so panning the map
+only counts the cells of the new tiles.
+"""
+
+import hashlib
+import json
+import logging
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+
+from hypermap.aggregator import search_transport
+from hypermap.aggregator.lru import LRUCache
+from hypermap.search_api import cache as search_cache
+from hypermap.search_api.utils import parse_geo_box, request_heatmap_facet
+
+LOGGER = logging.getLogger(__name__)
+
+# cells per side of the cached heatmap tiles, 0 disables the tiles
+REGISTRY_SEARCH_HEATMAP_TILE_SIZE = getattr(settings, 'REGISTRY_SEARCH_HEATMAP_TILE_SIZE', 16)
+
+WORLD_MIN = -180.0
+WORLD_SIZE = 360.0
+# deepest level of the prefix tree (maxDistErr 0.001)
+MAX_GRID_LEVEL = 19
+# highest number of cells of an assembled heatmap, as facet.heatmap.maxCells
+MAX_CELLS = 100000
+
+TILE_KEY = 'search_api:heatmap:%s'
+
+local_cache = LRUCache(maxsize=search_cache.REGISTRY_SEARCH_CACHE_SIZE * 10,
+                       timeout=search_cache.REGISTRY_SEARCH_CACHE_TTL)
+
+
+def is_enabled():
+    return REGISTRY_SEARCH_HEATMAP_TILE_SIZE > 0 and search_cache.is_enabled()
+
+
+def get_grid_level(hm_filter, hm_grid_level, hm_limit):
+    """
+    Return the grid level of a heatmap, as chosen by Solr from facet.heatmap.distErr when it is not given:
+    the first level whose cells are smaller than distErr (QuadPrefixTree.getLevelForDistance).
+    """
+    if hm_grid_level:
+        return hm_grid_level
+    dist_err = float(request_heatmap_facet(None, hm_filter, None, hm_limit)['facet.heatmap.distErr'])
+    for level in range(1, MAX_GRID_LEVEL):
+        if dist_err > WORLD_SIZE / 2 ** level:
+            return level
+    return MAX_GRID_LEVEL
+
+
+def get_cell_range(hm_filter, cell_size):
+    """
+    Return the columns and rows (first included, last excluded) of the cells intersecting a filter.
+    """
+    # the filter is [minY,minX TO maxY,maxX], the box is parsed as (y, x)
+    min_y, min_x, max_y, max_x = parse_geo_box(hm_filter).bounds
+    n_cells = int(round(WORLD_SIZE / cell_size))
+
+    def cells(min_value, max_value):
+        first = int(math.floor((min_value - WORLD_MIN) / cell_size))
+        last = int(math.ceil((max_value - WORLD_MIN) / cell_size))
+        first = min(max(first, 0), n_cells - 1)
+        return first, min(max(last, first + 1), n_cells)
+
+    return cells(min_x, max_x) + cells(min_y, max_y)
+
+
+def fetch_cells(search_engine_endpoint, params, field, level, cell_size, col_range, row_range):
+    """
+    Request the counts of a range of cells to Solr, returns a dict of count by (column, row),
+    or None if Solr did not answer with a grid of the expected level.
+    """
+    first_col, last_col = col_range
+    first_row, last_row = row_range
+    # the region is shrunk by a fraction of a cell, so the cells around it are not counted
+    margin = cell_size / 100
+    geom = '[{0},{1} TO {2},{3}]'.format(
+        WORLD_MIN + first_row * cell_size + margin, WORLD_MIN + first_col * cell_size + margin,
+        WORLD_MIN + last_row * cell_size - margin, WORLD_MIN + last_col * cell_size - margin
+    )
+    hm_params = dict(params)
+    hm_params.update({
+        'rows': 0,
+        'wt': 'json',
+        'facet': 'on',
+        'facet.heatmap': field,
+        'facet.heatmap.geom': geom,
+        'facet.heatmap.gridLevel': level,
+    })
+    res = search_transport.get(search_engine_endpoint, params=hm_params)
+    solr_response = res.json()
+    if 'error' in solr_response:
+        LOGGER.error('Heatmap tiles error: %s' % solr_response['error'])
+        return None
+
+    values = iter(solr_response['facet_counts']['facet_heatmaps'][field])
+    heatmap = dict(zip(values, values))
+    if heatmap['gridLevel'] != level or not heatmap['columns']:
+        return None
+    if abs((heatmap['maxX'] - heatmap['minX']) / heatmap['columns'] - cell_size) > cell_size / 1000:
+        return None
+
+    min_col = int(round((heatmap['minX'] - WORLD_MIN) / cell_size))
+    top_row = int(round((heatmap['maxY'] - WORLD_MIN) / cell_size)) - 1
+    counts = {}
+    for i, row in enumerate(heatmap['counts_ints2D'] or []):
+        for j, count in enumerate(row or []):
+            if count:
+                counts[(min_col + j, top_row - i)] = count
+    return counts
+
+
+def get_tile_keys(search_engine_endpoint, catalog_slug, params, field, level, tiles):
+    query = json.dumps([search_engine_endpoint, field, level, sorted(params.items())])
+    generation = search_cache.get_generation(catalog_slug)
+    keys = {}
+    for x, y in tiles:
+        digest = hashlib.sha1(('%s:%s:%s:%s' % (generation, query, x, y)).encode('utf-8')).hexdigest()
+        keys[(x, y)] = TILE_KEY % digest
+    return keys
+
+
+def get_heatmap(search_engine_endpoint, catalog_slug, params, field, hm_filter, hm_grid_level, hm_limit):
+    """
+    Return the a.hm response of a search with the q and fq params, assembled from the cached tiles,
+    or None if the heatmap can not be tiled.
+    """
+    if not hm_filter:
+        hm_filter = '[-90,-180 TO 90,180]'
+    params = dict((name, params[name]) for name in ('q', 'fq') if name in params)
+    level = get_grid_level(hm_filter, hm_grid_level, hm_limit)
+    cell_size = WORLD_SIZE / 2 ** level
+    first_col, last_col, first_row, last_row = get_cell_range(hm_filter, cell_size)
+    if (last_col - first_col) * (last_row - first_row) > MAX_CELLS:
+        return None
+
+    tile_size = min(REGISTRY_SEARCH_HEATMAP_TILE_SIZE, 2 ** level)
+    tiles = [(x, y) for x in range(first_col // tile_size, (last_col - 1) // tile_size + 1)
+             for y in range(first_row // tile_size, (last_row - 1) // tile_size + 1)]
+    keys = get_tile_keys(search_engine_endpoint, catalog_slug, params, field, level, tiles)
+
+    counts = {}
+    missing = []
+    shared = None
+    for tile in tiles:
+        tile_counts = local_cache.get(keys[tile])
+        if tile_counts is None:
+            if shared is None:
+                shared = cache.get_many(keys.values())
+            tile_counts = shared.get(keys[tile])
+            if tile_counts is not None:
+                local_cache.set(keys[tile], tile_counts)
+        if tile_counts is None:
+            missing.append(tile)
+        else:
+            counts.update(tile_counts)
+
+    if missing:
+        # the missing tiles are counted in one request covering them
+        col_range = (min(x for x, y in missing) * tile_size, (max(x for x, y in missing) + 1) * tile_size)
+        row_range = (min(y for x, y in missing) * tile_size, (max(y for x, y in missing) + 1) * tile_size)
+        try:
+            fetched = fetch_cells(search_engine_endpoint, params, field, level, cell_size, col_range, row_range)
+        except Exception, e:
+            # the search request reports the error
+            LOGGER.error(e, exc_info=True)
+            return None
+        if fetched is None:
+            return None
+        settled = search_cache.is_settled(catalog_slug)
+        for tile in missing:
+            x, y = tile
+            tile_counts = dict(
+                (cell, count) for cell, count in fetched.items()
+                if cell[0] // tile_size == x and cell[1] // tile_size == y
+            )
+            counts.update(tile_counts)
+            if settled:
+                local_cache.set(keys[tile], tile_counts)
+                cache.set(keys[tile], tile_counts, search_cache.REGISTRY_SEARCH_CACHE_TTL)
+        LOGGER.debug('Heatmap assembled from %s tiles, %s requested' % (len(tiles), len(missing)))
+
+    # rows from the top, rows and grids without counts are null as in the Solr response
+    grid = []
+    for row in range(last_row - 1, first_row - 1, -1):
+        row_counts = [counts.get((col, row), 0) for col in range(first_col, last_col)]
+        grid.append(row_counts if any(row_counts) else None)
+    if not any(grid):
+        grid = None
+
+    return {
+        'gridLevel': level,
+        'columns': last_col - first_col,
+        'rows': last_row - first_row,
+        'minX': WORLD_MIN + first_col * cell_size,
+        'maxX': WORLD_MIN + last_col * cell_size,
+        'minY': WORLD_MIN + first_row * cell_size,
+        'maxY': WORLD_MIN + last_row * cell_size,
+        'counts_ints2D': grid,
+        'projection': 'EPSG:4326'
+    }
@@ -0,0 +1,63 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.http import QueryDict
+
+from hypermap.search_api import engines, query_plan
+from hypermap.search_api.serializers import SearchSerializer
+
+SAMPLE_QUERY = (
+    'q_text=river&q_time=[2000-01-01 TO 2010-12-31T00:00:00]&q_geo=[-40,-120 TO 60,40]'
+    '&d_docs_limit=10&d_docs_sort=time&a_time_limit=100&a_time_gap=P1Y'
+    '&a_hm_limit=1000&a_hm_filter=[-40,-120 TO 60,40]&a_text_limit=10&a_user_limit=10'
+    '&search_engine_endpoint=http://localhost:8983/solr/hypermap/select'
+)
+
+
+class Command(BaseCommand):
+    help = ("Measure the CPU time spent validating search params and building the backend requests, "
+            "without and with the query plan cache.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '-n',
+            '--requests',
+            dest="requests",
+            default=2000,
+            help="Number of searches to build"),
+        make_option(
+            '-q',
+            '--query',
+            dest="query",
+            default=SAMPLE_QUERY,
+            help="Search params, as a query string"),
+    )
+
+    def build(self, serializer):
+        query = engines.SearchQuery(serializer)
+        engines.get_engine('solr').request_params(query)
+        engines.get_engine('elasticsearch').request_body(query, 5)
+
+    def handle(self, *args, **options):
+        requests = int(options.get('requests'))
+        params = QueryDict(options.get('query'))
+
+        def measure(get_serializer):
+            start = time.clock()
+            for i in range(requests):
+                self.build(get_serializer())
+            return (time.clock() - start) / requests * 1000000
+
+        def validate():
+            serializer = SearchSerializer(data=params)
+            serializer.is_valid(raise_exception=True)
+            return serializer
+
+        query_plan.plans.clear()
+        without_plans = measure(validate)
+        with_plans = measure(lambda: query_plan.get_plan(params))
+
+        self.stdout.write('CPU per search, without query plans: %.1f us' % without_plans)
+        self.stdout.write('CPU per search, with query plans: %.1f us' % with_plans)
+        self.stdout.write('Speedup: %.1fx' % (without_plans / with_plans))
@@ -0,0 +1,78 @@
+"""
+Query plans of the Search API.
+
+Parsing the search params (dates with dateutil, boxes with shapely, ISO 8601
+gaps) and building the backend request from them costs more CPU than the rest
+of a search. A QueryPlan keeps the validated params of a raw parameter set and
+the request parts compiled from them, and is cached by raw params, so a
+repeated search goes straight to the backend request.
+"""
+
+import threading
+
+from django.conf import settings
+
+from hypermap.aggregator.lru import LRUCache
+
+# highest number of query plans kept in memory by each process
+REGISTRY_SEARCH_PLAN_CACHE_SIZE = getattr(settings, 'REGISTRY_SEARCH_PLAN_CACHE_SIZE', 1000)
+# plans are rebuilt every hour, as incomplete dates are completed with the current year
+PLAN_TIMEOUT = 3600
+
+plans = LRUCache(maxsize=REGISTRY_SEARCH_PLAN_CACHE_SIZE, timeout=PLAN_TIMEOUT)
+
+
+class QueryPlan(object):
+    """
+    Validated params of a search, and the backend request parts compiled from them.
+    Quacks like a validated SearchSerializer, so the search functions take either.
+    """
+
+    def __init__(self, validated_data):
+        self.validated_data = validated_data
+        self.compiled = {}
+        self._lock = threading.Lock()
+
+    def is_valid(self, raise_exception=False):
+        return True
+
+    def get_compiled(self, name, build, *args):
+        with self._lock:
+            if name in self.compiled:
+                return self.compiled[name]
+        # built out of the lock, concurrent requests may build the same part
+        value = build(*args)
+        with self._lock:
+            return self.compiled.setdefault(name, value)
+
+
+def get_key(params):
+    return tuple(sorted((name, tuple(params.getlist(name))) for name in params))
+
+
+def get_plan(params):
+    """
+    Return the query plan of raw (QueryDict) search params, validating them if the plan is not cached.
+    Raises a ValidationError for invalid params.
+    """
+    from hypermap.search_api.serializers import SearchSerializer
+
+    key = get_key(params)
+    plan = plans.get(key)
+    if plan is None:
+        serializer = SearchSerializer(data=params)
+        serializer.is_valid(raise_exception=True)
+        plan = QueryPlan(serializer.validated_data)
+        if REGISTRY_SEARCH_PLAN_CACHE_SIZE > 0:
+            plans.set(key, plan)
+    return plan
+
+
+def compiled(serializer, name, build, *args):
+    """
+    Return build(*args), compiled once per query plan. Without a plan (a plain serializer), it is built each time.
+    Compiled values are shared by the requests, they must not be modified.
+    """
+    if isinstance(serializer, QueryPlan):
+        return serializer.get_compiled(name, build, *args)
+    return build(*args)
@@ -8,8 +8,8 @@ class SearchSerializer(serializers.Serializer):
     # TODO: remove this after catalogs integration:
     search_engine = serializers.ChoiceField(
         required=False,
-        help_text="Where will be running the search.",
-        choices=["solr", "elasticsearch"]
+        help_text="Where will be running the search. 'local' searches the documents kept in memory by the process.",
+        choices=["solr", "elasticsearch", "local"]
     )
     search_engine_endpoint = serializers.CharField(
         required=False,
@@ -47,6 +47,17 @@ class SearchSerializer(serializers.Serializer):
         help_text="When documents to return are more than d_docs_limit they can be paginated by this value.",
         default=1
     )
+    d_docs_cursor = serializers.CharField(
+        required=False,
+        help_text="Cursor to page through all the documents, instead of d.docs.page: '*' for the first page, "
+                  "then the d.docs.nextCursor of the previous page. Every page costs the same, however deep. "
+                  "d.docs.nextCursor is null after the last page."
+    )
+    d_docs_fields = serializers.CharField(
+        required=False,
+        help_text="Comma separated list of the fields of the returned docs, all of them by default. "
+                  "'map' returns the fields needed to draw the docs on a map: id, title, bbox and tile_url."
+    )
     d_docs_sort = serializers.ChoiceField(
         required=False,
         help_text="How to order the documents before returning the top X. 'score' is keyword search relevancy. "
@@ -155,6 +166,18 @@ class SearchSerializer(serializers.Serializer):
 
         return value
 
+    def validate_d_docs_fields(self, value):
+        """
+        Would be for example: id,title,bbox or map
+        """
+        if value:
+            try:
+                return utils.parse_docs_fields(value)
+            except Exception as e:
+                raise serializers.ValidationError(e.message)
+
+        return value
+
     def validate_d_docs_page(self, value):
         """
         paginations cant be zero or negative.
@@ -165,6 +188,16 @@ class SearchSerializer(serializers.Serializer):
             raise serializers.ValidationError("d_docs_page cant be zero or negative")
         return value
 
+    def validate(self, data):
+        """
+        cursors page through documents, d_docs_limit at a time.
+        :param data:
+        :return:
+        """
+        if data.get('d_docs_cursor') and data.get('d_docs_limit') <= 0:
+            raise serializers.ValidationError("d_docs_limit must be positive to use d_docs_cursor")
+        return data
+
 
 class CatalogSerializer(serializers.HyperlinkedModelSerializer):
     search_url = serializers.CharField(source="get_search_url",
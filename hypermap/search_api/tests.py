@@ -1,18 +1,26 @@
 import json
 import datetime
+import math
 import time
 import pytz
+import urlparse
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.http import QueryDict
 from django.db.models import signals
 from django.test import TestCase
 
 from hypermap.aggregator.models import Catalog, layer_post_save, service_post_save, Layer, Service
 from hypermap.search_api import utils
+from hypermap.search_api.serializers import SearchSerializer
+from hypermap.search_api import cache as search_cache, engines, federation, heatmap, query_plan
 from hypermap.aggregator.elasticsearch_client import ESHypermap
 from hypermap.aggregator.solr import SolrHypermap
 from hypermap.aggregator.tasks import index_service
+from httmock import HTTMock, urlmatch
+from rest_framework.exceptions import ValidationError
 
 
 SEARCH_TYPE = settings.REGISTRY_SEARCH_URL.split('+')[0]
@@ -353,3 +361,481 @@ class SearchApiTestCase(TestCase):
         self.assertEqual(d['f.y.facet.range.end'], '2016-01-01T00:00:00Z')
         self.assertEqual(d['f.y.facet.range.gap'], '+1DAYS')
         self.assertEqual(d['facet.range'], 'y')
+
+
+class SearchCacheTestCase(TestCase):
+
+    def setUp(self):
+        search_cache.local_cache.clear()
+        search_cache.reset_stats()
+
+    def test_keys(self):
+        params = {'q_text': 'river', 'd_docs_limit': 10, 'q_time': None}
+        key = search_cache.get_key('hypermap', 'solr', params)
+        self.assertEqual(key, search_cache.get_key('hypermap', 'solr', {'d_docs_limit': 10, 'q_text': 'river'}))
+        self.assertNotEqual(key, search_cache.get_key('hypermap', 'elasticsearch', params))
+        self.assertNotEqual(key, search_cache.get_key('other', 'solr', params))
+
+        # the catalog index changed
+        search_cache.invalidate(['hypermap'])
+        self.assertNotEqual(key, search_cache.get_key('hypermap', 'solr', params))
+        self.assertFalse(search_cache.is_settled('hypermap'))
+
+    def test_responses_and_stats(self):
+        key = search_cache.get_key('hypermap', 'solr', {'q_text': 'stats'})
+        self.assertEqual(search_cache.get_response(key), None)
+        search_cache.set_response(key, {'a.matchDocs': 1})
+        self.assertEqual(search_cache.get_response(key), {'a.matchDocs': 1})
+
+        # another process reads the response from the shared cache
+        search_cache.local_cache.clear()
+        self.assertEqual(search_cache.get_response(key), {'a.matchDocs': 1})
+
+        stats = search_cache.get_stats()
+        self.assertEqual((stats['misses'], stats['hits'], stats['local_hits']), (1, 1, 1))
+        self.assertEqual(stats['hit_rate'], 2 / 3.0)
+
+
+HEATMAP_POINTS = [(-120.5, 40.2), (-118.1, 33.9), (2.3, 48.8), (12.5, 41.9), (151.2, -33.8), (139.7, 35.6)]
+
+
+def heatmap_counts(hm_filter, level):
+    """
+    Count the points in the cells intersecting a filter, as Solr does.
+    """
+    from_point, to_point = utils.parse_solr_geo_range_as_pair(hm_filter)
+    min_y, min_x = utils.parse_lat_lon(from_point)
+    max_y, max_x = utils.parse_lat_lon(to_point)
+    cell = 360.0 / 2 ** level
+    first_col, last_col = int(math.floor((min_x + 180) / cell)), int(math.ceil((max_x + 180) / cell))
+    first_row, last_row = int(math.floor((min_y + 180) / cell)), int(math.ceil((max_y + 180) / cell))
+    grid = [[0] * (last_col - first_col) for i in range(last_row - first_row)]
+    for x, y in HEATMAP_POINTS:
+        col, row = int((x + 180) // cell), int((y + 180) // cell)
+        if first_col <= col < last_col and first_row <= row < last_row:
+            grid[last_row - 1 - row][col - first_col] += 1
+    return {
+        'gridLevel': level, 'columns': last_col - first_col, 'rows': last_row - first_row,
+        'minX': first_col * cell - 180, 'maxX': last_col * cell - 180,
+        'minY': first_row * cell - 180, 'maxY': last_row * cell - 180,
+        'counts_ints2D': [counts if any(counts) else None for counts in grid],
+    }
+
+
+class HeatmapTilesTestCase(TestCase):
+
+    endpoint = 'http://heatmap-solr:8983/solr/hypermap/select'
+
+    def setUp(self):
+        self.requests = []
+        heatmap.local_cache.clear()
+        cache.delete(search_cache.INVALIDATED_KEY % search_cache.get_index_name('hypermap'))
+
+        @urlmatch(netloc=r'heatmap-solr:8983')
+        def solr_heatmap(url, request):
+            params = dict(urlparse.parse_qsl(url.query))
+            self.requests.append(params)
+            hm = heatmap_counts(params['facet.heatmap.geom'], int(params['facet.heatmap.gridLevel']))
+            values = []
+            for name in ('gridLevel', 'columns', 'rows', 'minX', 'maxX', 'minY', 'maxY', 'counts_ints2D'):
+                values.extend([name, hm[name]])
+            return json.dumps({'facet_counts': {'facet_heatmaps': {'bbox': values}}})
+
+        self.solr_heatmap = solr_heatmap
+
+    def get_heatmap(self, hm_filter, params):
+        with HTTMock(self.solr_heatmap):
+            return heatmap.get_heatmap(self.endpoint, 'hypermap', params, 'bbox', hm_filter, 6, 0)
+
+    def test_grid_level(self):
+        params = utils.request_heatmap_facet('bbox', '[-90,-180 TO 90,180]', None, 100)
+        dist_err = float(params['facet.heatmap.distErr'])
+        level = heatmap.get_grid_level('[-90,-180 TO 90,180]', None, 100)
+        self.assertTrue(360.0 / 2 ** level < dist_err <= 360.0 / 2 ** (level - 1))
+        self.assertEqual(heatmap.get_grid_level('[-90,-180 TO 90,180]', 3, 100), 3)
+
+    def test_tiles(self):
+        params = {'q': '*:*', 'fq': ['bbox:[-90,-180 TO 90,180]'], 'rows': 10}
+        hm_filter = '[20,-130 TO 60,20]'
+        expected = heatmap_counts(hm_filter, 6)
+        hm = self.get_heatmap(hm_filter, params)
+        for name, value in expected.items():
+            self.assertEqual(hm[name], value)
+        self.assertEqual(len(self.requests), 1)
+
+        # the same viewport is assembled from the cached tiles
+        self.assertEqual(self.get_heatmap(hm_filter, params), hm)
+        self.assertEqual(len(self.requests), 1)
+
+        # after panning, only the new tiles are requested
+        hm_filter = '[20,-40 TO 60,120]'
+        hm = self.get_heatmap(hm_filter, params)
+        self.assertEqual(hm['counts_ints2D'], heatmap_counts(hm_filter, 6)['counts_ints2D'])
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[-1]['facet.heatmap.geom'].split(' TO ')[0].split(',')[1][:5], '90.05')
+
+        # the tiles of other queries are not shared
+        self.get_heatmap(hm_filter, {'q': 'river'})
+        self.assertEqual(len(self.requests), 3)
+
+
+class FederatedSearchTestCase(TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, federation, 'REGISTRY_SEARCH_FEDERATION_TIMEOUT',
+                        federation.REGISTRY_SEARCH_FEDERATION_TIMEOUT)
+        federation.REGISTRY_SEARCH_FEDERATION_TIMEOUT = 0.5
+        for name in ('Remote A', 'Remote B', 'Remote Slow'):
+            Catalog.objects.create(name=name, url='http://%s.example.com/api/' % name.lower().replace(' ', '-'))
+
+    def test_merge_responses(self):
+        responses = [
+            {
+                'a.matchDocs': 3, 'd.docs': [{'id': 1}, {'id': 2}],
+                'a.user': [{'value': 'bob', 'count': 2}, {'value': 'ann', 'count': 1}],
+                'a.time': {'start': '2000', 'end': '2001', 'gap': 'P1Y', 'counts': [{'value': '2000', 'count': 3}]},
+                'a.hm': {'gridLevel': 1, 'columns': 2, 'rows': 1, 'minX': -180, 'maxX': 180, 'minY': 0, 'maxY': 180,
+                         'counts_ints2D': [[1, 0]]},
+            },
+            {
+                'a.matchDocs': 2, 'd.docs': [{'id': 10}],
+                'a.user': [{'value': 'ann', 'count': 2}],
+                'a.time': {'start': '1999', 'end': '2000', 'gap': 'P1Y', 'counts': [{'value': '1999', 'count': 2}]},
+                'a.hm': {'gridLevel': 1, 'columns': 2, 'rows': 1, 'minX': -180, 'maxX': 180, 'minY': 0, 'maxY': 180,
+                         'counts_ints2D': [[1, 1]]},
+            },
+        ]
+        data = federation.merge_responses(responses, d_docs_limit=2, a_user_limit=1)
+        self.assertEqual(data['a.matchDocs'], 5)
+        self.assertEqual(data['d.docs'], [{'id': 1}, {'id': 10}])
+        self.assertEqual(data['a.user'], [{'value': 'ann', 'count': 3}])
+        self.assertEqual(data['a.time']['counts'], [{'value': '1999', 'count': 2}, {'value': '2000', 'count': 3}])
+        self.assertEqual((data['a.time']['start'], data['a.time']['end']), ('1999', '2001'))
+        self.assertEqual(data['a.hm']['counts_ints2D'], [[2, 1]])
+
+    def test_partial_results(self):
+
+        @urlmatch(netloc=r'remote-(a|b)\.example\.com')
+        def remote(url, request):
+            self.assertNotIn('catalogs', url.query)
+            return json.dumps({'a.matchDocs': 1, 'd.docs': [{'title': url.netloc}]})
+
+        @urlmatch(netloc=r'remote-slow\.example\.com')
+        def remote_slow(url, request):
+            time.sleep(1)
+            return json.dumps({'a.matchDocs': 1})
+
+        with HTTMock(remote, remote_slow):
+            response = self.client.get(reverse('search_api_federated'), {
+                'catalogs': 'remote-a,remote-b,remote-slow', 'd.docs.limit': 10
+            })
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['a.matchDocs'], 2)
+        self.assertEqual(len(data['d.docs']), 2)
+        self.assertTrue(data['partial'])
+        self.assertEqual([(c['slug'], c['status']) for c in data['catalogs']],
+                         [('remote-a', 'ok'), ('remote-b', 'ok'), ('remote-slow', 'timeout')])
+
+        response = self.client.get(reverse('search_api_federated'), {'catalogs': 'unknown'})
+        self.assertEqual(response.status_code, 404)
+
+
+class CursorPaginationTestCase(TestCase):
+
+    def setUp(self):
+        self.requests = []
+        search_cache.local_cache.clear()
+        self.catalog = Catalog.objects.create(name='Cursor catalog')
+
+    def test_cursor_encoding(self):
+        cursor = utils.encode_cursor([1.5, 'layer#10'])
+        self.assertEqual(utils.decode_cursor(cursor), [1.5, 'layer#10'])
+        self.assertEqual(utils.decode_cursor('not a cursor'), None)
+
+    def test_solr_cursor(self):
+
+        @urlmatch(netloc=r'cursor-solr:8983')
+        def solr_select(url, request):
+            params = urlparse.parse_qs(url.query)
+            self.requests.append(params)
+            cursor = params['cursorMark'][0]
+            return json.dumps({
+                'responseHeader': {'QTime': 1},
+                'response': {'numFound': 3, 'docs': [{'id': 1}, {'id': 2}] if cursor == '*' else []},
+                'nextCursorMark': 'AoE' if cursor == '*' else cursor,
+                'debug': {'timing': {}},
+            })
+
+        search_url = reverse('search_api', args=[self.catalog.slug])
+        params = {
+            'search_engine': 'solr', 'search_engine_endpoint': 'http://cursor-solr:8983/solr/hypermap/select',
+            'd.docs.limit': 2, 'd.docs.sort': 'time', 'd.docs.cursor': '*'
+        }
+        with HTTMock(solr_select):
+            data = json.loads(self.client.get(search_url, params).content)
+            self.assertEqual(data['d.docs.nextCursor'], 'AoE')
+            self.assertEqual(self.requests[-1]['sort'], ['layer_date desc,id asc'])
+            self.assertNotIn('start', self.requests[-1])
+
+            params['d.docs.cursor'] = 'AoE'
+            data = json.loads(self.client.get(search_url, params).content)
+            self.assertEqual(data['d.docs.nextCursor'], None)
+
+        params['d.docs.limit'] = 0
+        self.assertEqual(self.client.get(search_url, params).status_code, 400)
+
+    def test_elasticsearch_cursor(self):
+        self.addCleanup(ESHypermap.cluster_info.clear)
+        ESHypermap.cluster_info.set('version', 5)
+
+        @urlmatch(path=r'/cursor-catalog/_search')
+        def es_search(url, request):
+            body = json.loads(request.body)
+            self.requests.append(body)
+            return json.dumps({'hits': {'total': 3, 'hits': [
+                {'_source': {'id': '1', 'abstract': ''}, 'sort': [1.0, 'layer#1']},
+                {'_source': {'id': '2', 'abstract': ''}, 'sort': [1.0, 'layer#2']},
+            ]}})
+
+        search_url = reverse('search_api', args=[self.catalog.slug])
+        with HTTMock(es_search):
+            data = json.loads(self.client.get(search_url, {'d.docs.limit': 2, 'd.docs.cursor': '*'}).content)
+            self.assertNotIn('from', self.requests[-1])
+            self.assertNotIn('search_after', self.requests[-1])
+            self.assertEqual(self.requests[-1]['sort'], [{'_score': {'order': 'desc'}}, {'_uid': {'order': 'asc'}}])
+
+            self.client.get(search_url, {'d.docs.limit': 2, 'd.docs.cursor': data['d.docs.nextCursor']})
+            self.assertEqual(self.requests[-1]['search_after'], [1.0, 'layer#2'])
+
+            response = self.client.get(search_url, {'d.docs.limit': 2, 'd.docs.cursor': 'not a cursor'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.content), {'error': {'msg': 'invalid d_docs_cursor'}})
+
+
+class ExportTestCase(TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.catalog = Catalog.objects.create(name='Export catalog')
+        self.url = reverse('search_api_export', args=[self.catalog.slug])
+
+    def test_solr_export(self):
+
+        @urlmatch(netloc=r'export-solr:8983')
+        def solr_select(url, request):
+            params = urlparse.parse_qs(url.query)
+            self.requests.append(params)
+            pages = {'*': ([{'id': 1, 'title': u'Caf\xe9'}, {'id': 2, 'title': 'Roads, 1990'}], 'A'),
+                     'A': ([{'id': 3, 'title': 'Rivers'}], 'B'),
+                     'B': ([], 'B')}
+            docs, next_cursor = pages[params['cursorMark'][0]]
+            return json.dumps({'response': {'numFound': 3, 'docs': docs}, 'nextCursorMark': next_cursor})
+
+        params = {'search_engine': 'solr', 'search_engine_endpoint': 'http://export-solr:8983/solr/hypermap/select',
+                  'q.time': '[2000-01-01 TO *]'}
+        with HTTMock(solr_select):
+            response = self.client.get(self.url, params)
+            lines = list(response.streaming_content)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['id'] for line in lines], [1, 2, 3])
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(self.requests[0]['fq'], ['layer_date:[2000-01-01T00:00:00Z TO *]'])
+
+        params.update({'format': 'csv', 'fields': 'id,title'})
+        with HTTMock(solr_select):
+            content = ''.join(self.client.get(self.url, params).streaming_content)
+        self.assertEqual(content, 'id,title\r\n1,Caf\xc3\xa9\r\n2,"Roads, 1990"\r\n3,Rivers\r\n')
+        self.assertEqual(self.requests[-1]['fl'], ['id,title'])
+
+        self.assertEqual(self.client.get(self.url, {'format': 'xml'}).status_code, 400)
+
+    def test_elasticsearch_export(self):
+        requests = self.requests
+
+        class ScrollingElasticsearch(object):
+
+            def search(self, body=None, **kwargs):
+                requests.append((body, kwargs))
+                return {'_scroll_id': 'scroll', '_shards': {'failed': 0},
+                        'hits': {'hits': [{'_source': {'id': '1'}}]}}
+
+            def scroll(self, scroll_id, **kwargs):
+                hits = [{'_source': {'id': '2'}}] if len(requests) == 1 else []
+                requests.append(scroll_id)
+                return {'_scroll_id': 'scroll', '_shards': {'failed': 0}, 'hits': {'hits': hits}}
+
+        self.addCleanup(setattr, ESHypermap, 'es', ESHypermap.es)
+        self.addCleanup(ESHypermap.cluster_info.clear)
+        ESHypermap.es = ScrollingElasticsearch()
+        ESHypermap.cluster_info.set('version', 5)
+
+        lines = list(self.client.get(self.url, {'q.text': 'river'}).streaming_content)
+        self.assertEqual([json.loads(line)['id'] for line in lines], ['1', '2'])
+        body, kwargs = self.requests[0]
+        self.assertEqual(body['sort'], ['_doc'])
+        self.assertEqual(body['query']['bool']['must'], [{'query_string': {'query': 'river'}}])
+        self.assertEqual(kwargs['index'], self.catalog.slug)
+
+
+class QueryPlanTestCase(TestCase):
+
+    def setUp(self):
+        query_plan.plans.clear()
+
+    def test_plans(self):
+        params = QueryDict('q_time=[2000-01-01 TO 2010-12-31]&a_time_limit=10&d_docs_limit=5')
+        plan = query_plan.get_plan(params)
+        self.assertEqual(plan.validated_data['q_time'], '[2000-01-01T00:00:00Z TO 2010-12-31T00:00:00Z]')
+        same_params = QueryDict('d_docs_limit=5&a_time_limit=10&q_time=[2000-01-01 TO 2010-12-31]')
+        self.assertIs(query_plan.get_plan(same_params), plan)
+        self.assertIsNot(query_plan.get_plan(QueryDict('d_docs_limit=6')), plan)
+
+        builds = []
+
+        def build(value):
+            builds.append(value)
+            return {'built': value}
+
+        self.assertEqual(query_plan.compiled(plan, 'part', build, 1), {'built': 1})
+        self.assertEqual(query_plan.compiled(plan, 'part', build, 1), {'built': 1})
+        self.assertEqual(builds, [1])
+
+        # a plain serializer builds the parts each time
+        serializer = SearchSerializer(data=params)
+        serializer.is_valid()
+        query_plan.compiled(serializer, 'part', build, 2)
+        query_plan.compiled(serializer, 'part', build, 2)
+        self.assertEqual(builds, [1, 2, 2])
+
+        with self.assertRaises(ValidationError):
+            query_plan.get_plan(QueryDict('d_docs_page=0'))
+
+
+class LocalEngineTestCase(TestCase):
+
+    def setUp(self):
+        self.engine = engines.get_engine('local')
+        self.addCleanup(self.engine.clear)
+        search_cache.local_cache.clear()
+        query_plan.plans.clear()
+        self.catalog = Catalog.objects.create(name='Local catalog')
+        self.engine.add_documents(self.catalog.slug, [
+            {'id': 1, 'title': 'Rivers of Europe', 'abstract': '', 'layer_originator': 'ann',
+             'layer_date': '1990-01-01T00:00:00Z', 'min_x': 0, 'min_y': 40, 'max_x': 20, 'max_y': 60},
+            {'id': 2, 'title': 'Roads of Europe', 'abstract': 'main rivers', 'layer_originator': 'bob',
+             'layer_date': '2005-01-01T00:00:00Z', 'min_x': 0, 'min_y': 40, 'max_x': 20, 'max_y': 60},
+            {'id': 3, 'title': 'Rivers of Chile', 'abstract': '', 'layer_originator': 'bob',
+             'layer_date': '2010-01-01T00:00:00Z', 'min_x': -75, 'min_y': -55, 'max_x': -66, 'max_y': -17},
+        ])
+        self.url = reverse('search_api', args=[self.catalog.slug])
+
+    def search(self, **params):
+        params['search_engine'] = 'local'
+        return json.loads(self.client.get(self.url, params).content)
+
+    def test_search(self):
+        data = self.search(**{'q.text': 'rivers', 'd.docs.limit': 10, 'a.user.limit': 1})
+        self.assertEqual(data['a.matchDocs'], 3)
+        self.assertEqual(data['a.user'], [{'value': 'bob', 'count': 2}])
+
+        data = self.search(**{'q.geo': '[30,-10 TO 70,30]', 'q.time': '[2000-01-01 TO *]', 'd.docs.limit': 10})
+        self.assertEqual([doc['id'] for doc in data['d.docs']], [2])
+
+        data = self.search(**{'q.user': 'bob', 'd.docs.limit': 1, 'd.docs.sort': 'time', 'd.docs.cursor': '*'})
+        self.assertEqual([doc['id'] for doc in data['d.docs']], [3])
+        data = self.search(**{'q.user': 'bob', 'd.docs.limit': 1, 'd.docs.sort': 'time',
+                              'd.docs.cursor': data['d.docs.nextCursor']})
+        self.assertEqual([doc['id'] for doc in data['d.docs']], [2])
+        self.assertEqual(data['d.docs.nextCursor'], None)
+
+        response = self.client.get(self.url, {'search_engine': 'local', 'a.hm.limit': 100})
+        self.assertEqual(response.status_code, 400)
+
+    def test_export(self):
+        url = reverse('search_api_export', args=[self.catalog.slug])
+        content = ''.join(self.client.get(url, {'search_engine': 'local', 'q.text': 'europe', 'format': 'csv',
+                                                'fields': 'id,title'}).streaming_content)
+        self.assertEqual(content, 'id,title\r\n1,Rivers of Europe\r\n2,Roads of Europe\r\n')
+
+
+class DocsFieldsTestCase(TestCase):
+
+    def validated_data(self, query_string):
+        serializer = SearchSerializer(data=QueryDict(query_string))
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    def test_fields(self):
+        validated_data = self.validated_data('d_docs_fields=map&d_docs_limit=10')
+        self.assertEqual(validated_data['d_docs_fields'], ('id', 'title', 'bbox', 'tile_url'))
+        self.assertEqual(engines.solr_params(validated_data)['fl'], 'id,title,bbox,tile_url')
+        body = json.loads(engines.elasticsearch_body(validated_data, 5))
+        self.assertEqual(body['_source'], ['id', 'title', 'bbox', 'tile_url'])
+
+        validated_data = self.validated_data('d_docs_fields=id, layer_date')
+        self.assertEqual(validated_data['d_docs_fields'], ('id', 'layer_date'))
+        self.assertNotIn('fl', engines.solr_params(self.validated_data('d_docs_limit=10')))
+
+        with self.assertRaises(ValidationError):
+            self.validated_data('d_docs_fields=id,sum(min_x,max_x)')
+
+    def test_local_engine(self):
+        engine = engines.get_engine('local')
+        self.addCleanup(engine.clear)
+        catalog = Catalog.objects.create(name='Fields catalog')
+        engine.add_documents(catalog.slug, [{'id': 1, 'title': 'Rivers', 'abstract': 'Long abstract',
+                                             'bbox': 'ENVELOPE(0,1,1,0)', 'keywords': ['water']}])
+        response = self.client.get(reverse('search_api', args=[catalog.slug]), {
+            'search_engine': 'local', 'd.docs.limit': 10, 'd.docs.fields': 'map'
+        })
+        self.assertEqual(json.loads(response.content)['d.docs'],
+                         [{'id': 1, 'title': 'Rivers', 'bbox': 'ENVELOPE(0,1,1,0)'}])
+
+
+class ElasticsearchFiltersTestCase(TestCase):
+
+    def body(self, query_string, es_version=5):
+        serializer = SearchSerializer(data=QueryDict(query_string))
+        serializer.is_valid(raise_exception=True)
+        return json.loads(engines.elasticsearch_body(serializer.validated_data, es_version))
+
+    def test_filter_context(self):
+        body = self.body('q_text=river&q_time=[2000-01-01 TO *]&q_geo=[-10,-20 TO 10,20]&q_user=bob')
+        query = body['query']['bool']
+        self.assertEqual(query['must'], [{'query_string': {'query': 'river'}}])
+        self.assertEqual([list(clause)[0] for clause in query['filter']], ['range', 'geo_shape', 'match'])
+        self.assertEqual(query['filter'][0], {'range': {'layer_date': {'gte': '2000-01-01T00:00:00Z'}}})
+        self.assertNotIn('post_filter', body)
+
+        body = self.body('q_user=bob', es_version=1)
+        self.assertEqual(body['query']['filtered']['query'], {'match_all': {}})
+        self.assertEqual(body['query']['filtered']['filter']['bool']['must'],
+                         [{'query': {'match': {'layer_originator': 'bob'}}}])
+
+    def test_user_facet(self):
+        # the users facet is not filtered by q_user, the documents and the other facets are
+        body = self.body('q_user=bob&a_user_limit=5&a_text_limit=5')
+        self.assertEqual(body['query']['bool']['filter'], [])
+        self.assertEqual(body['post_filter'], {'match': {'layer_originator': 'bob'}})
+        self.assertEqual(body['aggs']['popular_users']['terms']['field'], 'layer_originator')
+        self.assertEqual(body['aggs']['user_filtered']['filter'], body['post_filter'])
+        self.assertEqual(list(body['aggs']['user_filtered']['aggs']), ['popular_text'])
+
+        self.addCleanup(ESHypermap.cluster_info.clear)
+        ESHypermap.cluster_info.set('version', 5)
+        catalog = Catalog.objects.create(name='Filters catalog')
+
+        @urlmatch(path=r'/filters-catalog/_search')
+        def es_search(url, request):
+            return json.dumps({'hits': {'total': 1, 'hits': []}, 'aggregations': {
+                'popular_users': {'buckets': [{'key': 'ann', 'doc_count': 3}, {'key': 'bob', 'doc_count': 1}]},
+                'user_filtered': {'doc_count': 1, 'popular_text': {'buckets': [{'key': 'river', 'doc_count': 1}]}},
+            }})
+
+        with HTTMock(es_search):
+            data = json.loads(self.client.get(reverse('search_api', args=[catalog.slug]), {
+                'q.user': 'bob', 'a.user.limit': 5, 'a.text.limit': 5
+            }).content)
+        self.assertEqual(data['a.user'], [{'value': 'ann', 'count': 3}, {'value': 'bob', 'count': 1}])
+        self.assertEqual(data['a.text'], [{'value': 'river', 'count': 1}])
@@ -11,5 +11,8 @@ router.register(r'catalogs', views.CatalogViewSet)
 urlpatterns = [
     url(r'^api/', include(router.urls)),
     url(r'^api/docs/$', TemplateView.as_view(template_name='search_api/swagger/index.html')),
+    url(r'^api/cache/$', views.SearchCacheStats.as_view(), name="search_api_cache"),
+    url(r'^api/search/$', views.FederatedSearch.as_view(), name="search_api_federated"),
     url(r'^(?P<catalog_slug>[-\w]+)/api/$', views.Search.as_view(), name="search_api"),
+    url(r'^(?P<catalog_slug>[-\w]+)/api/export/$', views.Export.as_view(), name="search_api_export"),
 ]
@@ -1,13 +1,30 @@
+import base64
+import json
 import re
 
 import datetime
 import isodate
 import math
 
-import requests
 from dateutil.parser import parse
 from shapely.geometry import box
 
+from hypermap.aggregator import search_transport, time_bounds
+
+# field of the bounds maintained by the indexers
+TIME_BOUNDS_FIELD = 'layer_date'
+
+# fields of the documents returned by the d.docs.fields profiles
+DOCS_FIELDS_PROFILES = {
+    'map': ('id', 'title', 'bbox', 'tile_url'),
+}
+DOCS_FIELD_RE = re.compile(r"^[\w.]+$")
+
+RANGE_PATTERN = "\\[(.*) TO (.*)\\]"
+RANGE_RE = re.compile(RANGE_PATTERN)
+ISO8601_TIME_RE = re.compile("PT(\d+)([HMS])")
+ISO8601_DATE_RE = re.compile("P(\d+)([YMWD])")
+
 
 def is_range_common_era(start, end):
     """
@@ -62,12 +79,11 @@ def parse_solr_time_range_as_pair(time_filter):
     :param time_filter: [2013-03-01 TO 2013-05-01T00:00:00]
     :return: (2013-03-01, 2013-05-01T00:00:00)
     """
-    pattern = "\\[(.*) TO (.*)\\]"
-    matcher = re.search(pattern, time_filter)
+    matcher = RANGE_RE.search(time_filter)
     if matcher:
         return matcher.group(1), matcher.group(2)
     else:
-        raise Exception("Regex {0} couldn't parse {1}".format(pattern, time_filter))
+        raise Exception("Regex {0} couldn't parse {1}".format(RANGE_PATTERN, time_filter))
 
 
 def parse_datetime_range(time_filter):
@@ -121,7 +137,7 @@ def parse_ISO8601(time_gap):
             "M": ("MINUTES", isodate.Duration(minutes=1)),
             "S": ("SECONDS", isodate.Duration(seconds=1))
         }
-        matcher = re.search("PT(\d+)([HMS])", time_gap)
+        matcher = ISO8601_TIME_RE.search(time_gap)
         if matcher:
             quantity = int(matcher.group(1))
             unit = matcher.group(2)
@@ -135,7 +151,7 @@ def parse_ISO8601(time_gap):
             "W": ("WEEKS", isodate.Duration(weeks=1)),
             "D": ("DAYS", isodate.Duration(days=1))
         }
-        matcher = re.search("P(\d+)([YMWD])", time_gap)
+        matcher = ISO8601_DATE_RE.search(time_gap)
         if matcher:
             quantity = int(matcher.group(1))
             unit = matcher.group(2)
@@ -249,12 +265,11 @@ def parse_solr_geo_range_as_pair(geo_box_str):
     :param geo_box_str: [-90,-180 TO 90,180]
     :return: ("-90,-180", "90,180")
     """
-    pattern = "\\[(.*) TO (.*)\\]"
-    matcher = re.search(pattern, geo_box_str)
+    matcher = RANGE_RE.search(geo_box_str)
     if matcher:
         return matcher.group(1), matcher.group(2)
     else:
-        raise Exception("Regex {0} could not parse {1}".format(pattern, geo_box_str))
+        raise Exception("Regex {0} could not parse {1}".format(RANGE_PATTERN, geo_box_str))
 
 
 def parse_lat_lon(point_str):
@@ -319,6 +334,43 @@ def request_field_facet(field, limit, ex_filter=True):
     pass
 
 
+def parse_docs_fields(docs_fields):
+    """
+    parses a comma separated list of document fields, or the name of a profile like 'map'.
+    :param docs_fields: id,title,bbox or map
+    :return: tuple of field names
+    """
+    if docs_fields in DOCS_FIELDS_PROFILES:
+        return DOCS_FIELDS_PROFILES[docs_fields]
+    fields = tuple(field.strip() for field in docs_fields.split(',') if field.strip())
+    for field in fields:
+        if not DOCS_FIELD_RE.match(field):
+            raise Exception("invalid field name: {0}".format(field))
+    return fields
+
+
+def encode_cursor(sort_values):
+    """
+    encode the sort values of the last document of a page as an opaque cursor.
+    :param sort_values: the sort values of an Elasticsearch hit.
+    :return: url safe cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(sort_values))
+
+
+def decode_cursor(cursor):
+    """
+    decode a cursor built by encode_cursor to Elasticsearch search_after values.
+    :param cursor:
+    :return: the sort values, or None if the cursor is not valid.
+    """
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        return None
+    return sort_values if isinstance(sort_values, list) else None
+
+
 def asterisk_to_min_max(field, time_filter, search_engine_endpoint, actual_params=None):
     """
     traduce [* TO *] to something like [MIN-INDEXED-DATE TO MAX-INDEXED-DATE]
@@ -334,6 +386,17 @@ def asterisk_to_min_max(field, time_filter, search_engine_endpoint, actual_param
 
     start, end = parse_solr_time_range_as_pair(time_filter)
     if start == '*' or end == '*':
+        # bounds maintained by the indexers, for the core of the endpoint
+        core_url = search_engine_endpoint.rstrip('/').rsplit('/', 1)[0]
+        bounds = time_bounds.get_bounds(core_url) if field == TIME_BOUNDS_FIELD else None
+        if bounds:
+            date_min, date_max = bounds
+            if start != '*':
+                date_min = start
+            if end != '*':
+                date_max = end
+            return "[{0} TO {1}]".format(date_min, date_max)
+
         params_stats = {
             "q": "*:*",
             "rows": 0,
@@ -341,13 +404,15 @@ def asterisk_to_min_max(field, time_filter, search_engine_endpoint, actual_param
             "stats": "true",
             "wt": "json"
         }
-        res_stats = requests.get(search_engine_endpoint, params=params_stats)
+        res_stats = search_transport.get(search_engine_endpoint, params=params_stats)
 
         if res_stats.ok:
 
             stats_date_field = res_stats.json()["stats"]["stats_fields"][field]
             date_min = stats_date_field["min"]
             date_max = stats_date_field["max"]
+            if field == TIME_BOUNDS_FIELD:
+                time_bounds.set_bounds(core_url, date_min, date_max)
 
             if start != '*':
                 date_min = start
@@ -241,6 +241,62 @@ REGISTRY_SKIP_CELERY = strtobool(os.getenv('REGISTRY_SKIP_CELERY', 'False'))
 # For csw-transactions is not necessary to harvest layers for created services.
 REGISTRY_HARVEST_SERVICES = strtobool(os.getenv('REGISTRY_HARVEST_SERVICES', 'True'))
 
+# Concurrent capabilities harvesting: threads per check_services task, concurrent
+# requests to the same remote host, number of services per check_services task and
+# timeout in seconds of the capabilities requests.
+REGISTRY_HARVEST_MAX_WORKERS = int(os.getenv('REGISTRY_HARVEST_MAX_WORKERS', 8))
+REGISTRY_HARVEST_MAX_PER_HOST = int(os.getenv('REGISTRY_HARVEST_MAX_PER_HOST', 2))
+REGISTRY_HARVEST_BATCH_SIZE = int(os.getenv('REGISTRY_HARVEST_BATCH_SIZE', 50))
+REGISTRY_HARVEST_TIMEOUT = int(os.getenv('REGISTRY_HARVEST_TIMEOUT', 30))
+
+# Parsed capabilities documents are cached for REGISTRY_CAPABILITIES_CACHE_TTL seconds, keeping at most
+# REGISTRY_CAPABILITIES_CACHE_SIZE documents per process. Set REGISTRY_CAPABILITIES_CACHE_DIR to share
+# the OGC documents between worker processes through the file system.
+REGISTRY_CAPABILITIES_CACHE_TTL = int(os.getenv('REGISTRY_CAPABILITIES_CACHE_TTL', 600))
+REGISTRY_CAPABILITIES_CACHE_SIZE = int(os.getenv('REGISTRY_CAPABILITIES_CACHE_SIZE', 20))
+REGISTRY_CAPABILITIES_CACHE_DIR = os.getenv('REGISTRY_CAPABILITIES_CACHE_DIR', None)
+
+# Requests to each remote host are limited to REGISTRY_HOST_RATE per second, in bursts of REGISTRY_HOST_BURST,
+# a layer check waiting more than REGISTRY_HOST_MAX_WAIT seconds is retried later, up to REGISTRY_HOST_MAX_RETRIES
+# times. After REGISTRY_HOST_FAILURE_THRESHOLD consecutive failures, a host is not requested for
+# REGISTRY_HOST_CIRCUIT_TIMEOUT seconds. The state is shared by the workers through the Django cache.
+REGISTRY_HOST_RATE = float(os.getenv('REGISTRY_HOST_RATE', 2))
+REGISTRY_HOST_BURST = int(os.getenv('REGISTRY_HOST_BURST', 5))
+REGISTRY_HOST_MAX_WAIT = float(os.getenv('REGISTRY_HOST_MAX_WAIT', 2))
+REGISTRY_HOST_MAX_RETRIES = int(os.getenv('REGISTRY_HOST_MAX_RETRIES', 10))
+REGISTRY_HOST_FAILURE_THRESHOLD = int(os.getenv('REGISTRY_HOST_FAILURE_THRESHOLD', 5))
+REGISTRY_HOST_CIRCUIT_TIMEOUT = int(os.getenv('REGISTRY_HOST_CIRCUIT_TIMEOUT', 600))
+
+# Layers waiting to be indexed are stored in the IndexQueueItem table. A claimed item which is not
+# processed after REGISTRY_INDEX_QUEUE_LEASE seconds can be claimed again, an item failing
+# REGISTRY_INDEX_QUEUE_MAX_RETRIES times is kept in the queue but not processed anymore.
+REGISTRY_INDEX_QUEUE_LEASE = int(os.getenv('REGISTRY_INDEX_QUEUE_LEASE', 300))
+REGISTRY_INDEX_QUEUE_MAX_RETRIES = int(os.getenv('REGISTRY_INDEX_QUEUE_MAX_RETRIES', 5))
+
+# Each check updates the statistics of its resource, including a reliability where the weight of the
+# last check is REGISTRY_CHECK_RELIABILITY_DECAY and the weight of the previous ones decays exponentially.
+REGISTRY_CHECK_RELIABILITY_DECAY = float(os.getenv('REGISTRY_CHECK_RELIABILITY_DECAY', 0.1))
+# Checks older than REGISTRY_CHECK_RETENTION_DAYS days are rolled up into hourly rollups, hourly rollups
+# older than REGISTRY_CHECK_HOURLY_RETENTION_DAYS days into daily rollups (0 disables the rollups).
+REGISTRY_CHECK_RETENTION_DAYS = int(os.getenv('REGISTRY_CHECK_RETENTION_DAYS', 30))
+REGISTRY_CHECK_HOURLY_RETENTION_DAYS = int(os.getenv('REGISTRY_CHECK_HOURLY_RETENTION_DAYS', 180))
+# Services and layers are checked every REGISTRY_CHECK_PERIOD minutes, adapted to their reliability, response
+# time and capabilities changes between REGISTRY_CHECK_MIN_PERIOD and REGISTRY_CHECK_MAX_PERIOD minutes, and
+# randomized by REGISTRY_CHECK_JITTER. The check_due_resources task, polled every REGISTRY_CHECK_SCHEDULER_PERIOD
+# minutes, starts at most REGISTRY_CHECK_BUDGET checks per minute.
+REGISTRY_CHECK_PERIOD = int(os.getenv('REGISTRY_CHECK_PERIOD', 1440))
+REGISTRY_CHECK_MIN_PERIOD = int(os.getenv('REGISTRY_CHECK_MIN_PERIOD', 60))
+REGISTRY_CHECK_MAX_PERIOD = int(os.getenv('REGISTRY_CHECK_MAX_PERIOD', 7 * 1440))
+REGISTRY_CHECK_JITTER = float(os.getenv('REGISTRY_CHECK_JITTER', 0.1))
+REGISTRY_CHECK_BUDGET = int(os.getenv('REGISTRY_CHECK_BUDGET', 60))
+REGISTRY_CHECK_SCHEDULER_PERIOD = int(os.getenv('REGISTRY_CHECK_SCHEDULER_PERIOD', 1))
+# Layers are checked with a minimal request (REGISTRY_LAYER_CHECK_MODE 'probe') timing out after
+# REGISTRY_PROBE_TIMEOUT seconds, their thumbnail is regenerated when their metadata or extent changed, or
+# when it is older than REGISTRY_THUMBNAIL_TTL days. Set 'thumbnail' to regenerate it at each check instead.
+REGISTRY_LAYER_CHECK_MODE = os.getenv('REGISTRY_LAYER_CHECK_MODE', 'probe')
+REGISTRY_PROBE_TIMEOUT = int(os.getenv('REGISTRY_PROBE_TIMEOUT', 10))
+REGISTRY_THUMBNAIL_TTL = int(os.getenv('REGISTRY_THUMBNAIL_TTL', 30))
+
 # WorldMap Service credentials (override this in local_settings or _ubuntu in production)
 REGISTRY_WORLDMAP_USERNAME = os.getenv('REGISTRY_WORLDMAP_USERNAME', 'hypermap')
 REGISTRY_WORLDMAP_PASSWORD = os.getenv('REGISTRY_WORLDMAP_PASSWORD', 'secret')
@@ -258,6 +314,32 @@ MAPPROXY_CONFIG = os.path.join(MEDIA_ROOT, 'mapproxy_config')
 # elasticsearch+https://user:pass/domain:port/
 REGISTRY_SEARCH_URL = os.getenv('REGISTRY_SEARCH_URL', 'solr+http://solr:8983')
 REGISTRY_SEARCH_BATCH_SIZE = int(os.getenv('REGISTRY_SEARCH_BATCH_SIZE', 50))
+# Seconds the Elasticsearch cluster version and the existing catalog indices are cached by each process.
+REGISTRY_SEARCH_INFO_TTL = int(os.getenv('REGISTRY_SEARCH_INFO_TTL', 300))
+# Requests to the search backend share a keep-alive connection pool of REGISTRY_SEARCH_POOL_SIZE
+# connections per host, time out after REGISTRY_SEARCH_TIMEOUT seconds and are retried
+# REGISTRY_SEARCH_RETRIES times with an exponential backoff of REGISTRY_SEARCH_BACKOFF seconds.
+REGISTRY_SEARCH_POOL_SIZE = int(os.getenv('REGISTRY_SEARCH_POOL_SIZE', 10))
+REGISTRY_SEARCH_TIMEOUT = int(os.getenv('REGISTRY_SEARCH_TIMEOUT', 30))
+REGISTRY_SEARCH_RETRIES = int(os.getenv('REGISTRY_SEARCH_RETRIES', 3))
+REGISTRY_SEARCH_BACKOFF = float(os.getenv('REGISTRY_SEARCH_BACKOFF', 0.1))
+# Search API responses are cached for REGISTRY_SEARCH_CACHE_TTL seconds (0 disables the cache), in the
+# Django cache and in memory, keeping at most REGISTRY_SEARCH_CACHE_SIZE responses per process.
+REGISTRY_SEARCH_CACHE_TTL = int(os.getenv('REGISTRY_SEARCH_CACHE_TTL', 300))
+REGISTRY_SEARCH_CACHE_SIZE = int(os.getenv('REGISTRY_SEARCH_CACHE_SIZE', 500))
+# Responses are not cached during REGISTRY_SEARCH_CACHE_DELAY seconds after a catalog index changed,
+# while the search backend makes the changes visible.
+REGISTRY_SEARCH_CACHE_DELAY = int(os.getenv('REGISTRY_SEARCH_CACHE_DELAY', 2))
+# Solr heatmaps are assembled from cached tiles of REGISTRY_SEARCH_HEATMAP_TILE_SIZE cells per side
+# (0 disables the tiles), cached as the search responses.
+REGISTRY_SEARCH_HEATMAP_TILE_SIZE = int(os.getenv('REGISTRY_SEARCH_HEATMAP_TILE_SIZE', 16))
+# Catalogs not answering a federated search within REGISTRY_SEARCH_FEDERATION_TIMEOUT seconds are skipped.
+REGISTRY_SEARCH_FEDERATION_TIMEOUT = float(os.getenv('REGISTRY_SEARCH_FEDERATION_TIMEOUT', 10))
+# Exports read REGISTRY_SEARCH_EXPORT_BATCH_SIZE documents per request to the search backend.
+REGISTRY_SEARCH_EXPORT_BATCH_SIZE = int(os.getenv('REGISTRY_SEARCH_EXPORT_BATCH_SIZE', 1000))
+# Validated search params and the backend requests built from them are kept for
+# REGISTRY_SEARCH_PLAN_CACHE_SIZE parameter sets per process (0 disables the query plans).
+REGISTRY_SEARCH_PLAN_CACHE_SIZE = int(os.getenv('REGISTRY_SEARCH_PLAN_CACHE_SIZE', 1000))
 SEARCH_TYPE = REGISTRY_SEARCH_URL.split('+')[0]
 SEARCH_URL = REGISTRY_SEARCH_URL.split('+')[1]
 
@@ -102,8 +102,8 @@ class TestBrowser(unittest.TestCase):
         print driver.current_url
         driver.find_element_by_link_text("Periodic tasks").click()
         print driver.current_url
-        print "> assert 3 periodic tasks. means beat is alive."
-        self.assertEqual("3 periodic tasks",
+        print "> assert 4 periodic tasks. means beat is alive."
+        self.assertEqual("4 periodic tasks",
                          driver.find_element_by_css_selector(
                              "p.paginator").text)
         driver.find_element_by_link_text("Home").click()